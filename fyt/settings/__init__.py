@@ -37,6 +37,30 @@ AWS_STORAGE_BUCKET_NAME = env.get('AWS_STORAGE_BUCKET_NAME')
 GOOGLE_MAPS_KEY = env.get('GOOGLE_MAPS_KEY')
 GOOGLE_MAPS_BROWSER_KEY = env.get('GOOGLE_MAPS_BROWSER_KEY')
 
+# Where to get directions from: 'google', or 'offline' to estimate
+# durations from the distance between stops. With DIRECTIONS_FALLBACK
+# directions are estimated whenever Google Maps fails.
+DIRECTIONS_BACKEND = env.get('DIRECTIONS_BACKEND', 'google')
+DIRECTIONS_FALLBACK = env.get('DIRECTIONS_FALLBACK', False)
+OFFLINE_ROAD_FACTOR = float(env.get('OFFLINE_ROAD_FACTOR', 1.4))
+OFFLINE_AVERAGE_SPEED = float(env.get('OFFLINE_AVERAGE_SPEED', 35))  # mph
+
+# Where to look up coordinates for the addresses of stops. The offline
+# geocoder only knows the addresses in OFFLINE_GEOCODES, and addresses
+# which are themselves coordinates.
+GEOCODING_BACKEND = env.get('GEOCODING_BACKEND', DIRECTIONS_BACKEND)
+OFFLINE_GEOCODES = {}
+
+# Requests to Google Maps are limited to MAPS_RATE_LIMIT per second, in
+# bursts of up to MAPS_BURST, and failed requests are retried for up to
+# MAPS_RETRY_TIMEOUT seconds. Usage is recorded every MAPS_METRICS_INTERVAL
+# seconds and compared to MAPS_DAILY_QUOTA.
+MAPS_RATE_LIMIT = float(env.get('MAPS_RATE_LIMIT', 10))
+MAPS_BURST = int(env.get('MAPS_BURST', 20))
+MAPS_RETRY_TIMEOUT = int(env.get('MAPS_RETRY_TIMEOUT', 30))
+MAPS_METRICS_INTERVAL = int(env.get('MAPS_METRICS_INTERVAL', 60))
+MAPS_DAILY_QUOTA = int(env.get('MAPS_DAILY_QUOTA', 2500))
+
 # Don't overwrite identically named files
 AWS_S3_FILE_OVERWRITE = False
 AWS_DEFAULT_ACL = None
@@ -2,15 +2,20 @@ import inspect
 import itertools
 import logging
 import os
+import shutil
 import string
+import tempfile
 
 from django.conf import settings
+from django.test.utils import override_settings
 from django_webtest import WebTest
 from model_mommy import mommy, random_gen
 from vcr import VCR
 
 from fyt.core.models import TripsYear
 from fyt.permissions.permissions import groups
+from fyt.transport.maps import metrics
+from fyt.transport.models import transport_config_cache
 from fyt.users.models import DartmouthUser
 
 
@@ -73,6 +78,29 @@ class FytTestCase(WebTest):
         super()._unpatch_settings()
         logging.disable(logging.NOTSET)
 
+    def _pre_setup(self):
+        super()._pre_setup()
+
+        # The test database is rolled back between tests, without
+        # signals, so cached transport configurations would leak.
+        transport_config_cache.invalidate()
+
+        # Don't write metrics of Maps requests made by previous tests
+        metrics.reset()
+
+        # Store files in a temporary directory instead of S3
+        self._media_root = tempfile.mkdtemp()
+        self._file_storage = override_settings(
+            DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+            MEDIA_ROOT=self._media_root,
+        )
+        self._file_storage.enable()
+
+    def _post_teardown(self):
+        self._file_storage.disable()
+        shutil.rmtree(self._media_root)
+        super()._post_teardown()
+
     def init_trips_year(self):
         """
         Initialize a current trips_year object in the test database.
@@ -0,0 +1,413 @@
+"""
+Benchmarks for the transport views and signals, on a synthetic trips year.
+
+The year is generated with model_mommy and directions are estimated by the
+offline backend, so benchmarks don't depend on the network. Everything is
+rolled back afterwards. See the benchmark_transport command.
+"""
+
+import math
+import platform
+import random
+import statistics
+import string
+import tempfile
+import time
+from datetime import date, timedelta
+from datetime import time as clock
+
+import django
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import resolve, reverse
+from model_mommy import mommy
+
+from fyt.core.models import TripsYear
+from fyt.incoming.models import IncomingStudent
+from fyt.permissions.permissions import groups
+from fyt.transport.models import (
+    BusIndex,
+    DistanceMatrix,
+    ExternalBus,
+    InternalBus,
+    Route,
+    Stop,
+    StoredPacket,
+    TransportConfig,
+    Vehicle,
+    transport_config_cache,
+)
+from fyt.trips.models import Campsite, Section, Trip, TripTemplate, TripType
+from fyt.users.models import DartmouthUser
+
+
+HANOVER = (43.7031377, -72.2898190)
+LODGE = (43.977253, -71.8154831)
+MILES_PER_DEGREE = 69
+
+
+class SyntheticYear:
+    """
+    A trips year with sections, trip templates, stops, routes, buses and
+    trippees, shaped like a real year.
+
+    Internal stops are scattered within `radius` degrees of Hanover and
+    split between internal routes. Every template runs in every section,
+    with `trippees` trippees on each trip. Every third section is local,
+    and its trippees ride external buses.
+    """
+
+    def __init__(
+        self,
+        trips_year,
+        sections=10,
+        templates=40,
+        stops=40,
+        routes=6,
+        external_routes=4,
+        trippees=8,
+        radius=0.8,
+        seed=0,
+    ):
+        self.trips_year = trips_year
+        self.n_sections = sections
+        self.n_templates = templates
+        self.n_stops = stops
+        self.n_routes = routes
+        self.n_external_routes = external_routes
+        self.n_trippees = trippees
+        self.radius = radius
+        self.random = random.Random(seed)
+
+    @property
+    def config(self):
+        return {
+            'sections': self.n_sections,
+            'templates': self.n_templates,
+            'stops': self.n_stops,
+            'routes': self.n_routes,
+            'external_routes': self.n_external_routes,
+            'trippees': self.n_trippees,
+        }
+
+    def make(self, model, **kwargs):
+        return mommy.make(model, trips_year=self.trips_year, **kwargs)
+
+    def make_stop(self, center, radius, **kwargs):
+        lat = center[0] + self.random.uniform(-radius, radius)
+        lng = center[1] + self.random.uniform(-radius, radius)
+        distance = math.hypot(lat - HANOVER[0], lng - HANOVER[1]) * MILES_PER_DEGREE
+        return self.make(
+            Stop,
+            lat_lng=f'{lat:.6f},{lng:.6f}',
+            address='',
+            distance=round(distance),
+            **kwargs,
+        )
+
+    def build(self):
+        self.make_transport()
+        self.make_trips()
+        self.make_internal_buses()
+        self.make_external_buses()
+        return self
+
+    def make_transport(self):
+        self.make(
+            TransportConfig,
+            hanover=self.make_stop(HANOVER, 0),
+            lodge=self.make_stop(LODGE, 0),
+        )
+
+        van = self.make(Vehicle, name='Van', capacity=14, chartered=False)
+        bus = self.make(Vehicle, name='Bus', capacity=56, chartered=True)
+
+        self.routes = [
+            self.make(
+                Route,
+                name=f'Route {i}',
+                category=Route.INTERNAL,
+                vehicle=bus if i % 2 else van,
+            )
+            for i in range(self.n_routes)
+        ]
+        self.stops = [
+            self.make_stop(HANOVER, self.radius, route=self.routes[i % self.n_routes])
+            for i in range(self.n_stops)
+        ]
+
+        self.external_routes = [
+            self.make(Route, name=f'External {i}', category=Route.EXTERNAL, vehicle=bus)
+            for i in range(self.n_external_routes)
+        ]
+        self.external_stops = [
+            self.make_stop(
+                HANOVER,
+                self.radius * 4,
+                route=route,
+                cost_round_trip=50,
+                cost_one_way=30,
+                pickup_time=self.random.choice([clock(7), clock(9)]),
+                dropoff_time=clock(17),
+            )
+            for route in self.external_routes
+            for _ in range(5)
+        ]
+
+    def make_trips(self):
+        triptypes = [self.make(TripType) for _ in range(4)]
+        campsites = [self.make(Campsite) for _ in range(10)]
+
+        self.templates = [
+            self.make(
+                TripTemplate,
+                name=100 + i,
+                max_trippees=10,
+                triptype=self.random.choice(triptypes),
+                campsite1=self.random.choice(campsites),
+                campsite2=self.random.choice(campsites),
+                dropoff_stop=self.random.choice(self.stops),
+                pickup_stop=self.random.choice(self.stops),
+                return_route=self.random.choice(self.routes),
+                description__trips_year=self.trips_year,
+            )
+            for i in range(self.n_templates)
+        ]
+
+        start = date(self.trips_year.year, 8, 20)
+        self.sections = [
+            self.make(
+                Section,
+                name=string.ascii_uppercase[i % 26],
+                leaders_arrive=start + timedelta(days=i),
+                is_local=(i % 3 == 0),
+            )
+            for i in range(self.n_sections)
+        ]
+
+        self.trips = [
+            self.make(Trip, template=template, section=section)
+            for section in self.sections
+            for template in self.templates
+        ]
+
+        trippees = []
+        for trip in self.trips:
+            for _ in range(self.n_trippees):
+                netid = f'bench{len(trippees)}'
+                stop = None
+                if trip.section.is_local and self.external_stops:
+                    stop = self.random.choice(self.external_stops)
+                trippees.append(
+                    mommy.prepare(
+                        IncomingStudent,
+                        trips_year=self.trips_year,
+                        netid=netid,
+                        class_year='2024',
+                        trip_assignment=trip,
+                        bus_assignment_round_trip=stop,
+                    )
+                )
+        IncomingStudent.objects.bulk_create(trippees)
+        # bulk_create skips the signals which count trippees
+        Trip.objects.update_counts([trip.pk for trip in self.trips])
+
+    def make_internal_buses(self):
+        scheduled = set()
+        for trip in self.trips:
+            scheduled.add((trip.get_dropoff_route().pk, trip.dropoff_date))
+            scheduled.add((trip.get_pickup_route().pk, trip.pickup_date))
+            scheduled.add((trip.get_return_route().pk, trip.return_date))
+
+        self.internal_buses = [
+            self.make(InternalBus, route_id=route, date=day)
+            for route, day in sorted(scheduled)
+        ]
+
+    def make_external_buses(self):
+        self.external_buses = [
+            self.make(ExternalBus, route=route, section=section)
+            for route in self.external_routes
+            for section in self.sections
+            if section.is_local
+        ]
+
+
+class Benchmark:
+    """
+    Time transport views and signals, and count their queries.
+
+    Each benchmark is run `repeat` times. Changes made by signal benchmarks
+    are rolled back after each run.
+    """
+
+    def __init__(self, year, repeat=3):
+        self.year = year
+        self.trips_year = year.trips_year
+        self.repeat = repeat
+        self.factory = RequestFactory()
+        self.user = DartmouthUser.objects.create(
+            netid='benchmark', name='Benchmark', email='benchmark@dartmouth.edu'
+        )
+        self.user.groups.add(groups.directors)
+
+    def measure(self, func, setup=None):
+        """
+        Run func `repeat` times. Returns a dict of timings and query counts.
+        """
+        seconds = []
+        queries = []
+        for _ in range(self.repeat):
+            with transaction.atomic():
+                args = setup() if setup else ()
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    func(*args)
+                    seconds.append(time.perf_counter() - start)
+                queries.append(len(captured))
+                transaction.set_rollback(True)
+            BusIndex.invalidate()
+            transport_config_cache.invalidate()
+
+        return {
+            'seconds': seconds,
+            'min_seconds': min(seconds),
+            'median_seconds': statistics.median(seconds),
+            'queries': queries,
+        }
+
+    def get(self, url):
+        request = self.factory.get(url)
+        request.user = self.user
+        match = resolve(url)
+        response = match.func(request, *match.args, **match.kwargs)
+        if response.status_code != 200:
+            raise AssertionError(f'{url} returned {response.status_code}')
+        if response.streaming:
+            b''.join(response.streaming_content)
+            response.close()
+        else:
+            response.render()
+        return response
+
+    def url(self, name, **kwargs):
+        return reverse(name, kwargs=dict(kwargs, trips_year=self.trips_year))
+
+    def views(self):
+        bus = self.year.internal_buses[0]
+        packet = self.url('core:internalbus:packet')
+        return {
+            'InternalBusMatrix': self.url('core:internalbus:index'),
+            'TransportChecklist': self.url(
+                'core:internalbus:checklist', route_pk=bus.route_id, date=bus.date
+            ),
+            'InternalBusPacket': packet,
+            'ExternalBusMatrix': self.url('core:externalbus:matrix'),
+        }
+
+    def signals(self):
+        """
+        Changes which cascade through the transport signals.
+        """
+        year = self.year
+
+        def create_bus():
+            bus = year.internal_buses[0]
+            InternalBus.objects.filter(pk=bus.pk).delete()
+            return (bus.route_id, bus.date)
+
+        def change_trip_route():
+            trip = Trip.objects.get(pk=year.trips[0].pk)
+            trip.dropoff_route = year.routes[-1]
+            trip.save()
+
+        def change_stop_route():
+            stop = Stop.objects.get(pk=year.stops[0].pk)
+            stop.route = year.routes[-1]
+            stop.save()
+
+        def change_stop_address():
+            stop = Stop.objects.get(pk=year.stops[0].pk)
+            stop.lat_lng = '43.9,-72.0'
+            stop.save()
+
+        def change_template_stop():
+            template = TripTemplate.objects.get(pk=year.templates[0].pk)
+            template.dropoff_stop = year.stops[-1]
+            template.save()
+
+        return {
+            'create InternalBus': (
+                lambda route, day: InternalBus.objects.create(
+                    trips_year=self.trips_year, route_id=route, date=day
+                ),
+                create_bus,
+            ),
+            'change Trip.dropoff_route': (change_trip_route, None),
+            'change Stop.route': (change_stop_route, None),
+            'change Stop.lat_lng': (change_stop_address, None),
+            'change TripTemplate.dropoff_stop': (change_template_stop, None),
+        }
+
+    def run(self):
+        results = {}
+
+        for name, url in self.views().items():
+            results[name] = self.measure(lambda: self.get(url))
+
+        # Packets are stored after they are first rendered
+        packet = self.views()['InternalBusPacket']
+        self.get(packet)
+        results['InternalBusPacket (stored)'] = self.measure(lambda: self.get(packet))
+        StoredPacket.objects.filter(trips_year=self.trips_year).delete()
+
+        for name, (func, setup) in self.signals().items():
+            results[name] = self.measure(func, setup)
+
+        return {
+            'config': dict(self.year.config, repeat=self.repeat),
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'results': results,
+        }
+
+
+def run_benchmarks(repeat=3, **config):
+    """
+    Build a synthetic trips year and benchmark it. Nothing is saved.
+
+    Returns the report, a dict which can be serialized as json.
+    """
+    media_root = tempfile.TemporaryDirectory()
+    offline = override_settings(
+        DIRECTIONS_BACKEND='offline',
+        GEOCODING_BACKEND='offline',
+        DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+        MEDIA_ROOT=media_root.name,
+    )
+
+    with media_root, offline, transaction.atomic():
+        last = TripsYear.objects.order_by('-year').first()
+        TripsYear.objects.update(is_current=False)
+        trips_year = TripsYear.objects.create(
+            year=(last.year + 1 if last else date.today().year), is_current=True
+        )
+
+        start = time.perf_counter()
+        year = SyntheticYear(trips_year, **config).build()
+        DistanceMatrix.objects.compute(trips_year)
+        build_seconds = time.perf_counter() - start
+
+        report = Benchmark(year, repeat=repeat).run()
+        report['build_seconds'] = build_seconds
+
+        transaction.set_rollback(True)
+
+    BusIndex.invalidate()
+    transport_config_cache.invalidate()
+
+    return report
@@ -0,0 +1,54 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from fyt.transport.benchmark import run_benchmarks
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Benchmark the transport views and signals on a synthetic trips year. '
+        'The synthetic year is rolled back afterwards'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sections', type=int, default=10)
+        parser.add_argument('--templates', type=int, default=40)
+        parser.add_argument('--stops', type=int, default=40)
+        parser.add_argument('--routes', type=int, default=6)
+        parser.add_argument('--external-routes', type=int, default=4)
+        parser.add_argument(
+            '--trippees', type=int, default=8, help='number of trippees on each trip'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='number of times to run each benchmark',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='write the json report to this file')
+
+    def handle(self, *args, **options):
+        report = run_benchmarks(
+            repeat=options['repeat'],
+            sections=options['sections'],
+            templates=options['templates'],
+            stops=options['stops'],
+            routes=options['routes'],
+            external_routes=options['external_routes'],
+            trippees=options['trippees'],
+            seed=options['seed'],
+        )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+        self.stdout.write(f'Built synthetic year in {report["build_seconds"]:.2f}s')
+        for name, result in report['results'].items():
+            self.stdout.write(
+                f'{name}: {result["median_seconds"] * 1000:.1f}ms, '
+                f'{max(result["queries"])} queries'
+            )
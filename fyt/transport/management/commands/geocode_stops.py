@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from fyt.core.models import TripsYear
+from fyt.transport.models import Stop
+
+
+class Command(BaseCommand):
+
+    help = 'Look up coordinates for stops in the current trips year'
+
+    def handle(self, *args, **options):
+        trips_year = TripsYear.objects.current()
+
+        pending = Stop.objects.needs_geocoding(trips_year).count()
+        updated = Stop.objects.geocode(trips_year)
+
+        for stop in updated:
+            self.stdout.write(f'Geocoded {stop.location_str()}')
+
+        missing = pending - len(updated)
+        if missing:
+            self.stderr.write(f'Could not geocode {missing} stops')
+
+        self.stdout.write(f'Geocoded {len(updated)} stops in {trips_year}')
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from fyt.core.models import TripsYear
+from fyt.transport.models import RouteProposal, TransportConfig
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Propose internal bus routes for all trips in the current trips year '
+        'which use as few buses and vehicle-miles as possible'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--apply',
+            action='store_true',
+            help='apply the stored proposal instead of computing a new one',
+        )
+
+    def handle(self, *args, **options):
+        trips_year = TripsYear.objects.current()
+
+        if options['apply']:
+            # Show what will be changed, and which buses deleted, first
+            self.write_diff(RouteProposal.objects.diff(trips_year))
+            diff = RouteProposal.objects.apply(trips_year)
+            self.stdout.write(f'Applied {len(diff.changes)} route changes')
+            return
+
+        try:
+            optimizer = RouteProposal.objects.propose(trips_year)
+        except TransportConfig.DoesNotExist:
+            raise CommandError(f'Hanover and the Lodge are not set for {trips_year}')
+
+        self.write_cost('Before', optimizer.initial_cost)
+        self.write_cost('After', optimizer.cost())
+        self.write_diff(RouteProposal.objects.diff(trips_year))
+
+    def write_cost(self, label, cost):
+        self.stdout.write(
+            f'{label}: {cost.buses} buses, {cost.miles:.0f} miles, '
+            f'{cost.excess} passengers over capacity'
+        )
+
+    def write_diff(self, diff):
+        for proposal in diff.changes:
+            self.stdout.write(
+                f'{proposal.trip} {proposal.stop_type.lower()} on {proposal.date}: '
+                f'{proposal.current_route} -> {proposal.route}'
+            )
+        for route, date in diff.new_buses:
+            self.stdout.write(f'Schedule bus: {route} on {date}')
+        for bus in diff.unused_buses:
+            self.stdout.write(f'Remove bus: {bus}')
+        for bus in diff.kept_buses:
+            self.stdout.write(f'Keep unused bus with notes or custom times: {bus}')
+        if not diff:
+            self.stdout.write('No changes')
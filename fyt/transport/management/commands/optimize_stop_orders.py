@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from fyt.core.models import TripsYear
+from fyt.transport.models import InternalBus
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Reorder the stops of every internal bus in the current trips year '
+        'to minimize travel time. Buses with custom times are skipped.'
+    )
+
+    def handle(self, *args, **options):
+        trips_year = TripsYear.objects.current()
+
+        buses = InternalBus.objects.optimize_stop_orders(trips_year)
+        for bus in buses:
+            self.stdout.write(f'Reordered {bus}')
+        self.stdout.write(f'Reordered {len(buses)} buses')
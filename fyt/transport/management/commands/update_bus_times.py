@@ -0,0 +1,117 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fyt.core.models import TripsYear
+from fyt.transport.maps import MapError, metrics
+from fyt.transport.models import InternalBus, LazyDistanceMatrix
+from fyt.transport.views import render_packets
+
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Recompute directions and stop times for all internal buses which '
+        'have been marked dirty'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop', action='store_true', help='keep polling for dirty buses'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=30,
+            help='number of seconds to wait between polls',
+        )
+        parser.add_argument(
+            '--packets',
+            action='store_true',
+            help=(
+                'render packets which are out of date when starting and after '
+                'updating buses'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        first = True
+        while True:
+            updated = self.update_dirty_buses()
+            # Other changes to packets are rendered when they are downloaded,
+            # so don't check every packet on each poll
+            if options['packets'] and (first or updated):
+                self.render_packets()
+            first = False
+            metrics.flush(force=True)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def update_dirty_buses(self):
+        """
+        Return the number of buses which were updated.
+        """
+        trips_year = TripsYear.objects.current()
+        dirty = InternalBus.objects.dirty(trips_year).values_list('pk', flat=True)
+        matrix = LazyDistanceMatrix(trips_year)
+        updated = 0
+
+        for pk in dirty:
+            try:
+                bus = self.update_bus(trips_year, pk, matrix)
+            except MapError as exc:
+                self.stderr.write(f'Could not update bus {pk}: {exc}')
+            except Exception as exc:
+                # Don't stop the worker; the bus is left dirty and is
+                # retried on the next poll.
+                log.exception('Could not update bus %s', pk)
+                self.stderr.write(f'Could not update bus {pk}: {exc!r}')
+            else:
+                if bus is not None:
+                    self.stdout.write(f'Updated {bus}')
+                    updated += 1
+
+        return updated
+
+    def update_bus(self, trips_year, pk, matrix):
+        bus = InternalBus.objects.dirty(trips_year).filter(pk=pk).first()
+        if bus is None:
+            return None
+
+        # Request directions before locking the bus, so that the lock is
+        # not held while waiting on Google Maps. Requested legs are cached,
+        # so computing the directions again below does not request them.
+        bus.distance_matrix = matrix
+        bus.directions
+
+        # Lock the bus while it is updated. Other workers skip locked
+        # buses, and signals which mark the bus dirty again wait until
+        # the update is committed so that changes are not lost. The bus
+        # is skipped if another worker updated it in the meantime.
+        with transaction.atomic():
+            bus = (
+                InternalBus.objects.dirty(trips_year)
+                .select_for_update(skip_locked=True, of=('self',))
+                .filter(pk=pk)
+                .first()
+            )
+            if bus is not None:
+                bus.distance_matrix = matrix
+                bus.update_stop_times()
+            return bus
+
+    def render_packets(self):
+        trips_year = TripsYear.objects.current()
+        try:
+            packets = render_packets(trips_year)
+        except MapError as exc:
+            self.stderr.write(f'Could not render packets: {exc}')
+        else:
+            for packet in packets:
+                self.stdout.write(f'Rendered {packet}')
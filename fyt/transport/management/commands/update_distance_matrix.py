@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from fyt.core.models import TripsYear
+from fyt.transport.maps import MapError
+from fyt.transport.models import DistanceMatrix
+
+
+class Command(BaseCommand):
+
+    help = 'Compute travel times between all stops in the current trips year'
+
+    def handle(self, *args, **options):
+        trips_year = TripsYear.objects.current()
+
+        try:
+            matrix = DistanceMatrix.objects.compute(trips_year)
+        except MapError as exc:
+            raise CommandError(f'Could not compute distance matrix: {exc}')
+
+        size = len(matrix.locations)
+        self.stdout.write(f'Computed {size}x{size} distance matrix for {trips_year}')
@@ -1,7 +1,18 @@
-from django.db import models
-from django.db.models import Q
+import hashlib
+import itertools
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.db import models, transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.text import slugify
 
 from fyt.transport.category import EXTERNAL, INTERNAL
+from fyt.trips.constants import FIRST_CAMPSITE_DELTA, LODGE_ARRIVAL_DELTA
 from fyt.utils.matrix import OrderedMatrix
 
 
@@ -9,6 +20,41 @@ class StopManager(models.Manager):
     def external(self, trips_year):
         return self.filter(trips_year=trips_year, route__category=EXTERNAL)
 
+    def needs_geocoding(self, trips_year):
+        """
+        Stops which only have an address, or whose coordinates were
+        geocoded from a previous address.
+        """
+        stale = ~Q(geocoded_address='') & ~Q(geocoded_address=F('address'))
+        return (
+            self.filter(trips_year=trips_year)
+            .exclude(address='')
+            .filter(Q(lat_lng='') | stale)
+        )
+
+    def geocode(self, trips_year):
+        """
+        Look up coordinates for all stops in trips_year which need
+        geocoding. Stops whose address cannot be geocoded are skipped.
+
+        Stops are saved one at a time so that signals mark the affected
+        buses dirty. Returns the updated stops.
+        """
+        from fyt.transport.maps import geocode
+
+        stops = list(self.needs_geocoding(trips_year))
+        coordinates = geocode(stop.address for stop in stops)
+
+        updated = []
+        for stop in stops:
+            if stop.address in coordinates:
+                stop.lat_lng = coordinates[stop.address]
+                stop.geocoded_address = stop.address
+                stop.save(update_fields=['lat_lng', 'geocoded_address'])
+                updated.append(stop)
+
+        return updated
+
 
 class RouteManager(models.Manager):
     def internal(self, trips_year):
@@ -26,10 +72,110 @@ class InternalBusManager(models.Manager):
     def internal(self, trips_year):
         return self.filter(trips_year=trips_year, route__category=INTERNAL)
 
+    def dirty(self, trips_year):
+        """
+        Buses whose directions and times need to be recomputed.
+        """
+        return self.filter(trips_year=trips_year, dirty=True)
+
+    def optimize_stop_orders(self, trips_year):
+        """
+        Optimize the order of stops on every bus in trips_year. Buses which
+        use custom times are skipped, since the times were entered for the
+        current order. Returns the reordered buses.
+        """
+        from fyt.transport.models import DistanceMatrix
+        from fyt.transport.optimizer import TravelTimes
+
+        times = TravelTimes(DistanceMatrix.objects.for_year(trips_year))
+        buses = (
+            self.internal(trips_year)
+            .filter(use_custom_times=False)
+            .select_related('route__vehicle')
+        )
+        return [bus for bus in buses if bus.optimize_stop_order(times)]
+
     def validate(self):
-        for bus in self.order_by('trips_year'):
-            bus.validate_stop_ordering()
-            print(f'validated {bus}')
+        for trips_year in self.values_list('trips_year', flat=True).distinct():
+            errors = self.stop_ordering_errors(trips_year)
+            if errors:
+                raise ValidationError(
+                    [msg for bus_errors in errors.values() for msg in bus_errors]
+                )
+            print(f'validated {trips_year}')
+
+    def stop_ordering_errors(self, trips_year, buses=None):
+        """
+        Sanity check the stop orderings of all buses in trips_year at once.
+
+        The trips that each bus should drop off and pick up are compared to
+        the StopOrder table. Pass `buses` to only check some of the buses.
+
+        Returns a dict mapping each bus with unordered or surplus trips to
+        a list of error messages.
+        """
+        from fyt.transport.models import StopOrder
+        from fyt.trips.models import Trip
+
+        if buses is None:
+            buses = self.filter(trips_year=trips_year)
+        buses = {(bus.route_id, bus.date): bus for bus in buses}
+
+        # Trips which should be ordered, keyed by (bus pk, stop type)
+        expected = defaultdict(set)
+        trips = Trip.objects.filter(trips_year=trips_year).values_list(
+            'pk',
+            'dropoff_route',
+            'template__dropoff_stop__route',
+            'pickup_route',
+            'template__pickup_stop__route',
+            'section__leaders_arrive',
+        )
+        for pk, dropoff, default_dropoff, pickup, default_pickup, arrive in trips:
+            for stop_type, route, delta in (
+                (StopOrder.DROPOFF, dropoff or default_dropoff, FIRST_CAMPSITE_DELTA),
+                (StopOrder.PICKUP, pickup or default_pickup, LODGE_ARRIVAL_DELTA),
+            ):
+                bus = buses.get((route, arrive + timedelta(days=delta)))
+                if bus is not None:
+                    expected[bus.pk, stop_type].add(pk)
+
+        ordered = defaultdict(set)
+        stoporders = StopOrder.objects.filter(trips_year=trips_year).values_list(
+            'bus', 'stop_type', 'trip'
+        )
+        for bus_pk, stop_type, trip_pk in stoporders:
+            ordered[bus_pk, stop_type].add(trip_pk)
+
+        problems = []
+        for bus in buses.values():
+            for stop_type in (StopOrder.PICKUP, StopOrder.DROPOFF):
+                key = (bus.pk, stop_type)
+                unordered = expected[key] - ordered[key]
+                surplus = ordered[key] - expected[key]
+                if unordered or surplus:
+                    problems.append((bus, stop_type, unordered, surplus))
+
+        # Only load the offending trips
+        trips = Trip.objects.in_bulk(
+            [pk for *_, unordered, surplus in problems for pk in unordered | surplus]
+        )
+
+        errors = defaultdict(list)
+        for bus, stop_type, unordered, surplus in problems:
+            if unordered:
+                unordered = set(trips[pk] for pk in unordered)
+                errors[bus].append(
+                    f'Unordered {stop_type} trips for bus {bus}: {unordered}'
+                )
+            if surplus:
+                # a trip has been removed from the route
+                surplus = set(trips[pk] for pk in surplus)
+                errors[bus].append(
+                    f'Surplus {stop_type} trips for bus {bus}: {surplus}'
+                )
+
+        return dict(errors)
 
 
 def external_route_matrix(trips_year, default=None):
@@ -76,7 +222,7 @@ class ExternalPassengerManager(models.Manager):
                 models.Q(bus_assignment_round_trip__isnull=False)
                 | models.Q(bus_assignment_to_hanover__isnull=False)
             ),
-            lambda p: p.bus_assignment_to_hanover,
+            'bus_assignment_to_hanover',
         )
 
     def matrix_from_hanover(self, trips_year):
@@ -90,30 +236,43 @@ class ExternalPassengerManager(models.Manager):
                 models.Q(bus_assignment_round_trip__isnull=False)
                 | models.Q(bus_assignment_from_hanover__isnull=False)
             ),
-            lambda p: p.bus_assignment_from_hanover,
+            'bus_assignment_from_hanover',
         )
 
-    def _matrix(self, trips_year, condition, getter):
+    def _matrix(self, trips_year, condition, one_way):
         """
-        getter returns the one-way bus stop from the IncStudent
+        one_way is the name of the one-way bus stop field of IncomingStudent.
+
+        Passengers are counted by the database, grouped by section and by the
+        route of their round-trip stop, or their one-way stop if they do not
+        have a round-trip stop.
         """
         from fyt.incoming.models import IncomingStudent
 
         matrix = external_route_matrix(trips_year, default=0)
-        passengers = IncomingStudent.objects.filter(
-            condition,
-            trips_year=trips_year,
-            trip_assignment__isnull=False,
-            trip_assignment__section__is_local=True,
-        ).select_related(
-            'bus_assignment_round_trip__route',
-            'bus_assignment_to_hanover__route',
-            'bus_assignment_from_hanover__route',
-            'trip_assignment__section',
-        )
-        for p in passengers:
-            bus = p.bus_assignment_round_trip or getter(p)
-            matrix[bus.route][p.trip_assignment.section] += 1
+        if not matrix:
+            return matrix
+
+        routes = {route.pk: route for route in matrix}
+        sections = {section.pk: section for section in next(iter(matrix.values()))}
+
+        counts = (
+            IncomingStudent.objects.filter(
+                condition,
+                trips_year=trips_year,
+                trip_assignment__isnull=False,
+                trip_assignment__section__is_local=True,
+            )
+            .annotate(
+                route=Coalesce('bus_assignment_round_trip__route', f'{one_way}__route')
+            )
+            .values_list('route', 'trip_assignment__section')
+            .annotate(count=Count('pk'))
+            .order_by()
+        )
+        for route, section, count in counts:
+            if route in routes and section in sections:
+                matrix[routes[route]][sections[section]] = count
 
         return matrix
 
@@ -143,3 +302,354 @@ class StopOrderManager(models.Manager):
             'trip__template__dropoff_stop',
             'trip__template__pickup_stop',
         )
+
+
+class CachedLegManager(models.Manager):
+    """
+    Manager for the CachedLeg model.
+
+    Legs are keyed by (origin, destination) pairs of stop locations.
+    """
+
+    def fresh(self):
+        return self.filter(created_at__gt=(timezone.now() - self.model.TTL))
+
+    def lookup(self, pairs):
+        """
+        Return a dict mapping each cached (origin, destination) pair to the
+        raw json of the leg. Pairs which are not cached, or whose cached
+        entries have expired, are omitted.
+        """
+        origins = set(origin for origin, _ in pairs)
+        destinations = set(destination for _, destination in pairs)
+
+        cached = self.fresh().filter(origin__in=origins, destination__in=destinations)
+        legs = {(leg.origin, leg.destination): leg.raw for leg in cached}
+
+        return {pair: legs[pair] for pair in pairs if pair in legs}
+
+    def store(self, legs):
+        """
+        Cache the raw json of legs, a dict keyed by (origin, destination).
+        """
+        if not legs:
+            return
+
+        stale = Q()
+        for origin, destination in legs:
+            stale |= Q(origin=origin, destination=destination)
+
+        # Another request may cache the same legs at the same time; its
+        # legs are kept instead of raising an IntegrityError
+        with transaction.atomic():
+            self.filter(stale).delete()
+            self.bulk_create(
+                [
+                    self.model(origin=origin, destination=destination, raw=raw)
+                    for (origin, destination), raw in legs.items()
+                ],
+                ignore_conflicts=True,
+            )
+
+    def invalidate(self, location):
+        """
+        Delete all cached legs which start or end at location.
+        """
+        return self.filter(Q(origin=location) | Q(destination=location)).delete()
+
+
+class CachedGeocodeManager(models.Manager):
+    """
+    Manager for the CachedGeocode model.
+    """
+
+    def fresh(self):
+        return self.filter(created_at__gt=(timezone.now() - self.model.TTL))
+
+    def lookup(self, addresses):
+        """
+        Return a dict mapping each cached address to its coordinates.
+        """
+        cached = self.fresh().filter(address__in=addresses)
+        return {geocode.address: geocode.lat_lng for geocode in cached}
+
+    def store(self, coordinates):
+        """
+        Cache coordinates, a dict keyed by address.
+        """
+        if not coordinates:
+            return
+
+        # Another request may cache the same addresses at the same time;
+        # its coordinates are kept instead of raising an IntegrityError
+        with transaction.atomic():
+            self.filter(address__in=coordinates).delete()
+            self.bulk_create(
+                [
+                    self.model(address=address, lat_lng=lat_lng)
+                    for address, lat_lng in coordinates.items()
+                ],
+                ignore_conflicts=True,
+            )
+
+
+class MapsUsageManager(models.Manager):
+    def record(self, api, counts):
+        """
+        Add counts, as collected by `maps.Metrics`, to today's usage of api.
+        """
+        with transaction.atomic():
+            usage, _ = self.select_for_update().get_or_create(
+                date=timezone.localdate(), api=api
+            )
+            usage.requests += counts['requests']
+            usage.failures += counts['failures']
+            usage.cache_hits += counts['cache_hits']
+            usage.cache_misses += counts['cache_misses']
+            usage.latency += counts['latency']
+            usage.histogram = [
+                a + b
+                for a, b in itertools.zip_longest(
+                    usage.histogram, counts['histogram'], fillvalue=0
+                )
+            ]
+            usage.save()
+        return usage
+
+    def recent(self, days=30):
+        """
+        Usage over the last few days, most recent first.
+        """
+        since = timezone.localdate() - timedelta(days=days)
+        return self.filter(date__gt=since).order_by('-date', 'api')
+
+
+class DistanceMatrixManager(models.Manager):
+    def for_year(self, trips_year):
+        """
+        Return the matrix for trips_year, or None if it was never computed.
+        """
+        return self.filter(trips_year=trips_year).first()
+
+    def compute(self, trips_year):
+        """
+        Compute the matrix for all stops in trips_year.
+        """
+        from fyt.transport.maps import get_distance_matrix
+        from fyt.transport.models import Stop
+
+        stops = Stop.objects.filter(trips_year=trips_year).order_by('pk')
+        locations, durations, distances = get_distance_matrix(
+            [stop for stop in stops if stop.location]
+        )
+        matrix, _ = self.update_or_create(
+            trips_year=trips_year,
+            defaults={
+                'locations': locations,
+                'durations': durations,
+                'distances': distances,
+                'created_at': timezone.now(),
+            },
+        )
+        return matrix
+
+
+class RouteProposalManager(models.Manager):
+    def propose(self, trips_year):
+        """
+        Optimize the routes of trips_year, replacing any previous proposals.
+
+        Returns the optimizer, which has the cost of the schedule before and
+        after optimization.
+        """
+        from fyt.transport.optimizer import Optimizer
+
+        optimizer = Optimizer(trips_year)
+        optimizer.solve()
+
+        with transaction.atomic():
+            self.filter(trips_year=trips_year).delete()
+            self.bulk_create(
+                self.model(
+                    trips_year=trips_year,
+                    trip=ride.trip,
+                    stop_type=ride.stop_type,
+                    route=ride.route,
+                )
+                for ride in optimizer.rides
+            )
+
+        return optimizer
+
+    def diff(self, trips_year):
+        """
+        Compare the proposals for trips_year to the current schedule.
+
+        Trips which do not have a proposal, because they were created after
+        the optimizer was run, keep their current routes.
+
+        Only buses which the proposals move all trips off of are removed.
+        Buses which did not carry any trips, eg. because they were scheduled
+        by hand, are left alone, and buses with notes or custom times are
+        kept so that they can be reviewed.
+        """
+        from fyt.transport.models import InternalBus, StopOrder
+        from fyt.transport.optimizer import ScheduleDiff
+        from fyt.trips.models import Trip
+
+        proposals = {
+            (proposal.trip_id, proposal.stop_type): proposal
+            for proposal in self.filter(trips_year=trips_year).select_related('route')
+        }
+        trips = Trip.objects.filter(trips_year=trips_year).select_related(
+            'section',
+            'dropoff_route',
+            'pickup_route',
+            'return_route',
+            'template__dropoff_stop__route',
+            'template__pickup_stop__route',
+            'template__return_route',
+        )
+
+        changes = []
+        needed = set()
+        current = set()
+        for trip in trips:
+            rides = [
+                (self.model.DROPOFF, trip.get_dropoff_route(), trip.dropoff_date),
+                (self.model.PICKUP, trip.get_pickup_route(), trip.pickup_date),
+            ]
+            for stop_type, route, date in rides:
+                current.add((route, date))
+                proposal = proposals.get((trip.pk, stop_type))
+                if proposal is not None and proposal.route != route:
+                    proposal.trip = trip
+                    changes.append(proposal)
+                    route = proposal.route
+                needed.add((route, date))
+            current.add((trip.get_return_route(), trip.return_date))
+            needed.add((trip.get_return_route(), trip.return_date))
+
+        buses = {
+            (bus.route, bus.date): bus
+            for bus in InternalBus.objects.internal(trips_year).select_related('route')
+        }
+        new_buses = sorted(
+            (
+                (route, date)
+                for route, date in needed
+                if route is not None
+                and route.category == INTERNAL
+                and (route, date) not in buses
+            ),
+            key=lambda key: (key[1], key[0].name),
+        )
+        custom_times = set(
+            StopOrder.objects.filter(
+                trips_year=trips_year, custom_time__isnull=False
+            ).values_list('bus', flat=True)
+        )
+
+        unused_buses = []
+        kept_buses = []
+        for key, bus in buses.items():
+            if key in needed or key not in current:
+                continue
+            if bus.notes or bus.use_custom_times or bus.pk in custom_times:
+                kept_buses.append(bus)
+            else:
+                unused_buses.append(bus)
+
+        return ScheduleDiff(changes, new_buses, unused_buses, kept_buses)
+
+    def apply(self, trips_year):
+        """
+        Apply the proposals for trips_year.
+
+        Routes which differ from the default route of the stop are set as
+        overrides on the trips, buses are scheduled for routes which need
+        them, and buses which no longer carry any trips are deleted unless
+        they have notes or custom times. Returns the applied `ScheduleDiff`.
+        """
+        from fyt.transport.models import InternalBus
+        from fyt.transport.signals import resolve_dropoffs, resolve_pickups
+        from fyt.trips.models import Trip
+
+        diff = self.diff(trips_year)
+
+        trips = {}
+        dropoffs = []
+        pickups = []
+        for proposal in diff.changes:
+            trip = trips.setdefault(proposal.trip_id, proposal.trip)
+            if proposal.is_dropoff:
+                default = trip.template.dropoff_stop.route
+                trip.dropoff_route = (
+                    None if proposal.route == default else proposal.route
+                )
+                dropoffs.append(trip.pk)
+            else:
+                default = trip.template.pickup_stop.route
+                trip.pickup_route = (
+                    None if proposal.route == default else proposal.route
+                )
+                pickups.append(trip.pk)
+
+        with transaction.atomic():
+            for route, date in diff.new_buses:
+                InternalBus.objects.create(
+                    trips_year=trips_year, route=route, date=date
+                )
+
+            Trip.objects.bulk_update(trips.values(), ['dropoff_route', 'pickup_route'])
+            resolve_dropoffs(Trip.objects.filter(pk__in=dropoffs))
+            resolve_pickups(Trip.objects.filter(pk__in=pickups))
+
+            InternalBus.objects.filter(
+                pk__in=[bus.pk for bus in diff.unused_buses]
+            ).delete()
+
+        return diff
+
+
+class StoredPacketManager(models.Manager):
+    def fingerprint(self, *querysets, version=''):
+        """
+        Hash the rows of several `values_list` querysets, which should
+        contain all the fields that the content of a packet depends on.
+        `version` identifies anything else the packet depends on, such as
+        the deployed static files.
+        """
+        digest = hashlib.sha256(version.encode())
+        for qs in querysets:
+            for row in qs.order_by('pk'):
+                digest.update(repr(row).encode())
+        return digest.hexdigest()
+
+    def fresh(self, trips_year, name, fingerprint):
+        """
+        Return the stored packet called name, if it is up to date with
+        fingerprint.
+        """
+        return (
+            self.filter(trips_year=trips_year, name=name, fingerprint=fingerprint)
+            .order_by('-created_at')
+            .first()
+        )
+
+    def store(self, trips_year, name, fingerprint, content):
+        """
+        Store the rendered html of a packet, replacing previous versions.
+        """
+        packet = self.model(trips_year=trips_year, name=name, fingerprint=fingerprint)
+        packet.html.save(f'{slugify(name)}.html', ContentFile(content))
+
+        previous = self.filter(
+            trips_year=trips_year, name=name, created_at__lte=packet.created_at
+        ).exclude(pk=packet.pk)
+
+        for old in previous:
+            old.html.delete(save=False)
+            old.delete()
+
+        return packet
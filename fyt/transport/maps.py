@@ -1,8 +1,16 @@
+import math
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 import googlemaps
 from django.conf import settings
-from googlemaps.exceptions import ApiError, TransportError
+from django.core.exceptions import ImproperlyConfigured
+from googlemaps.exceptions import ApiError, Timeout, TransportError
+
+from fyt.utils.lat_lng import parse_lat_lng
 
 
 """
@@ -10,16 +18,182 @@ Interface with the Google Maps Directions API
 
 See https://developers.google.com/maps/documentation/directions/intro
 for more information about the format of the response object.
+
+Directions can also be estimated offline, for development or when the API
+is unavailable. See DIRECTIONS_BACKEND in the settings.
+
+The addresses of stops are geocoded to coordinates with the backend named
+by GEOCODING_BACKEND.
+
+All requests to Google Maps share one client, are rate limited, and are
+counted in MapsUsage. See the MAPS_* settings.
 """
 
 TIMEOUT = 10
 MAX_WAYPOINTS = 23  # imposed by Google Maps
+MAX_WORKERS = 8  # concurrent requests to the directions backend
+MATRIX_BLOCK = 10  # Distance Matrix requests are limited to 100 elements
+EARTH_RADIUS = 6371000  # meters
+METERS_PER_MILE = 1609.344
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10]  # seconds
 
 
 class MapError(Exception):
     pass
 
 
+class TokenBucket:
+    """
+    Limit requests to `rate` per second, in bursts of up to `capacity`.
+
+    The bucket refills with `rate` tokens per second. Each request takes a
+    token, waiting for one if the bucket is empty. Waiting requests reserve
+    their token so that they are served in order.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token. Returns the number of seconds spent waiting.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            wait = max(0, -self.tokens / self.rate)
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Metrics:
+    """
+    Count requests, failures, latency and cache hits for each Maps API.
+
+    Requests are made from several threads, so counts are collected in
+    memory and periodically written to MapsUsage by `flush`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.pending = {}
+            self.flushed_at = time.monotonic()
+
+    def _counts(self, api):
+        if api not in self.pending:
+            self.pending[api] = {
+                'requests': 0,
+                'failures': 0,
+                'cache_hits': 0,
+                'cache_misses': 0,
+                'latency': 0.0,
+                'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+        return self.pending[api]
+
+    def record_request(self, api, latency, failed=False):
+        with self.lock:
+            counts = self._counts(api)
+            counts['requests'] += 1
+            counts['failures'] += failed
+            counts['latency'] += latency
+            counts['histogram'][bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def record_cache(self, api, hits, misses):
+        with self.lock:
+            counts = self._counts(api)
+            counts['cache_hits'] += hits
+            counts['cache_misses'] += misses
+
+    def flush(self, force=False):
+        """
+        Write the collected counts to the database.
+
+        Counts are written right away if requests were made, since those
+        already took much longer than the write. Cache hits are only
+        written once MAPS_METRICS_INTERVAL has passed since the last flush.
+        """
+        from fyt.transport.models import MapsUsage
+
+        with self.lock:
+            now = time.monotonic()
+            requested = any(x['requests'] for x in self.pending.values())
+            elapsed = now - self.flushed_at
+            if not (force or requested or elapsed >= settings.MAPS_METRICS_INTERVAL):
+                return
+            pending, self.pending = self.pending, {}
+            self.flushed_at = now
+
+        for api, counts in pending.items():
+            MapsUsage.objects.record(api, counts)
+
+
+metrics = Metrics()
+
+
+class Client:
+    """
+    A googlemaps.Client shared by all requests, so that connections are
+    reused. Requests are rate limited and recorded in `metrics`.
+
+    Requests which fail with a server error or because the rate limit was
+    exceeded are retried by googlemaps for up to MAPS_RETRY_TIMEOUT seconds.
+    """
+
+    def __init__(self):
+        self.client = googlemaps.Client(
+            key=settings.GOOGLE_MAPS_KEY,
+            timeout=TIMEOUT,
+            retry_timeout=settings.MAPS_RETRY_TIMEOUT,
+        )
+        self.limiter = TokenBucket(settings.MAPS_RATE_LIMIT, settings.MAPS_BURST)
+
+    def request(self, api, **kwargs):
+        """
+        Call the googlemaps method named api, eg. 'directions'.
+        """
+        self.limiter.acquire()
+        start = time.monotonic()
+        failed = True
+        try:
+            response = getattr(self.client, api)(**kwargs)
+            failed = False
+            return response
+        except (TransportError, ApiError, Timeout) as exc:
+            raise MapError(exc)
+        finally:
+            metrics.record_request(api, time.monotonic() - start, failed=failed)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the shared Client, creating it on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client()
+        return _client
+
+
 def _split_stops(stops):
     """
     Given an ordered route of stops, return a tuple
@@ -30,45 +204,377 @@ def _split_stops(stops):
     return (addrs[0], addrs[1:-1], addrs[-1])
 
 
-def get_directions(stops):
+def get_directions(stops, matrix=None):
     """
     Do a Google maps directions lookup.
 
     Returns a maps json response, with a start_stop
     and end_stop Stop objects added to each leg.
 
+    Legs are cached in the database, keyed by the locations of their start
+    and end stops. Only legs which are not cached are requested from Google,
+    so re-ordering a few stops on a route only looks up the changed legs.
+
+    If a DistanceMatrix is passed, legs which are not cached are taken from
+    the matrix before requesting them. These legs have durations and
+    distances but no turn-by-turn steps.
+
     TODO: just return the 'legs' value
     """
+    from fyt.transport.models import CachedLeg
+
     if len(stops) < 2:
         raise MapError('Only one stop provided')
 
-    orig, waypoints, dest = _split_stops(stops)
+    pairs = _pairs(stops)
+    legs = CachedLeg.objects.lookup(pairs)
+    metrics.record_cache('directions', hits=len(legs), misses=len(pairs) - len(legs))
+
+    if matrix is not None:
+        for pair in pairs:
+            if pair not in legs and matrix.leg(*pair) is not None:
+                legs[pair] = matrix.leg(*pair)
+
+    try:
+        for start, end in _missing_runs(pairs, legs):
+            raw = _request_directions(stops[start : end + 1])
+            fetched = dict(zip(pairs[start:end], raw['legs']))
+            CachedLeg.objects.store(_cacheable(fetched))
+            legs.update(fetched)
+    finally:
+        metrics.flush()
+
+    return Directions({'legs': [legs[pair] for pair in pairs]}, stops)
+
+
+def prefetch_directions(routes):
+    """
+    Cache the legs of several routes at once.
+
+    Legs which are not already cached are requested from Google Maps
+    concurrently, using a bounded pool of threads, so the time this takes
+    depends on the slowest request instead of the sum of all of them.
+
+    Errors are ignored here; they are raised again when directions for the
+    route are requested with `get_directions`.
+    """
+    from fyt.transport.models import CachedLeg
+
+    routes = [stops for stops in routes if len(stops) >= 2]
+    pairs = set(pair for stops in routes for pair in _pairs(stops))
+    known = set(CachedLeg.objects.lookup(list(pairs)))
+    metrics.record_cache('directions', hits=len(known), misses=len(pairs) - len(known))
+
+    # Don't request legs shared by several routes more than once
+    requests = []
+    for stops in routes:
+        route_pairs = _pairs(stops)
+        for start, end in _missing_runs(route_pairs, known):
+            requests.append(stops[start : end + 1])
+            known.update(route_pairs[start:end])
+
+    def request(stops):
+        try:
+            return stops, _request_directions(stops)
+        except MapError:
+            return stops, None
+
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for stops, raw in pool.map(request, requests):
+            if raw is not None:
+                fetched.update(zip(_pairs(stops), raw['legs']))
+
+    CachedLeg.objects.store(_cacheable(fetched))
+    metrics.flush()
+
+
+def get_distance_matrix(stops):
+    """
+    Compute travel times and distances between every pair of stops.
+
+    The matrix is requested from the configured backend in blocks of
+    MATRIX_BLOCK origins and destinations, concurrently.
+
+    Returns a tuple (locations, durations, distances). Durations, in
+    seconds, and distances, in meters, are lists with a row for each
+    origin location. Entries are None if there is no route.
+    """
+    by_location = {}
+    for stop in stops:
+        by_location.setdefault(stop.location, stop)
+
+    locations = list(by_location)
+    stops = list(by_location.values())
+    size = len(stops)
+
+    durations = [[None] * size for _ in range(size)]
+    distances = [[None] * size for _ in range(size)]
+
+    blocks = [
+        (i, j)
+        for i in range(0, size, MATRIX_BLOCK)
+        for j in range(0, size, MATRIX_BLOCK)
+    ]
+
+    def request(block):
+        i, j = block
+        origins = stops[i : i + MATRIX_BLOCK]
+        destinations = stops[j : j + MATRIX_BLOCK]
+        return block, get_backend().distance_matrix(origins, destinations)
+
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            for (i, j), rows in pool.map(request, blocks):
+                for di, row in enumerate(rows):
+                    for dj, leg in enumerate(row):
+                        if leg is not None:
+                            durations[i + di][j + dj] = leg['duration']['value']
+                            distances[i + di][j + dj] = leg['distance']['value']
+    finally:
+        metrics.flush()
+
+    return locations, durations, distances
+
+
+def geocode(addresses):
+    """
+    Look up the coordinates of several addresses.
+
+    Cached coordinates are used when possible. Remaining addresses are
+    geocoded concurrently by the configured backend, and cached.
+
+    Returns a dict mapping each address to "lat,lng" coordinates.
+    Addresses which cannot be geocoded are omitted.
+    """
+    from fyt.transport.models import CachedGeocode
+
+    addresses = set(addresses)
+    coordinates = CachedGeocode.objects.lookup(addresses)
+    missing = [address for address in addresses if address not in coordinates]
+    metrics.record_cache('geocode', hits=len(coordinates), misses=len(missing))
+
+    backend = get_backend('GEOCODING_BACKEND')
+
+    def request(address):
+        try:
+            return address, backend.geocode(address)
+        except MapError:
+            return address, None
+
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for address, lat_lng in pool.map(request, missing):
+            if lat_lng is not None:
+                fetched[address] = lat_lng
+
+    CachedGeocode.objects.store(fetched)
+    coordinates.update(fetched)
+    metrics.flush()
+
+    return coordinates
+
+
+def _cacheable(legs):
+    """
+    Filter out estimated legs, which should not be cached.
+    """
+    return {pair: raw for pair, raw in legs.items() if not raw.get('estimated')}
+
+
+def _pairs(stops):
+    """
+    The (origin, destination) location pairs of each leg of the route.
+    """
+    locations = [x.location for x in stops]
+    return list(zip(locations[:-1], locations[1:]))
+
 
-    # TODO: now that MAX_WAYPOINTS is 23, can we remove this?
-    # Is there ever a route with 23 stops?
-    if len(waypoints) > MAX_WAYPOINTS:
-        d1 = get_directions(stops[:MAX_WAYPOINTS])
-        d2 = get_directions(stops[MAX_WAYPOINTS - 1 :])
+def _missing_runs(pairs, legs):
+    """
+    Find runs of consecutive legs which are not in legs.
 
-        # Sanity check
-        if d1.legs[-1].end_stop != d2.legs[0].start_stop:
-            raise MapError('mismatched end and start stops on recursion')
+    Yields (start, end) tuples such that stops[start:end + 1] is the
+    sub-route covering each run of missing legs.
+    """
+    start = None
+    for i, pair in enumerate(pairs):
+        if pair not in legs and start is None:
+            start = i
+        elif pair in legs and start is not None:
+            yield (start, i)
+            start = None
 
-        return Directions({'legs': d1.legs + d2.legs}, stops)
+    if start is not None:
+        yield (start, len(pairs))
+
+
+def _request_directions(stops):
+    """
+    Request directions for the route from the configured backend.
+
+    If the backend fails and DIRECTIONS_FALLBACK is set, the legs are
+    estimated offline instead.
+
+    Returns the raw json of the route.
+    """
+    try:
+        return get_backend().directions(stops)
+    except MapError:
+        if not settings.DIRECTIONS_FALLBACK:
+            raise
+        return OfflineBackend().directions(stops)
 
-    client = googlemaps.Client(key=settings.GOOGLE_MAPS_KEY, timeout=TIMEOUT)
 
+def get_backend(setting='DIRECTIONS_BACKEND'):
+    """
+    Return an instance of the backend named by the setting,
+    DIRECTIONS_BACKEND or GEOCODING_BACKEND.
+    """
+    name = getattr(settings, setting)
     try:
-        resp = client.directions(origin=orig, destination=dest, waypoints=waypoints)
-    except (TransportError, ApiError) as exc:
-        raise MapError(exc)
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ImproperlyConfigured('Unknown %s %r' % (setting, name))
+    return backend()
+
+
+class GoogleBackend:
+    """
+    Request directions from the Google Maps Directions API.
+    """
+
+    def directions(self, stops):
+        orig, waypoints, dest = _split_stops(stops)
+
+        # TODO: now that MAX_WAYPOINTS is 23, can we remove this?
+        # Is there ever a route with 23 stops?
+        if len(waypoints) > MAX_WAYPOINTS:
+            d1 = Directions(
+                self.directions(stops[:MAX_WAYPOINTS]), stops[:MAX_WAYPOINTS]
+            )
+            d2 = Directions(
+                self.directions(stops[MAX_WAYPOINTS - 1 :]), stops[MAX_WAYPOINTS - 1 :]
+            )
+
+            # Sanity check
+            if d1.legs[-1].end_stop != d2.legs[0].start_stop:
+                raise MapError('mismatched end and start stops on recursion')
+
+            return {'legs': [leg.raw for leg in d1.legs + d2.legs]}
+
+        resp = get_client().request(
+            'directions', origin=orig, destination=dest, waypoints=waypoints
+        )
+
+        if len(resp) != 1:
+            raise MapError('Expecting one route')
+        if resp[0]['waypoint_order'] != list(range(len(waypoints))):
+            raise MapError('Waypoints out of order')
+
+        return resp[0]
+
+    def distance_matrix(self, origins, destinations):
+        resp = get_client().request(
+            'distance_matrix',
+            origins=[x.location for x in origins],
+            destinations=[x.location for x in destinations],
+        )
+
+        def leg(element):
+            if element['status'] != 'OK':
+                return None
+            return {
+                'duration': element['duration'],
+                'distance': element['distance'],
+                'steps': [],
+            }
 
-    if len(resp) != 1:
-        raise MapError('Expecting one route')
-    if resp[0]['waypoint_order'] != list(range(len(waypoints))):
-        raise MapError('Waypoints out of order')
+        return [[leg(x) for x in row['elements']] for row in resp['rows']]
 
-    return Directions(resp[0], stops)
+    def geocode(self, address):
+        resp = get_client().request('geocode', address=address)
+
+        if not resp:
+            raise MapError('No results for %r' % address)
+
+        location = resp[0]['geometry']['location']
+        return '%.7f,%.7f' % (location['lat'], location['lng'])
+
+
+class OfflineBackend:
+    """
+    Estimate directions without making any requests.
+
+    The length of each leg is the great-circle distance between the
+    coordinates of its stops, multiplied by `road_factor` to account for
+    roads not being straight. Durations assume an `average_speed`, in
+    miles per hour.
+
+    Estimated legs have no turn-by-turn steps, and are never cached.
+
+    Addresses are geocoded from the OFFLINE_GEOCODES setting, a dict
+    mapping addresses to "lat,lng" coordinates.
+    """
+
+    def __init__(self, road_factor=None, average_speed=None):
+        self.road_factor = road_factor or settings.OFFLINE_ROAD_FACTOR
+        self.average_speed = average_speed or settings.OFFLINE_AVERAGE_SPEED
+
+    def directions(self, stops):
+        return {'legs': [self.leg(a, b) for a, b in zip(stops[:-1], stops[1:])]}
+
+    def distance_matrix(self, origins, destinations):
+        def leg(start_stop, end_stop):
+            try:
+                return self.leg(start_stop, end_stop)
+            except MapError:
+                return None
+
+        return [[leg(a, b) for b in destinations] for a in origins]
+
+    def geocode(self, address):
+        lat_lng = settings.OFFLINE_GEOCODES.get(address) or parse_lat_lng(address)
+        if not lat_lng:
+            raise MapError('Unknown address %r' % address)
+        return lat_lng
+
+    def leg(self, start_stop, end_stop):
+        distance = self.road_factor * great_circle_distance(
+            _coordinates(start_stop), _coordinates(end_stop)
+        )
+        duration = distance / (self.average_speed * METERS_PER_MILE / 3600)
+        return {
+            'distance': {'value': round(distance)},
+            'duration': {'value': round(duration)},
+            'steps': [],
+            'estimated': True,
+        }
+
+
+BACKENDS = {'google': GoogleBackend, 'offline': OfflineBackend}
+
+
+def _coordinates(stop):
+    """
+    The (lat, lng) coordinates of the stop, as floats.
+    """
+    if not stop.lat_lng:
+        raise MapError('%s has no coordinates' % stop)
+    lat, lng = stop.lat_lng.split(',')
+    return float(lat), float(lng)
+
+
+def great_circle_distance(start, end):
+    """
+    The distance, in meters, between two (lat, lng) coordinates.
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, start + end)
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
 
 
 class Directions:
@@ -109,6 +615,20 @@ class Leg:
     def duration(self):
         return timedelta(seconds=self.raw['duration']['value'])
 
+    @property
+    def distance(self):
+        """
+        The length of the leg, in meters.
+        """
+        return self.raw['distance']['value']
+
     @property
     def steps(self):
         return self.raw['steps']
+
+    @property
+    def estimated(self):
+        """
+        Was the leg estimated by the offline backend?
+        """
+        return self.raw.get('estimated', False)
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.13 on 2026-10-18 18:19
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0021_auto_20180819_1241'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedDirections',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(editable=False, max_length=40, unique=True)),
+                ('locations', models.TextField(editable=False)),
+                ('raw', models.JSONField(editable=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+            ],
+        ),
+    ]
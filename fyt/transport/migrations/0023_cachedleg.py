@@ -0,0 +1,30 @@
+# Generated by Django 3.1.13 on 2026-10-18 18:21
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0022_cacheddirections'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedLeg',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('origin', models.CharField(editable=False, max_length=255)),
+                ('destination', models.CharField(editable=False, max_length=255)),
+                ('raw', models.JSONField(editable=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+            ],
+            options={
+                'unique_together': {('origin', 'destination')},
+            },
+        ),
+        migrations.DeleteModel(
+            name='CachedDirections',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.13 on 2026-10-18 18:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0023_cachedleg'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='internalbus',
+            name='times_updated_at',
+            field=models.DateTimeField(default=None, editable=False, null=True, verbose_name='When were directions and times last computed?'),
+        ),
+    ]
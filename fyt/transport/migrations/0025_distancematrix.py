@@ -0,0 +1,30 @@
+# Generated by Django 3.1.13 on 2026-10-18 18:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20180719_1052'),
+        ('transport', '0024_internalbus_times_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistanceMatrix',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('locations', models.JSONField(editable=False)),
+                ('durations', models.JSONField(editable=False)),
+                ('distances', models.JSONField(editable=False)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('trips_year', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, to='core.tripsyear')),
+            ],
+            options={
+                'unique_together': {('trips_year',)},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.13 on 2026-10-18 19:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20180719_1052'),
+        ('trips', '0024_auto_20180822_0834'),
+        ('transport', '0025_distancematrix'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteProposal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stop_type', models.CharField(choices=[('PICKUP', 'PICKUP'), ('DROPOFF', 'DROPOFF')], max_length=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('route', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='transport.route')),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='trips.trip')),
+                ('trips_year', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, to='core.tripsyear')),
+            ],
+            options={
+                'unique_together': {('trips_year', 'trip', 'stop_type')},
+            },
+        ),
+    ]
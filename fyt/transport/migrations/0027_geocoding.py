@@ -0,0 +1,28 @@
+# Generated by Django 3.1.13 on 2026-10-18 19:28
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0026_routeproposal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedGeocode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.CharField(editable=False, max_length=255, unique=True)),
+                ('lat_lng', models.CharField(editable=False, max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='stop',
+            name='geocoded_address',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.1.13 on 2026-10-18 19:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20180719_1052'),
+        ('transport', '0027_geocoding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredPacket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, editable=False, max_length=255)),
+                ('fingerprint', models.CharField(editable=False, max_length=64)),
+                ('html', models.FileField(editable=False, upload_to='packets/')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('trips_year', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, to='core.tripsyear')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
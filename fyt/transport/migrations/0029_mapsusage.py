@@ -0,0 +1,31 @@
+# Generated by Django 3.1.13 on 2026-10-18 19:41
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transport', '0028_storedpacket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapsUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(default=django.utils.timezone.localdate, editable=False)),
+                ('api', models.CharField(choices=[('directions', 'Directions'), ('distance_matrix', 'Distance Matrix'), ('geocode', 'Geocoding')], editable=False, max_length=20)),
+                ('requests', models.PositiveIntegerField(default=0, editable=False)),
+                ('failures', models.PositiveIntegerField(default=0, editable=False)),
+                ('cache_hits', models.PositiveIntegerField(default=0, editable=False)),
+                ('cache_misses', models.PositiveIntegerField(default=0, editable=False)),
+                ('latency', models.FloatField(default=0, editable=False, help_text='total seconds spent on requests')),
+                ('histogram', models.JSONField(default=list, editable=False)),
+            ],
+            options={
+                'unique_together': {('date', 'api')},
+            },
+        ),
+    ]
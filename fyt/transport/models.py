@@ -1,11 +1,15 @@
+import time
+import weakref
 from collections import defaultdict
 from copy import copy
 from datetime import datetime, timedelta
 from itertools import groupby, takewhile
 
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+from django.db.models import Q
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.functional import cached_property
 from model_utils import FieldTracker
 
@@ -13,14 +17,21 @@ from fyt.core.models import DatabaseModel
 from fyt.incoming.models import IncomingStudent
 from fyt.transport.category import EXTERNAL, INTERNAL
 from fyt.transport.managers import (
+    CachedGeocodeManager,
+    CachedLegManager,
+    DistanceMatrixManager,
     ExternalBusManager,
     ExternalPassengerManager,
     InternalBusManager,
+    MapsUsageManager,
     RouteManager,
+    RouteProposalManager,
     StopManager,
     StopOrderManager,
+    StoredPacketManager,
 )
-from fyt.transport.maps import get_directions
+from fyt.transport.maps import LATENCY_BUCKETS, MapError, geocode, get_directions
+from fyt.transport.optimizer import TravelTimes, order_stops
 from fyt.trips.models import Trip
 from fyt.utils.lat_lng import validate_lat_lng
 
@@ -60,18 +71,89 @@ class TransportConfig(DatabaseModel):
     )
 
 
+class TransportConfigCache:
+    """
+    Cache of the Hanover and Lodge stops of each trips year.
+
+    The stops are needed by every bus, so they are cached for the life of
+    the process instead of being queried on each use. Entries are cleared by
+    signals when a TransportConfig or one of its stops is saved. Other
+    processes pick up the change when their entries expire after `TIMEOUT`
+    seconds.
+
+    New instances are returned on each call since buses attach passengers to
+    the stops.
+    """
+
+    TIMEOUT = 60
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, trips_year):
+        """
+        Return the (hanover, lodge) stops of trips_year.
+        """
+        key = getattr(trips_year, 'pk', trips_year)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            config = TransportConfig.objects.select_related('hanover', 'lodge').get(
+                trips_year=key
+            )
+            entry = (
+                time.monotonic() + self.TIMEOUT,
+                self._values(config.hanover),
+                self._values(config.lodge),
+            )
+            self.entries[key] = entry
+
+        _, hanover, lodge = entry
+        return self._instance(hanover), self._instance(lodge)
+
+    @staticmethod
+    def _values(stop):
+        return [getattr(stop, field.attname) for field in Stop._meta.concrete_fields]
+
+    @staticmethod
+    def _instance(values):
+        # Build a new instance, rather than a copy, so that field trackers
+        # work when the stop is saved.
+        names = [field.attname for field in Stop._meta.concrete_fields]
+        return Stop.from_db(DEFAULT_DB_ALIAS, names, values)
+
+    def is_cached(self, stop):
+        """
+        Is stop the cached Hanover or Lodge stop of its trips year?
+        """
+        entry = self.entries.get(stop.trips_year_id)
+        pk = Stop._meta.concrete_fields.index(Stop._meta.pk)
+        return entry is not None and stop.pk in (entry[1][pk], entry[2][pk])
+
+    def invalidate(self, trips_year=None):
+        """
+        Clear the entry of trips_year, or of all years if it is None.
+        """
+        if trips_year is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(getattr(trips_year, 'pk', trips_year), None)
+
+
+transport_config_cache = TransportConfigCache()
+
+
 def Hanover(trips_year):
     """
     Return the Hanover Stop for this year.
     """
-    return TransportConfig.objects.get(trips_year=trips_year).hanover
+    return transport_config_cache.get(trips_year)[0]
 
 
 def Lodge(trips_year):
     """
     Return the Lodge Stop for this year.
     """
-    return TransportConfig.objects.get(trips_year=trips_year).lodge
+    return transport_config_cache.get(trips_year)[1]
 
 
 class Stop(DatabaseModel):
@@ -86,7 +168,7 @@ class Stop(DatabaseModel):
         ordering = ['name']
 
     objects = StopManager()
-    tracker = FieldTracker(fields=['route', 'address', 'lat_lng'])
+    tracker = FieldTracker(fields=['route', 'address', 'lat_lng', 'geocoded_address'])
 
     name = models.CharField(max_length=255)
     address = models.CharField(
@@ -108,6 +190,12 @@ class Stop(DatabaseModel):
         help_text="Latitude & longitude coordinates, eg. 43.7030,-72.2895",
     )
 
+    # the address the coordinates were geocoded from, if they were not
+    # entered by hand
+    geocoded_address = models.CharField(
+        max_length=255, blank=True, default='', editable=False
+    )
+
     # verbal directions, descriptions. migrated from legacy.
     directions = models.TextField(blank=True)
 
@@ -188,6 +276,45 @@ class Stop(DatabaseModel):
         """
         return self.lat_lng or self.address
 
+    def save(self, **kwargs):
+        # Coordinates entered by hand are never replaced by geocoding
+        if self.tracker.has_changed('lat_lng') and not self.tracker.has_changed(
+            'geocoded_address'
+        ):
+            self.geocoded_address = ''
+        return super().save(**kwargs)
+
+    def needs_geocoding(self):
+        """
+        Does the stop only have an address, or coordinates which were
+        geocoded from a previous address?
+        """
+        if not self.address:
+            return False
+        if not self.lat_lng:
+            return True
+        stale = self.geocoded_address and self.geocoded_address != self.address
+        return bool(stale) and not self.tracker.has_changed('lat_lng')
+
+    def geocode(self):
+        """
+        Look up the coordinates of the address, if the stop needs geocoding.
+        The stop is not saved.
+
+        Returns True if the coordinates were updated. Raises a MapError if
+        the address cannot be geocoded.
+        """
+        if not self.needs_geocoding():
+            return False
+
+        coordinates = geocode([self.address])
+        if self.address not in coordinates:
+            raise MapError('Could not find coordinates for %r' % self.address)
+
+        self.lat_lng = coordinates[self.address]
+        self.geocoded_address = self.address
+        return True
+
     def __str__(self):
         return self.name
 
@@ -271,6 +398,13 @@ class InternalBus(DatabaseModel):
         'Are pickup and dropoff times for this bus input manually?', default=False
     )
 
+    times_updated_at = models.DateTimeField(
+        'When were directions and times last computed?',
+        null=True,
+        default=None,
+        editable=False,
+    )
+
     class Meta:
         unique_together = ['trips_year', 'route', 'date']
         ordering = ['date']
@@ -310,13 +444,16 @@ class InternalBus(DatabaseModel):
         """
         A cache of Trips with preloaded size attributes.
         """
+        dropoffs = self.dropping_off()
+        pickups = self.picking_up()
+
         return self.TripCache(
-            None,
-            self.dropping_off(),
-            self.picking_up(),
+            list(dropoffs) + list(pickups),
+            dropoffs,
+            pickups,
             self.returning(),
-            Hanover(self.trips_year),
-            Lodge(self.trips_year),
+            Hanover(self.trips_year_id),
+            Lodge(self.trips_year_id),
         )
 
     class TripCache:
@@ -346,7 +483,7 @@ class InternalBus(DatabaseModel):
         def get(self, value):
             if self.trip_dict is None:
                 return value
-            return self.trip_dict[value]
+            return self.trip_dict.get(value, value)
 
     @cached_property
     def all_stops(self):
@@ -456,6 +593,10 @@ class InternalBus(DatabaseModel):
         """
         Go through the bus route and update the times at which trips are
         picked up and dropped off.
+
+        All StopOrders for the bus are loaded in one query, and the computed
+        times are written in a single bulk update inside a transaction so
+        that readers never see a partially updated bus.
         """
         progress = self.get_departure_time()
 
@@ -466,14 +607,22 @@ class InternalBus(DatabaseModel):
             )
         )
 
-        # TODO: wrap this whole update in a transaction?
+        stoporders = {
+            (stoporder.trip_id, stoporder.stop_type): stoporder
+            for stoporder in self.stoporder_set.all()
+        }
+        updated = []
+
+        def set_time(trip, stop_type, time):
+            stoporder = stoporders[(trip.pk, stop_type)]
+            stoporder.computed_time = time
+            updated.append(stoporder)
+
         for leg in legs_to_lodge:
 
             if leg.start_stop != self.trip_cache.hanover:
                 for trip in leg.start_stop.trips_picked_up:
-                    stoporder = trip.get_pickup_stoporder()
-                    stoporder.computed_time = progress.time()
-                    stoporder.save()
+                    set_time(trip, StopOrder.PICKUP, progress.time())
 
                 progress += self.LOADING_TIME
 
@@ -483,7 +632,7 @@ class InternalBus(DatabaseModel):
                 if leg.start_stop != self.trip_cache.hanover:
                     custom_times = set(
                         [
-                            t.get_pickup_stoporder().custom_time
+                            stoporders[(t.pk, StopOrder.PICKUP)].custom_time
                             for t in leg.start_stop.trips_picked_up
                         ]
                     )
@@ -498,43 +647,87 @@ class InternalBus(DatabaseModel):
 
             if leg.end_stop != self.trip_cache.lodge:
                 for trip in leg.end_stop.trips_dropped_off:
-                    stoporder = trip.get_dropoff_stoporder()
-                    stoporder.computed_time = progress.time()
-                    stoporder.save()
+                    set_time(trip, StopOrder.DROPOFF, progress.time())
 
-        self.dirty = False
-        self.save()
+        with transaction.atomic():
+            StopOrder.objects.bulk_update(updated, ['computed_time'])
+            self.dirty = False
+            self.times_updated_at = timezone.now()
+            self.save(update_fields=['dirty', 'times_updated_at'])
 
         return self.directions
 
-    def validate_stop_ordering(self):
+    def stored_directions(self):
         """
-        Sanity check the stop orderings for this bus are correct.
+        Directions annotated with the stop times stored by the last call to
+        `update_stop_times`.
+
+        Nothing is recomputed or saved, so the times are out of date if the
+        bus is `dirty`. Custom times only set the time each stop is left.
         """
+        hanover = self.trip_cache.hanover
+        lodge = self.trip_cache.lodge
 
-        def stoporders_by_type(type):
-            return filter(lambda x: x.stop_type == type, self.stoporder_set.all())
+        times = {}
+        for stoporder in self.stoporder_set.all():
+            if self.use_custom_times:
+                time = stoporder.custom_time
+            else:
+                time = stoporder.computed_time
+            times[(stoporder.trip_id, stoporder.stop_type)] = time
+
+        def stored_time(trips, stop_type):
+            for trip in trips:
+                time = times.get((trip.pk, stop_type))
+                if time is not None:
+                    return time
+            return None
 
-        opts = (
-            (StopOrder.PICKUP, self.picking_up(), lambda x: x.template.pickup_stop),
-            (StopOrder.DROPOFF, self.dropping_off(), lambda x: x.template.dropoff_stop),
-        )
+        def arrival(stop):
+            if stop in (hanover, lodge):
+                return None
+            dropoff = stored_time(stop.trips_dropped_off, StopOrder.DROPOFF)
+            return dropoff or stored_time(stop.trips_picked_up, StopOrder.PICKUP)
+
+        def shift(time, delta):
+            return (datetime.combine(self.date, time) + delta).time()
 
-        for stop_type, trips, stop_getter in opts:
-            ordered_trips = set([x.trip for x in stoporders_by_type(stop_type)])
-            unordered_trips = set(trips) - ordered_trips
-            surplus_trips = ordered_trips - set(trips)
+        directions = self.directions
+        legs_to_lodge = takewhile(lambda leg: leg.start_stop != lodge, directions.legs)
 
-            if unordered_trips:
-                raise ValidationError(
-                    f'Unordered {stop_type} trips for bus {self}: ' f'{unordered_trips}'
-                )
+        for leg in legs_to_lodge:
+            if self.use_custom_times:
+                if leg.start_stop != hanover:
+                    leg.start_time = stored_time(
+                        leg.start_stop.trips_picked_up, StopOrder.PICKUP
+                    )
+                continue
+
+            leg.end_time = arrival(leg.end_stop)
+            if leg.start_stop == hanover:
+                if leg.end_time is not None:
+                    leg.start_time = shift(leg.end_time, -leg.duration)
+            else:
+                start = arrival(leg.start_stop)
+                if start is not None:
+                    leg.start_time = shift(start, self.LOADING_TIME)
+
+            if leg.end_stop == lodge and leg.start_time is not None:
+                leg.end_time = shift(leg.start_time, leg.duration)
+
+        return directions
 
-            if surplus_trips:
-                # a trip has been removed from the route
-                raise ValidationError(
-                    f'Surplus {stop_type} trips for bus {self}: ' f'{surplus_trips}'
-                )
+    def validate_stop_ordering(self):
+        """
+        Sanity check the stop orderings for this bus are correct.
+
+        See `InternalBusManager.stop_ordering_errors`.
+        """
+        errors = InternalBus.objects.stop_ordering_errors(
+            self.trips_year_id, buses=[self]
+        )
+        if errors:
+            raise ValidationError(errors[self])
 
     def get_stop_ordering(self):
         """
@@ -562,6 +755,68 @@ class InternalBus(DatabaseModel):
                 return True
         return False
 
+    def optimize_stop_order(self, times=None):
+        """
+        Reorder the stops of the bus so that it takes as little time as
+        possible to travel from Hanover to the Lodge, without exceeding
+        the capacity of the bus.
+
+        Returns True if the order was changed, in which case the bus is
+        marked dirty.
+        """
+        stoporders = list(self.stoporder_set.all())
+        if not stoporders:
+            return False
+
+        if times is None:
+            times = TravelTimes(self.distance_matrix)
+
+        sizes = dict(
+            Trip.objects.with_counts(self.trips_year_id)
+            .filter(pk__in=[stoporder.trip_id for stoporder in stoporders])
+            .values_list('pk', 'size')
+        )
+
+        # Stops in their current order, and the change in load at each
+        by_stop = defaultdict(list)
+        for stoporder in stoporders:
+            by_stop[stoporder.stop].append(stoporder)
+        change = {
+            stop: sum(
+                sizes[x.trip_id] if x.is_pickup else -sizes[x.trip_id] for x in orders
+            )
+            for stop, orders in by_stop.items()
+        }
+
+        def feasible(order):
+            load = sum(sizes[x.trip_id] for x in stoporders if x.is_dropoff)
+            for stop in order:
+                load += change[stop]
+                if load > self.route.vehicle.capacity:
+                    return False
+            return True
+
+        end = None
+        if any(x.is_pickup for x in stoporders) or self.returning().exists():
+            end = Lodge(self.trips_year_id)
+
+        current = list(by_stop)
+        order = order_stops(current, Hanover(self.trips_year_id), end, times, feasible)
+        if order == current:
+            return False
+
+        changed = []
+        for i, stop in enumerate(order, 1):
+            for stoporder in by_stop[stop]:
+                stoporder.order = i
+                changed.append(stoporder)
+
+        StopOrder.objects.bulk_update(changed, ['order'])
+        InternalBus.objects.filter(pk=self.pk).update(dirty=True)
+        self.dirty = True
+        BusIndex.invalidate()
+        return True
+
     @cached_property
     def directions(self):
         """
@@ -581,7 +836,11 @@ class InternalBus(DatabaseModel):
             else:
                 stop.over_capacity = False
             stop.passenger_count = load
-        return get_directions(self.all_stops)
+        return get_directions(self.all_stops, matrix=self.distance_matrix)
+
+    @cached_property
+    def distance_matrix(self):
+        return LazyDistanceMatrix(self.trips_year_id)
 
     def detail_url(self):
         kwargs = {
@@ -636,20 +895,27 @@ class StopOrder(DatabaseModel):
         unique_together = ['trips_year', 'bus', 'trip']
         ordering = ['order']
 
-    # TODO: handle time calculations more efficiently
     @property
     def time(self):
         """
-        Re-compute pickup and dropoff times for this bus.
+        The pickup or dropoff time for this stop.
+
+        Times for dirty buses are recomputed in the background by the
+        `update_bus_times` command, so this returns the last computed time
+        without waiting on Google Maps. Check `is_stale` to see whether
+        the time is out of date.
         """
         if self.bus.use_custom_times:
             return self.custom_time
-
-        if self.bus.dirty:
-            self.bus.update_stop_times()
-            self.refresh_from_db()
         return self.computed_time
 
+    @property
+    def is_stale(self):
+        """
+        Is the computed time waiting to be recomputed?
+        """
+        return self.bus.dirty and not self.bus.use_custom_times
+
     @property
     def stop(self):
         if self.is_dropoff:
@@ -678,6 +944,292 @@ class StopOrder(DatabaseModel):
         return f'{self.stop_type}: {self.trip} {self.bus.date}'
 
 
+class BusIndex:
+    """
+    Index of the internal buses and StopOrders of a trips year.
+
+    Buses are keyed by (route pk, date) and StopOrders by (trip pk, stop
+    type). Each is loaded at most once, on first use, so looking up the
+    buses and times of many trips costs two queries in total. Indexes are
+    attached to trips with `preload` and only live as long as those trips.
+    All live indexes are reset when buses or StopOrders change.
+    """
+
+    _live = weakref.WeakSet()
+
+    def __init__(self, trips_year):
+        self.trips_year = trips_year
+        self.reset()
+        BusIndex._live.add(self)
+
+    @classmethod
+    def preload(cls, trips, trips_year):
+        """
+        Attach a shared index to each of trips.
+        """
+        index = cls(trips_year)
+        for trip in trips:
+            trip.bus_index = index
+        return trips
+
+    @classmethod
+    def invalidate(cls):
+        for index in list(cls._live):
+            index.reset()
+
+    def reset(self):
+        self._buses = None
+        self._stoporders = None
+
+    def get_bus(self, route_pk, date):
+        if self._buses is None:
+            buses = InternalBus.objects.filter(trips_year=self.trips_year)
+            self._buses = {(bus.route_id, bus.date): bus for bus in buses}
+        return self._buses.get((route_pk, date))
+
+    def get_stoporder(self, trip, stop_type):
+        if self._stoporders is None:
+            stoporders = StopOrder.objects.filter(
+                trips_year=self.trips_year
+            ).select_related('bus')
+            self._stoporders = {(x.trip_id, x.stop_type): x for x in stoporders}
+        return self._stoporders.get((trip.pk, stop_type))
+
+
+class CachedLeg(models.Model):
+    """
+    Google Maps directions for a single leg of a route, between the
+    locations of two stops.
+
+    Directions only depend on the locations of the stops, so these are not
+    tied to a trips year. Entries expire after TTL, and are invalidated
+    by signals when the address or coordinates of a Stop change.
+    """
+
+    #: How long cached legs are considered fresh
+    TTL = timedelta(days=7)
+
+    origin = models.CharField(max_length=255, editable=False)
+    destination = models.CharField(max_length=255, editable=False)
+    raw = models.JSONField(editable=False)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = CachedLegManager()
+
+    class Meta:
+        unique_together = ['origin', 'destination']
+
+    def __str__(self):
+        return f'{self.origin} to {self.destination}'
+
+
+class CachedGeocode(models.Model):
+    """
+    The coordinates of an address, as found by the geocoding backend.
+
+    Like CachedLeg, these are not tied to a trips year. Entries expire
+    after TTL.
+    """
+
+    #: How long cached coordinates are considered fresh
+    TTL = timedelta(days=30)
+
+    address = models.CharField(max_length=255, unique=True, editable=False)
+    lat_lng = models.CharField(max_length=255, editable=False)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = CachedGeocodeManager()
+
+    def __str__(self):
+        return f'{self.address} ({self.lat_lng})'
+
+
+class MapsUsage(models.Model):
+    """
+    Daily usage of a Google Maps API.
+
+    Counts are collected by `maps.metrics`. `histogram` counts requests by
+    latency, in the buckets of `maps.LATENCY_BUCKETS`.
+    """
+
+    DIRECTIONS = 'directions'
+    DISTANCE_MATRIX = 'distance_matrix'
+    GEOCODE = 'geocode'
+
+    date = models.DateField(default=timezone.localdate, editable=False)
+    api = models.CharField(
+        max_length=20,
+        choices=(
+            (DIRECTIONS, 'Directions'),
+            (DISTANCE_MATRIX, 'Distance Matrix'),
+            (GEOCODE, 'Geocoding'),
+        ),
+        editable=False,
+    )
+    requests = models.PositiveIntegerField(default=0, editable=False)
+    failures = models.PositiveIntegerField(default=0, editable=False)
+    cache_hits = models.PositiveIntegerField(default=0, editable=False)
+    cache_misses = models.PositiveIntegerField(default=0, editable=False)
+    latency = models.FloatField(
+        default=0, editable=False, help_text='total seconds spent on requests'
+    )
+    histogram = models.JSONField(default=list, editable=False)
+
+    objects = MapsUsageManager()
+
+    class Meta:
+        unique_together = ['date', 'api']
+
+    def __str__(self):
+        return f'{self.get_api_display()} {self.date}'
+
+    @property
+    def mean_latency(self):
+        if self.requests:
+            return self.latency / self.requests
+
+    @property
+    def cache_hit_rate(self):
+        total = self.cache_hits + self.cache_misses
+        if total:
+            return self.cache_hits / total
+
+    @property
+    def p95_latency(self):
+        return self.latency_percentile(95)
+
+    def latency_percentile(self, percentile):
+        """
+        An upper bound on the latency of `percentile` percent of requests,
+        from the histogram. None if the bound is above the largest bucket.
+        """
+        if not self.requests:
+            return None
+
+        target = self.requests * percentile / 100
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.histogram):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+
+class DistanceMatrix(DatabaseModel):
+    """
+    Travel times and distances between every pair of stops in a trips year.
+
+    This is computed by the `update_distance_matrix` command. Buses use the
+    matrix to compute stop times without requesting directions. Entries are
+    keyed by stop location, so legs for stops which have been added or
+    moved since the matrix was computed are still requested as usual.
+    """
+
+    class Meta:
+        unique_together = ['trips_year']
+
+    locations = models.JSONField(editable=False)
+    # Rows are indexed by origin, columns by destination
+    durations = models.JSONField(editable=False)  # seconds
+    distances = models.JSONField(editable=False)  # meters
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = DistanceMatrixManager()
+
+    @cached_property
+    def index(self):
+        return {location: i for i, location in enumerate(self.locations)}
+
+    def leg(self, origin, destination):
+        """
+        Return the raw json of the leg between two locations, or None if
+        the leg is not in the matrix.
+        """
+        try:
+            i, j = self.index[origin], self.index[destination]
+        except KeyError:
+            return None
+
+        if self.durations[i][j] is None:
+            return None
+
+        return {
+            'duration': {'value': self.durations[i][j]},
+            'distance': {'value': self.distances[i][j]},
+            'steps': [],
+        }
+
+    def __str__(self):
+        return f'Distance matrix for {self.trips_year}'
+
+
+class LazyDistanceMatrix:
+    """
+    The DistanceMatrix of a trips year, loaded the first time a leg is
+    looked up.
+
+    Most legs are usually cached as CachedLegs, in which case the matrix is
+    never decoded. Share one instance between buses so that the matrix is
+    loaded at most once.
+    """
+
+    def __init__(self, trips_year):
+        self.trips_year = trips_year
+
+    @cached_property
+    def matrix(self):
+        return DistanceMatrix.objects.for_year(self.trips_year)
+
+    def leg(self, origin, destination):
+        if self.matrix is None:
+            return None
+        return self.matrix.leg(origin, destination)
+
+
+class RouteProposal(DatabaseModel):
+    """
+    A route proposed by the optimizer for the dropoff or pickup of a trip.
+
+    Proposals are created by the `optimize_routes` command. They are not
+    used for scheduling until they are applied, which overrides the routes
+    of the trips and schedules the buses that they need.
+    """
+
+    class Meta:
+        unique_together = ['trips_year', 'trip', 'stop_type']
+
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE)
+
+    PICKUP = StopOrder.PICKUP
+    DROPOFF = StopOrder.DROPOFF
+    stop_type = models.CharField(
+        max_length=10, choices=((PICKUP, PICKUP), (DROPOFF, DROPOFF))
+    )
+    route = models.ForeignKey(Route, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = RouteProposalManager()
+
+    @property
+    def is_dropoff(self):
+        return self.stop_type == self.DROPOFF
+
+    @property
+    def current_route(self):
+        if self.is_dropoff:
+            return self.trip.get_dropoff_route()
+        return self.trip.get_pickup_route()
+
+    @property
+    def date(self):
+        if self.is_dropoff:
+            return self.trip.dropoff_date
+        return self.trip.pickup_date
+
+    def __str__(self):
+        return f'{self.trip} {self.stop_type.lower()}: {self.route}'
+
+
 class ExternalBus(DatabaseModel):
     """
     Bus used to transport local-section students to and
@@ -724,13 +1276,22 @@ class ExternalBus(DatabaseModel):
         )
 
     def all_passengers(self):
-        def pks(qs):
-            return [x.pk for x in qs]
-
         return IncomingStudent.objects.filter(
-            pk__in=(pks(self.passengers_to_hanover) + pks(self.passengers_from_hanover))
+            Q(bus_assignment_round_trip__route=self.route)
+            | Q(bus_assignment_to_hanover__route=self.route)
+            | Q(bus_assignment_from_hanover__route=self.route),
+            trips_year=self.trips_year_id,
+            trip_assignment__section=self.section,
         ).order_by('name')
 
+    @cached_property
+    def hanover(self):
+        return Hanover(self.trips_year_id)
+
+    @cached_property
+    def distance_matrix(self):
+        return LazyDistanceMatrix(self.trips_year_id)
+
     DROPOFF_ATTR = 'dropoff'
     PICKUP_ATTR = 'pickup'
 
@@ -743,16 +1304,21 @@ class ExternalBus(DatabaseModel):
         """
         d = defaultdict(list)
         for p in self.passengers_to_hanover:
-            d[p.get_bus_to_hanover()].append(p)
+            d[copy(p.get_bus_to_hanover())].append(p)
         for stop, psngrs in d.items():
             setattr(stop, self.DROPOFF_ATTR, [])
             setattr(stop, self.PICKUP_ATTR, psngrs)
 
-        hanover = Hanover(self.trips_year)
+        hanover = copy(self.hanover)
         setattr(hanover, self.DROPOFF_ATTR, self.passengers_to_hanover)
         setattr(hanover, self.PICKUP_ATTR, [])
 
-        return sort_by_distance(d.keys(), reverse=True) + [hanover]
+        # Order the stops as a path from Hanover, traveled in reverse
+        times = self._travel_times()
+        stops = order_stops(
+            sort_by_distance(d.keys()), hanover, cost=lambda a, b: times(b, a)
+        )
+        return stops[::-1] + [hanover]
 
     def get_stops_from_hanover(self):
         """
@@ -760,16 +1326,22 @@ class ExternalBus(DatabaseModel):
         """
         d = defaultdict(list)
         for p in self.passengers_from_hanover:
-            d[p.get_bus_from_hanover()].append(p)
+            d[copy(p.get_bus_from_hanover())].append(p)
         for stop, psngrs in d.items():
             setattr(stop, self.DROPOFF_ATTR, psngrs)
             setattr(stop, self.PICKUP_ATTR, [])
 
-        hanover = Hanover(self.trips_year)
+        hanover = copy(self.hanover)
         setattr(hanover, self.DROPOFF_ATTR, [])
         setattr(hanover, self.PICKUP_ATTR, self.passengers_from_hanover)
 
-        return [hanover] + sort_by_distance(d.keys())
+        stops = order_stops(
+            sort_by_distance(d.keys()), hanover, cost=self._travel_times()
+        )
+        return [hanover] + stops
+
+    def _travel_times(self):
+        return TravelTimes(self.distance_matrix)
 
     def directions_to_hanover(self):
         directions = self._directions(self.get_stops_to_hanover())
@@ -811,7 +1383,29 @@ class ExternalBus(DatabaseModel):
             if load > self.route.vehicle.capacity:
                 stop.over_capacity = True
             stop.passenger_count = load
-        return get_directions(stops)
+        return get_directions(stops, matrix=self.distance_matrix)
 
     def __str__(self):
         return "Section %s %s" % (self.section.name, self.route)
+
+
+class StoredPacket(DatabaseModel):
+    """
+    A transport packet which was rendered ahead of time.
+
+    Packets are downloaded many times on trip days, so they are stored as
+    html files and served as they are. `fingerprint` is a hash of the
+    buses and passengers in the packet; when it changes the packet is
+    rendered and stored again.
+    """
+
+    #: The path of the packet view
+    name = models.CharField(max_length=255, editable=False, db_index=True)
+    fingerprint = models.CharField(max_length=64, editable=False)
+    html = models.FileField(upload_to='packets/', editable=False)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = StoredPacketManager()
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,488 @@
+"""
+Propose internal bus routes for a trips year.
+
+Directors choose which route drops off and picks up each trip, either by
+the route of the trip's stops or by overriding it on the trip. The
+optimizer searches for route assignments which need as few buses as
+possible, and then as few vehicle-miles as possible, without putting more
+passengers on a bus than its vehicle can hold.
+
+The search is a local search which starts from the current assignments and
+only accepts changes which improve on them, so a proposal stays close to
+the current schedule. Each date is solved independently since a bus only
+runs on one date.
+
+Returning trips ride the bus of their return route and are not moved, but
+they count against the capacity of the bus.
+
+`order_stops` orders the stops of a single bus, replacing the rough ordering
+by distance from Hanover with a near-optimal path over travel times.
+"""
+
+from collections import defaultdict
+from itertools import groupby
+
+from django.conf import settings
+
+from fyt.transport.maps import METERS_PER_MILE, _coordinates, great_circle_distance
+
+
+# Upper bound on the number of improvement passes made for each date
+MAX_PASSES = 20
+
+# Changes in mileage smaller than this are ignored, so that the search
+# does not cycle between equivalent assignments.
+EPSILON = 1e-6
+
+
+class Distances:
+    """
+    Road distances, in miles, between stops.
+
+    Distances come from the `DistanceMatrix` of the trips year when it
+    contains both stops. Otherwise the distance is estimated from the
+    coordinates of the stops, as in the offline directions backend. Stops
+    without coordinates fall back on their rough `distance` from Hanover:
+    stops on the same route are assumed to lie along the same road, and
+    other stops are connected through Hanover.
+    """
+
+    def __init__(self, matrix=None, road_factor=None):
+        self.matrix = matrix
+        self.road_factor = road_factor or settings.OFFLINE_ROAD_FACTOR
+        self.cache = {}
+
+    def __call__(self, origin, destination):
+        if origin.pk == destination.pk:
+            return 0
+
+        key = (origin.pk, destination.pk)
+        if key not in self.cache:
+            self.cache[key] = self._distance(origin, destination)
+        return self.cache[key]
+
+    def _distance(self, origin, destination):
+        if self.matrix is not None:
+            leg = self.matrix.leg(origin.location, destination.location)
+            if leg is not None:
+                return leg['distance']['value'] / METERS_PER_MILE
+
+        if origin.lat_lng and destination.lat_lng:
+            meters = great_circle_distance(
+                _coordinates(origin), _coordinates(destination)
+            )
+            return self.road_factor * meters / METERS_PER_MILE
+
+        if origin.route_id is not None and origin.route_id == destination.route_id:
+            return abs(origin.distance - destination.distance)
+
+        return origin.distance + destination.distance
+
+
+class TravelTimes(Distances):
+    """
+    Travel times, in seconds, between stops.
+
+    Times come from the `DistanceMatrix` when it contains both stops, and
+    are otherwise estimated from `Distances` at the average speed used by
+    the offline directions backend.
+    """
+
+    def __init__(self, matrix=None, road_factor=None, average_speed=None):
+        super().__init__(matrix, road_factor)
+        self.average_speed = average_speed or settings.OFFLINE_AVERAGE_SPEED
+
+    def _distance(self, origin, destination):
+        if self.matrix is not None:
+            leg = self.matrix.leg(origin.location, destination.location)
+            if leg is not None:
+                return leg['duration']['value']
+
+        miles = super()._distance(origin, destination)
+        return 3600 * miles / self.average_speed
+
+
+def order_stops(stops, start, end=None, cost=None, feasible=None):
+    """
+    Order stops so that the path from start, through every stop, to end
+    takes as little time as possible. If end is None the path finishes at
+    the last stop.
+
+    A nearest-neighbour path is improved with 2-opt, which reverses
+    sections of the path for as long as that makes it shorter. The passed
+    order is used instead of the nearest-neighbour path when it is shorter,
+    so the result is never worse than the passed order.
+
+    `cost(origin, destination)` defaults to `TravelTimes`. If `feasible` is
+    given, orders for which `feasible(order)` is False are skipped, unless
+    the passed order is not feasible either.
+    """
+    cost = cost or TravelTimes()
+    stops = list(stops)
+    if len(stops) < 2:
+        return stops
+
+    if feasible is None or not feasible(stops):
+
+        def feasible(order):
+            return True
+
+    def length(order):
+        path = [start] + order + ([end] if end is not None else [])
+        return sum(cost(a, b) for a, b in zip(path, path[1:]))
+
+    best = stops
+    best_length = length(stops)
+
+    candidate = _nearest_neighbour(stops, start, cost)
+    if length(candidate) < best_length - EPSILON and feasible(candidate):
+        best, best_length = candidate, length(candidate)
+
+    improved = True
+    while improved:
+        improved = False
+        for i in range(len(best) - 1):
+            for j in range(i + 2, len(best) + 1):
+                candidate = best[:i] + best[i:j][::-1] + best[j:]
+                candidate_length = length(candidate)
+                if candidate_length < best_length - EPSILON and feasible(candidate):
+                    best, best_length = candidate, candidate_length
+                    improved = True
+
+    return best
+
+
+def _nearest_neighbour(stops, start, cost):
+    """
+    Starting from start, repeatedly visit the closest remaining stop.
+    """
+    remaining = list(stops)
+    path = []
+    current = start
+    while remaining:
+        current = min(remaining, key=lambda stop: cost(current, stop))
+        remaining.remove(current)
+        path.append(current)
+    return path
+
+
+class Ride:
+    """
+    A trip which needs to be dropped off or picked up.
+    """
+
+    def __init__(self, trip, stop_type, stop, date, route):
+        self.trip = trip
+        self.stop_type = stop_type
+        self.stop = stop
+        self.date = date
+        self.route = route
+
+    @property
+    def size(self):
+        return self.trip.size
+
+    @property
+    def is_dropoff(self):
+        from fyt.transport.models import StopOrder
+
+        return self.stop_type == StopOrder.DROPOFF
+
+
+class Cost(tuple):
+    """
+    The cost of a schedule, compared lexicographically: the number of
+    passengers over capacity, the number of buses, and vehicle-miles.
+    """
+
+    def __new__(cls, excess=0, buses=0, miles=0):
+        return super().__new__(cls, (excess, buses, miles))
+
+    def __add__(self, other):
+        return Cost(*(a + b for a, b in zip(self, other)))
+
+    def __sub__(self, other):
+        return Cost(*(a - b for a, b in zip(self, other)))
+
+    def improves(self):
+        """
+        Is this difference in cost an improvement?
+        """
+        return self < Cost(0, 0, -EPSILON)
+
+    @property
+    def excess(self):
+        return self[0]
+
+    @property
+    def buses(self):
+        return self[1]
+
+    @property
+    def miles(self):
+        return self[2]
+
+
+class Optimizer:
+    """
+    Optimize the routes of all dropoffs and pickups in a trips year.
+
+    Usage:
+
+        optimizer = Optimizer(trips_year)
+        optimizer.solve()
+        optimizer.rides  # each ride has its proposed route
+    """
+
+    def __init__(self, trips_year, distances=None):
+        from fyt.transport.models import (
+            DistanceMatrix,
+            Hanover,
+            Lodge,
+            Route,
+            StopOrder,
+        )
+        from fyt.trips.models import Trip
+
+        self.trips_year = trips_year
+        self.hanover = Hanover(trips_year)
+        self.lodge = Lodge(trips_year)
+        self.distances = distances or Distances(
+            DistanceMatrix.objects.for_year(trips_year)
+        )
+
+        self.routes = {
+            route.pk: route
+            for route in Route.objects.internal(trips_year).select_related('vehicle')
+        }
+
+        trips = Trip.objects.with_counts(trips_year).select_related(
+            'template__dropoff_stop', 'template__pickup_stop', 'section'
+        )
+
+        self.rides = []
+        self.returns = defaultdict(list)
+        for trip in trips:
+            dropoff = self.routes.get(
+                trip.dropoff_route_id or trip.template.dropoff_stop.route_id
+            )
+            if dropoff is not None:
+                self.rides.append(
+                    Ride(
+                        trip,
+                        StopOrder.DROPOFF,
+                        trip.template.dropoff_stop,
+                        trip.dropoff_date,
+                        dropoff,
+                    )
+                )
+
+            pickup = self.routes.get(
+                trip.pickup_route_id or trip.template.pickup_stop.route_id
+            )
+            if pickup is not None:
+                self.rides.append(
+                    Ride(
+                        trip,
+                        StopOrder.PICKUP,
+                        trip.template.pickup_stop,
+                        trip.pickup_date,
+                        pickup,
+                    )
+                )
+
+            route = self.routes.get(
+                trip.return_route_id or trip.template.return_route_id
+            )
+            if route is not None:
+                self.returns[route, trip.return_date].append(trip)
+
+        self.initial_cost = self.cost()
+
+    def cost(self):
+        """
+        The cost of the current assignment of rides to routes.
+        """
+        runs = defaultdict(list)
+        for ride in self.rides:
+            runs[ride.route, ride.date].append(ride)
+
+        total = Cost()
+        for route, date in self.schedule():
+            total += self.evaluate(route, date, runs[route, date])
+        return total
+
+    def solve(self):
+        """
+        Assign each ride to a route, and return the cost of the schedule.
+        """
+        for date, rides in self._rides_by_date().items():
+            self._solve_date(date, rides)
+        return self.cost()
+
+    def evaluate(self, route, date, rides):
+        """
+        The cost of a bus on route and date carrying rides.
+
+        The bus follows the same path as `InternalBus.all_stops`: it leaves
+        Hanover with all dropoffs, visits stops in order of their distance,
+        continues to the Lodge if it is picking up or returning trips, and
+        takes returning trips back to Hanover.
+        """
+        returns = self.returns.get((route, date), [])
+        if not rides and not returns:
+            return Cost()
+
+        load = sum(ride.size for ride in rides if ride.is_dropoff)
+        peak = load
+        path = [self.hanover]
+
+        rides = sorted(rides, key=lambda ride: (ride.stop.distance, ride.stop.pk))
+        for _, group in groupby(rides, lambda ride: ride.stop.pk):
+            group = list(group)
+            for ride in group:
+                load += -ride.size if ride.is_dropoff else ride.size
+            peak = max(peak, load)
+            path.append(group[0].stop)
+
+        if returns or any(not ride.is_dropoff for ride in rides):
+            path.append(self.lodge)
+            peak = max(peak, sum(trip.size for trip in returns))
+
+        if returns:
+            path.append(self.hanover)
+
+        miles = sum(self.distances(a, b) for a, b in zip(path, path[1:]))
+        excess = max(0, peak - route.vehicle.capacity)
+        return Cost(excess, 1, miles)
+
+    def schedule(self):
+        """
+        The (route, date) of each bus needed by the current assignment.
+        """
+        keys = set(self.returns) | set((ride.route, ride.date) for ride in self.rides)
+        return sorted(keys, key=lambda key: (key[1], key[0].name, key[0].pk))
+
+    def _rides_by_date(self):
+        rides_by_date = defaultdict(list)
+        for ride in self.rides:
+            rides_by_date[ride.date].append(ride)
+        return rides_by_date
+
+    def _runs(self, rides):
+        runs = {route: [] for route in self.routes.values()}
+        for ride in rides:
+            runs[ride.route].append(ride)
+        return runs
+
+    def _solve_date(self, date, rides):
+        runs = self._runs(rides)
+        costs = {route: self.evaluate(route, date, runs[route]) for route in runs}
+
+        for _ in range(MAX_PASSES):
+            improved = False
+
+            # Try to empty the least used buses first
+            for route in sorted(runs, key=lambda r: sum(x.size for x in runs[r])):
+                if runs[route] and self._close(date, route, runs, costs):
+                    improved = True
+
+            for ride in rides:
+                if self._relocate(date, ride, runs, costs):
+                    improved = True
+
+            if not improved:
+                break
+
+    def _removal(self, date, ride, runs, costs):
+        """
+        The change in cost of taking a ride off of its bus.
+        """
+        remaining = [x for x in runs[ride.route] if x is not ride]
+        return self.evaluate(ride.route, date, remaining) - costs[ride.route]
+
+    def _insertion(self, date, ride, route, runs, costs):
+        """
+        The change in cost of adding a ride to the bus of route.
+        """
+        return self.evaluate(route, date, runs[route] + [ride]) - costs[route]
+
+    def _move(self, date, ride, route, runs, costs):
+        """
+        Move a ride to another route, and return the change in cost.
+        """
+        old = ride.route
+        runs[old] = [x for x in runs[old] if x is not ride]
+        runs[route] = runs[route] + [ride]
+        old_cost = self.evaluate(old, date, runs[old])
+        new_cost = self.evaluate(route, date, runs[route])
+        delta = (old_cost - costs[old]) + (new_cost - costs[route])
+        costs[old], costs[route] = old_cost, new_cost
+        ride.route = route
+        return delta
+
+    def _relocate(self, date, ride, runs, costs):
+        """
+        Move a single ride to the route where it most improves the cost.
+        """
+        removal = self._removal(date, ride, runs, costs)
+        deltas = [
+            (removal + self._insertion(date, ride, route, runs, costs), route)
+            for route in runs
+            if route != ride.route
+        ]
+        improvements = [(delta, route) for delta, route in deltas if delta.improves()]
+        if not improvements:
+            return False
+
+        _, route = min(improvements, key=lambda x: x[0])
+        self._move(date, ride, route, runs, costs)
+        return True
+
+    def _close(self, date, route, runs, costs):
+        """
+        Try to move every ride on a bus to other buses which are already
+        running, so that the bus is no longer needed. The moves are undone
+        if together they do not improve the cost.
+        """
+        targets = [r for r in runs if r != route and costs[r].buses]
+        if not targets:
+            return False
+
+        moved = []
+        total = Cost()
+        for ride in runs[route]:
+            _, target = min(
+                ((self._insertion(date, ride, t, runs, costs), t) for t in targets),
+                key=lambda x: x[0],
+            )
+            moved.append(ride)
+            total += self._move(date, ride, target, runs, costs)
+
+        if total.improves():
+            return True
+
+        for ride in reversed(moved):
+            self._move(date, ride, route, runs, costs)
+        return False
+
+
+class ScheduleDiff:
+    """
+    The differences between the current schedule and the proposed routes.
+
+        changes       RouteProposals which move a trip to a different route
+        new_buses     (route, date) of buses which need to be scheduled
+        unused_buses  InternalBuses which no longer carry any trips
+        kept_buses    InternalBuses which no longer carry any trips, but are
+                      not removed because they have notes or custom times
+    """
+
+    def __init__(self, changes, new_buses, unused_buses, kept_buses=()):
+        self.changes = changes
+        self.new_buses = new_buses
+        self.unused_buses = unused_buses
+        self.kept_buses = kept_buses
+
+    def __bool__(self):
+        return bool(self.changes or self.new_buses or self.unused_buses)
@@ -1,57 +1,106 @@
 from django.db.models import Q
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 from fyt.transport.models import (
-    Hanover,
+    BusIndex,
+    CachedLeg,
     InternalBus,
-    Lodge,
     Stop,
     StopOrder,
     TransportConfig,
+    transport_config_cache,
 )
 from fyt.trips.models import Section, Trip, TripTemplate
 
 
-def create_dropoff(bus, trip):
-    return StopOrder.objects.create(
-        trips_year=bus.trips_year, bus=bus, trip=trip, stop_type=StopOrder.DROPOFF
+def make_stoporder(bus, trip, stop_type):
+    """
+    Build an unsaved StopOrder, for use with `bulk_create`.
+
+    `bulk_create` does not call `StopOrder.save`, so the order is populated
+    from the distance of the stop here.
+    """
+    stoporder = StopOrder(
+        trips_year_id=bus.trips_year_id, bus=bus, trip=trip, stop_type=stop_type
     )
+    stoporder.order = stoporder.stop.distance
+    return stoporder
 
 
-def create_pickup(bus, trip):
-    return StopOrder.objects.create(
-        trips_year=bus.trips_year, bus=bus, trip=trip, stop_type=StopOrder.PICKUP
-    )
+def mark_dirty(buses):
+    """
+    Mark buses dirty in a single query. `buses` is a list of pks.
+    """
+    InternalBus.objects.filter(pk__in=buses).update(dirty=True)
 
 
-def mark_dirty(bus):
-    bus.dirty = True
-    bus.save()
+def resolve_dropoffs(trips):
+    resolve_stoporders(trips, StopOrder.DROPOFF)
 
 
-def resolve_dropoff(trip):
-    # Mark the old bus as `dirty` and delete the old StopOrder
-    ordering = trip.get_dropoff_stoporder()
-    if ordering is not None:
-        mark_dirty(ordering.bus)
-        ordering.delete()
+def resolve_pickups(trips):
+    resolve_stoporders(trips, StopOrder.PICKUP)
 
-    new_bus = trip.get_dropoff_bus()
-    if new_bus:
-        create_dropoff(new_bus, trip)
+
+def resolve_dropoff(trip):
+    resolve_dropoffs(Trip.objects.filter(pk=trip.pk))
 
 
 def resolve_pickup(trip):
-    # Mark the old bus as `dirty` and delete the old StopOrder
-    ordering = trip.get_pickup_stoporder()
-    if ordering is not None:
-        mark_dirty(ordering.bus)
-        ordering.delete()
+    resolve_pickups(Trip.objects.filter(pk=trip.pk))
 
-    new_bus = trip.get_pickup_bus()
-    if new_bus:
-        create_pickup(new_bus, trip)
+
+def resolve_stoporders(trips, stop_type):
+    """
+    Move the StopOrders of a queryset of trips to the buses which are now
+    scheduled to drop off or pick up the trips.
+
+    This is done in bulk: the old StopOrders are deleted and the new ones
+    created in single queries, and both the old and new buses are marked
+    dirty with one update.
+    """
+    if stop_type == StopOrder.DROPOFF:
+        stop_field = 'dropoff_stop'
+
+        def route_and_date(trip):
+            route = trip.dropoff_route_id or trip.template.dropoff_stop.route_id
+            return (route, trip.section.at_campsite1)
+
+    else:
+        stop_field = 'pickup_stop'
+
+        def route_and_date(trip):
+            route = trip.pickup_route_id or trip.template.pickup_stop.route_id
+            return (route, trip.section.arrive_at_lodge)
+
+    trips = list(trips.select_related('section', f'template__{stop_field}'))
+    if not trips:
+        return
+
+    # Mark the old buses as `dirty` and delete the old StopOrders
+    old = StopOrder.objects.filter(trip__in=trips, stop_type=stop_type)
+    dirty = set(old.values_list('bus', flat=True))
+    old.delete()
+
+    keys = set(route_and_date(trip) for trip in trips)
+    buses = {
+        (bus.route_id, bus.date): bus
+        for bus in InternalBus.objects.filter(
+            route__in=[route for route, _ in keys], date__in=[date for _, date in keys]
+        )
+    }
+
+    new = []
+    for trip in trips:
+        bus = buses.get(route_and_date(trip))
+        if bus is not None:
+            new.append(make_stoporder(bus, trip, stop_type))
+            dirty.add(bus.pk)
+
+    StopOrder.objects.bulk_create(new)
+    mark_dirty(dirty)
+    BusIndex.invalidate()
 
 
 @receiver(post_save, sender=InternalBus)
@@ -60,11 +109,27 @@ def create_ordering_for_new_bus(instance, created, **kwargs):
     Generate ordering for a new bus.
     """
     if created:
-        for trip in instance.dropping_off():
-            create_dropoff(instance, trip)
-
-        for trip in instance.picking_up():
-            create_pickup(instance, trip)
+        dropoffs = [
+            make_stoporder(instance, trip, StopOrder.DROPOFF)
+            for trip in instance.dropping_off()
+        ]
+        pickups = [
+            make_stoporder(instance, trip, StopOrder.PICKUP)
+            for trip in instance.picking_up()
+        ]
+        StopOrder.objects.bulk_create(dropoffs + pickups)
+
+
+# StopOrders are deleted in bulk by `resolve_stoporders`, which invalidates
+# indexes itself. A post_delete receiver would prevent fast deletes.
+@receiver(post_save, sender=InternalBus)
+@receiver(post_delete, sender=InternalBus)
+@receiver(post_save, sender=StopOrder)
+def invalidate_bus_indexes(**kwargs):
+    """
+    Indexes of buses and StopOrders are out of date when either changes.
+    """
+    BusIndex.invalidate()
 
 
 @receiver(post_save, sender=Trip)
@@ -100,11 +165,8 @@ def update_ordering_for_stop_changes(instance, created, **kwargs):
             template__pickup_stop=instance, pickup_route=None
         )
 
-        for trip in affected_dropoffs:
-            resolve_dropoff(trip)
-
-        for trip in affected_pickups:
-            resolve_pickup(trip)
+        resolve_dropoffs(affected_dropoffs)
+        resolve_pickups(affected_pickups)
 
 
 @receiver(post_save, sender=Stop)
@@ -120,10 +182,7 @@ def mark_buses_dirty_for_address_changes(instance, created, **kwargs):
         instance.tracker.has_changed('address')
         or instance.tracker.has_changed('lat_lng')
     ):
-        # TODO: can the Lodge/Hanover check be done without a db query?
-        if instance == Hanover(instance.trips_year) or instance == Lodge(
-            instance.trips_year
-        ):
+        if instance in transport_config_cache.get(instance.trips_year_id):
             affected_buses = InternalBus.objects.filter(trips_year=instance.trips_year)
         else:
             affected_buses = InternalBus.objects.filter(
@@ -136,13 +195,27 @@ def mark_buses_dirty_for_address_changes(instance, created, **kwargs):
         affected_buses.update(dirty=True)
 
 
+@receiver(post_save, sender=Stop)
+def invalidate_legs_for_address_changes(instance, created, **kwargs):
+    """
+    Cached legs to or from the old location of a Stop are no longer valid if
+    the address or coordinates of the Stop change.
+    """
+    if not created:
+        for field in ['address', 'lat_lng']:
+            if instance.tracker.has_changed(field):
+                previous = instance.tracker.previous(field)
+                if previous:
+                    CachedLeg.objects.invalidate(previous)
+
+
 @receiver(post_save, sender=StopOrder)
 def mark_buses_dirty_for_order_changes(instance, created, **kwargs):
     """
     Bus directions and times change when the route is re-arranged.
     """
     if not created and instance.tracker.has_changed('order'):
-        mark_dirty(instance.bus)
+        mark_dirty([instance.bus_id])
 
 
 @receiver(post_save, sender=TripTemplate)
@@ -151,12 +224,10 @@ def update_ordering_for_triptemplate_stop_changes(instance, created, **kwargs):
     Orderings are changed when the stops of a TripTemplate change.
     """
     if not created and instance.tracker.has_changed('dropoff_stop'):
-        for trip in Trip.objects.filter(template=instance):
-            resolve_dropoff(trip)
+        resolve_dropoffs(Trip.objects.filter(template=instance))
 
     if not created and instance.tracker.has_changed('pickup_stop'):
-        for trip in Trip.objects.filter(template=instance):
-            resolve_pickup(trip)
+        resolve_pickups(Trip.objects.filter(template=instance))
 
 
 @receiver(post_save, sender=Section)
@@ -165,9 +236,23 @@ def update_ordering_for_section_date_change(instance, created, **kwargs):
     Orderings are changed when the date of a Section changes.
     """
     if not created and instance.tracker.has_changed('leaders_arrive'):
-        for trip in Trip.objects.filter(section=instance):
-            resolve_dropoff(trip)
-            resolve_pickup(trip)
+        resolve_dropoffs(Trip.objects.filter(section=instance))
+        resolve_pickups(Trip.objects.filter(section=instance))
+
+
+@receiver(post_save, sender=TransportConfig)
+@receiver(post_delete, sender=TransportConfig)
+def invalidate_transport_config_cache(instance, **kwargs):
+    transport_config_cache.invalidate(instance.trips_year_id)
+
+
+@receiver(post_save, sender=Stop)
+def invalidate_transport_config_cache_for_stop_changes(instance, **kwargs):
+    """
+    The cached Hanover and Lodge stops are out of date when they are edited.
+    """
+    if transport_config_cache.is_cached(instance):
+        transport_config_cache.invalidate(instance.trips_year_id)
 
 
 @receiver(post_save, sender=TransportConfig)
@@ -1,7 +1,7 @@
 from django.conf import settings
 from django.template import Library, loader
 
-from fyt.transport.maps import MapError, _split_stops
+from fyt.transport.maps import METERS_PER_MILE, MapError, _split_stops
 
 
 register = Library()
@@ -31,11 +31,13 @@ def embed_map(stops):
 def directions(bus):
     """
     Given an internal bus, display directions or MapError.
+
+    Stop times are not recomputed here; the stored times are shown until
+    the `update_bus_times` worker updates the bus.
     """
     try:
         return {
-            # TODO: refactor to use bus.directions()
-            'directions': bus.update_stop_times(),
+            'directions': bus.stored_directions(),
             'stop_template': 'transport/maps/_internal_stop.html',
         }
     except MapError as exc:
@@ -114,3 +116,11 @@ def lat_lng_dms(lat_lng):
     lng = float(lng.strip())
 
     return '{} {}'.format(_fmt_side(lat, ['S', 'N']), _fmt_side(lng, ['W', 'E']))
+
+
+@register.filter
+def meters_to_miles(meters):
+    """
+    Template filter to convert a distance in meters to miles.
+    """
+    return '{:.1f}'.format(meters / METERS_PER_MILE)
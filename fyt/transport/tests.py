@@ -1,40 +1,62 @@
+import io
 import itertools
+import json
+import os
+import tempfile
 import unittest
 from datetime import date, datetime, time, timedelta
 
-from django.core.exceptions import ValidationError
-from django.db import IntegrityError
-from django.db.models import ProtectedError
+import googlemaps
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.models import ProtectedError, QuerySet
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from model_mommy import mommy
 from model_mommy.recipe import Recipe, foreign_key
 
+from fyt.core.models import TripsYear
 from fyt.core.mommy_recipes import trips_year
-from fyt.incoming.models import IncomingStudent
+from fyt.incoming.models import IncomingStudent, Registration
 from fyt.test import FytTestCase, vcr
 from fyt.transport import maps
+from fyt.transport.benchmark import run_benchmarks
 from fyt.transport.models import (
+    BusIndex,
+    CachedGeocode,
+    CachedLeg,
+    DistanceMatrix,
     ExternalBus,
     Hanover,
     InternalBus,
     Lodge,
+    MapsUsage,
     Route,
+    RouteProposal,
     Stop,
     StopOrder,
+    StoredPacket,
     TransportConfig,
     sort_by_distance,
 )
+from fyt.transport.optimizer import Optimizer, order_stops
 from fyt.transport.signals import resolve_dropoff, resolve_pickup
 from fyt.transport.templatetags.maps import lat_lng_dms
 from fyt.transport.views import (
     EXCEEDS_CAPACITY,
     NOT_SCHEDULED,
+    InternalBusSchedule,
     Riders,
     TransportChecklist,
-    get_internal_issues_matrix,
     get_internal_rider_matrix,
     get_internal_route_matrix,
+    packet_urls,
+    preload_external_passengers,
     preload_transported_trips,
+    render_packets,
+    total_size,
     trip_transport_matrix,
 )
 from fyt.trips.models import Section, Trip
@@ -51,6 +73,10 @@ stoporder_recipe = Recipe(
 )
 
 
+def fake_directions(stops):
+    return {'legs': [{'duration': {'value': 60}, 'steps': []} for _ in stops[1:]]}
+
+
 class TransportTestCase(FytTestCase):
     def init_transport_config(self):
         hanover = mommy.make(
@@ -218,6 +244,59 @@ class InternalBusManagerTestCase(TransportTestCase):
         )
         self.assertQsEqual(InternalBus.objects.internal(self.trips_year), [internal])
 
+    def make_bus_with_trips(self):
+        bus = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route__category=Route.INTERNAL,
+            date=date(2015, 1, 4),
+        )
+        dropoff = mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            dropoff_route=bus.route,
+            section__leaders_arrive=date(2015, 1, 2),
+        )
+        pickup = mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            pickup_route=bus.route,
+            section__leaders_arrive=date(2014, 12, 31),
+        )
+        return bus, dropoff, pickup
+
+    def test_stop_ordering_errors(self):
+        bus1, dropoff1, pickup1 = self.make_bus_with_trips()
+        bus2, dropoff2, pickup2 = self.make_bus_with_trips()
+        self.assertEqual(InternalBus.objects.stop_ordering_errors(self.trips_year), {})
+
+        StopOrder.objects.filter(trip=dropoff1).delete()
+        surplus = mommy.make(
+            StopOrder,
+            trips_year=self.trips_year,
+            bus=bus2,
+            trip__trips_year=self.trips_year,
+            stop_type=StopOrder.PICKUP,
+        )
+
+        with self.assertNumQueries(4):
+            errors = InternalBus.objects.stop_ordering_errors(self.trips_year)
+        self.assertEqual(
+            errors,
+            {
+                bus1: [f'Unordered DROPOFF trips for bus {bus1}: {{{dropoff1!r}}}'],
+                bus2: [f'Surplus PICKUP trips for bus {bus2}: {{{surplus.trip!r}}}'],
+            },
+        )
+
+    def test_validate_stop_ordering(self):
+        bus, dropoff, pickup = self.make_bus_with_trips()
+        bus.validate_stop_ordering()
+
+        StopOrder.objects.filter(trip=pickup).delete()
+        with self.assertRaisesRegex(ValidationError, 'Unordered PICKUP trips'):
+            bus.validate_stop_ordering()
+
 
 class TestViews(FytTestCase):
     def test_index_views(self):
@@ -507,10 +586,7 @@ class IssuesMatrixTestCase(TransportTestCase):
                 date(2015, 1, 6): NOT_SCHEDULED,
             }
         }
-        matrix = get_internal_issues_matrix(
-            get_internal_route_matrix(self.trips_year),
-            get_internal_rider_matrix(self.trips_year),
-        )
+        matrix = InternalBusSchedule(self.trips_year).issues
         self.assertEqual(target, matrix)
 
     def test_exceeds_capacity(self):
@@ -563,13 +639,82 @@ class IssuesMatrixTestCase(TransportTestCase):
                 date(2015, 1, 6): EXCEEDS_CAPACITY,
             }
         }
-        matrix = get_internal_issues_matrix(
-            get_internal_route_matrix(self.trips_year),
-            get_internal_rider_matrix(self.trips_year),
-        )
+        matrix = InternalBusSchedule(self.trips_year).issues
 
         self.assertEqual(target, matrix)
 
+    def test_loads_match_bus_stops(self):
+        route = mommy.make(Route, trips_year=self.trips_year, category=Route.INTERNAL)
+        section1 = mommy.make(
+            Section, trips_year=self.trips_year, leaders_arrive=date(2015, 1, 1)
+        )
+        section2 = mommy.make(
+            Section, trips_year=self.trips_year, leaders_arrive=date(2014, 12, 30)
+        )
+        # Dropped off and picked up by the same bus
+        for section in [section1, section2, section2]:
+            trip = mommy.make(
+                Trip,
+                trips_year=self.trips_year,
+                section=section,
+                template__dropoff_stop__route=route,
+                template__pickup_stop__route=route,
+                template__return_route=route,
+            )
+            mommy.make(
+                IncomingStudent, 3, trips_year=self.trips_year, trip_assignment=trip
+            )
+
+        bus = mommy.make(
+            InternalBus, trips_year=self.trips_year, route=route, date=date(2015, 1, 3)
+        )
+        schedule = InternalBusSchedule(self.trips_year)
+
+        expected = []
+        load = 0
+        for stop in bus.all_stops:
+            load += total_size(stop.trips_picked_up)
+            load -= total_size(stop.trips_dropped_off)
+            expected.append((stop, load))
+
+        self.assertEqual(schedule.loads[bus], expected)
+        self.assertEqual(len(expected), 5)
+        self.assertEqual(schedule.over_capacity(bus), bus.over_capacity())
+
+    def test_schedule_in_constant_queries(self):
+        route = mommy.make(Route, trips_year=self.trips_year, category=Route.INTERNAL)
+
+        def make_buses(day):
+            section = mommy.make(
+                Section, trips_year=self.trips_year, leaders_arrive=date(2015, 1, day)
+            )
+            mommy.make(
+                Trip,
+                2,
+                trips_year=self.trips_year,
+                section=section,
+                template__dropoff_stop__route=route,
+                template__pickup_stop__route=route,
+                template__return_route=route,
+            )
+            for delta in [2, 4, 5]:
+                mommy.make(
+                    InternalBus,
+                    trips_year=self.trips_year,
+                    route=route,
+                    date=date(2015, 1, day + delta),
+                )
+
+        make_buses(1)
+        Hanover(self.trips_year)  # Cache the transport config
+        with self.assertNumQueries(5):
+            InternalBusSchedule(self.trips_year)
+
+        make_buses(10)
+        make_buses(20)
+        with self.assertNumQueries(5):
+            InternalBusSchedule(self.trips_year)
+
 
 class RidersTestCase(unittest.TestCase):
     def setUp(self):
@@ -752,6 +897,38 @@ class ExternalBusManager(FytTestCase):
         actual = ExternalBus.passengers.matrix_from_hanover(self.trips_year)
         self.assertEqual(target, actual)
 
+    def test_passengers_matrix_counts_in_database(self):
+        sxn = mommy.make(Section, trips_year=self.trips_year, is_local=True)
+        rt1 = mommy.make(Route, trips_year=self.trips_year, category=Route.EXTERNAL)
+        rt2 = mommy.make(Route, trips_year=self.trips_year, category=Route.EXTERNAL)
+        mommy.make(
+            IncomingStudent,
+            5,
+            trips_year=self.trips_year,
+            bus_assignment_round_trip__route=rt1,
+            trip_assignment__section=sxn,
+        )
+        mommy.make(
+            IncomingStudent,
+            trips_year=self.trips_year,
+            bus_assignment_to_hanover__route=rt2,
+            bus_assignment_from_hanover__route=rt1,
+            trip_assignment__section=sxn,
+        )
+
+        # Routes, sections, and counts
+        with self.assertNumQueries(3):
+            to_hanover = ExternalBus.passengers.matrix_to_hanover(self.trips_year)
+        self.assertEqual(to_hanover, {rt1: {sxn: 5}, rt2: {sxn: 1}})
+
+        from_hanover = ExternalBus.passengers.matrix_from_hanover(self.trips_year)
+        self.assertEqual(from_hanover, {rt1: {sxn: 6}, rt2: {sxn: 0}})
+
+    def test_passengers_matrix_without_routes(self):
+        with self.assertNumQueries(1):
+            matrix = ExternalBus.passengers.matrix_to_hanover(self.trips_year)
+        self.assertEqual(matrix, {})
+
     def test_invalid_riders(self):
         route = mommy.make(Route, trips_year=self.trips_year, category=Route.EXTERNAL)
 
@@ -1408,6 +1585,116 @@ class RefactorTestCase(TransportTestCase):
             [{'bus': new_pickup_bus, 'trip': trip, 'stop_type': StopOrder.PICKUP}],
         )
 
+    def test_changing_section_dates_in_constant_queries(self):
+        route = mommy.make(Route, trips_year=self.trips_year, category=Route.INTERNAL)
+        buses = [
+            mommy.make(
+                InternalBus,
+                trips_year=self.trips_year,
+                date=date(2015, 1, day),
+                route=route,
+            )
+            for day in range(3, 7)
+        ]
+        InternalBus.objects.update(dirty=False)
+
+        def change_dates(num_trips):
+            section = mommy.make(
+                Section, trips_year=self.trips_year, leaders_arrive=date(2015, 1, 1)
+            )
+            mommy.make(
+                Trip,
+                num_trips,
+                trips_year=self.trips_year,
+                section=section,
+                dropoff_route=route,
+                pickup_route=route,
+            )
+            section.leaders_arrive = date(2015, 1, 2)
+            with self.assertNumQueries(13):
+                section.save()
+
+        change_dates(1)
+        change_dates(5)
+
+        self.assertQsEqual(InternalBus.objects.filter(dirty=True), buses)
+        self.assertEqual(buses[0].get_stop_ordering().count(), 0)
+        self.assertEqual(buses[1].get_stop_ordering().count(), 6)
+        self.assertEqual(buses[3].get_stop_ordering().count(), 6)
+
+
+class BusIndexTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_transport_config()
+        self.route = mommy.make(
+            Route, trips_year=self.trips_year, category=Route.INTERNAL
+        )
+        self.section = mommy.make(
+            Section, trips_year=self.trips_year, leaders_arrive=date(2015, 1, 1)
+        )
+        self.dropoff_bus = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route=self.route,
+            date=date(2015, 1, 3),
+        )
+
+    def make_trips(self, n):
+        return mommy.make(
+            Trip,
+            n,
+            trips_year=self.trips_year,
+            section=self.section,
+            template__dropoff_stop__route=self.route,
+            template__pickup_stop__route=self.route,
+        )
+
+    def test_lookups_use_index(self):
+        self.make_trips(5)
+        trips = BusIndex.preload(
+            Trip.objects.select_related(
+                'section', 'template__dropoff_stop', 'template__pickup_stop'
+            ),
+            self.trips_year,
+        )
+        with self.assertNumQueries(2):
+            for trip in trips:
+                self.assertEqual(trip.get_dropoff_bus(), self.dropoff_bus)
+                self.assertIsNone(trip.get_pickup_bus())
+                self.assertEqual(trip.get_dropoff_stoporder().bus, self.dropoff_bus)
+                self.assertIsNone(trip.get_pickup_stoporder())
+                self.assertIsNone(trip.get_dropoff_time())
+
+    def test_index_is_reset_when_buses_change(self):
+        trip = BusIndex.preload(self.make_trips(1), self.trips_year)[0]
+        self.assertIsNone(trip.get_pickup_bus())
+        self.assertIsNone(trip.get_pickup_stoporder())
+
+        pickup_bus = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route=self.route,
+            date=date(2015, 1, 5),
+        )
+        self.assertEqual(trip.get_pickup_bus(), pickup_bus)
+        self.assertEqual(trip.get_pickup_stoporder().bus, pickup_bus)
+
+        pickup_bus.delete()
+        self.assertIsNone(trip.get_pickup_bus())
+        self.assertIsNone(trip.get_pickup_stoporder())
+
+    def test_section_packets_use_index(self):
+        self.make_trips(3)
+        url = reverse(
+            'core:packets:section',
+            kwargs={'trips_year': self.trips_year, 'section_pk': self.section.pk},
+        )
+        resp = self.app.get(url, user=self.make_director())
+        self.assertEqual(len(resp.context['trips']), 3)
+        for trip in resp.context['trips']:
+            self.assertIsNotNone(trip.bus_index)
+
 
 class StopOrderTestCase(FytTestCase):
     def setUp(self):
@@ -1563,6 +1850,74 @@ class ExternalBusModelTestCase(TransportTestCase):
         self.assertEqual(getattr(stops[2], bus.PICKUP_ATTR), [])
         self.assertEqual(len(stops), 3)
 
+    def make_passengers(self):
+        sxn = mommy.make(Section, trips_year=self.trips_year, is_local=True)
+        rt1 = mommy.make(Route, trips_year=self.trips_year, category=Route.EXTERNAL)
+        rt2 = mommy.make(Route, trips_year=self.trips_year, category=Route.EXTERNAL)
+        stop1 = mommy.make(Stop, trips_year=self.trips_year, route=rt1, distance=3)
+        stop2 = mommy.make(Stop, trips_year=self.trips_year, route=rt1, distance=100)
+        stop3 = mommy.make(Stop, trips_year=self.trips_year, route=rt2, distance=5)
+        for assignment, stop, registered in [
+            ('bus_assignment_round_trip', stop1, True),
+            ('bus_assignment_to_hanover', stop2, True),
+            ('bus_assignment_from_hanover', stop2, False),
+            ('bus_assignment_round_trip', stop3, False),
+        ]:
+            mommy.make(
+                IncomingStudent,
+                trips_year=self.trips_year,
+                trip_assignment__section=sxn,
+                registration=(
+                    mommy.make(Registration, trips_year=self.trips_year)
+                    if registered
+                    else None
+                ),
+                **{assignment: stop},
+            )
+        mommy.make(ExternalBus, trips_year=self.trips_year, route=rt1, section=sxn)
+        mommy.make(ExternalBus, trips_year=self.trips_year, route=rt2, section=sxn)
+
+    def test_all_passengers(self):
+        self.make_passengers()
+        bus = ExternalBus.objects.get(route__stops__distance=100)
+        self.assertQsEqual(
+            bus.all_passengers(),
+            set(bus.passengers_to_hanover + bus.passengers_from_hanover),
+        )
+        self.assertEqual(len(bus.all_passengers()), 3)
+
+    def test_preload_external_passengers(self):
+        self.make_passengers()
+
+        with self.assertNumQueries(3):
+            buses = preload_external_passengers(
+                ExternalBus.objects.select_related('section', 'route__vehicle'),
+                self.trips_year,
+            )
+
+        # The distance matrix is loaded once, when it is first used
+        with self.assertNumQueries(1):
+            for bus in buses:
+                bus.get_stops_to_hanover()
+                bus.get_stops_from_hanover()
+                for passenger in bus.passengers_to_hanover:
+                    passenger.get_phone_number()
+                for passenger in bus.passengers_from_hanover:
+                    passenger.get_phone_number()
+
+        for bus in buses:
+            fresh = ExternalBus.objects.get(pk=bus.pk)
+            self.assertEqual(bus.passengers_to_hanover, fresh.passengers_to_hanover)
+            self.assertEqual(bus.passengers_from_hanover, fresh.passengers_from_hanover)
+            self.assertEqual(bus.get_stops_to_hanover(), fresh.get_stops_to_hanover())
+            self.assertEqual(
+                bus.get_stops_from_hanover(), fresh.get_stops_from_hanover()
+            )
+
+    def test_preload_external_passengers_without_buses(self):
+        with self.assertNumQueries(1):
+            preload_external_passengers(ExternalBus.objects.all(), self.trips_year)
+
     def test_date_to_hanover(self):
         bus = mommy.make(ExternalBus, section__leaders_arrive=date(2015, 1, 1))
         self.assertEqual(bus.date_to_hanover, date(2015, 1, 2))
@@ -1623,6 +1978,13 @@ class InternalBusTimingTestCase(TransportTestCase):
         self.assertEqual(directions.legs[2].start_time, time(11, 24, 44))
         self.assertEqual(directions.legs[2].end_time, time(13, 27, 35))
 
+        # The stored times are shown without recomputing them
+        stored = InternalBus.objects.get(pk=bus.pk).stored_directions()
+        self.assertEqual(
+            [(leg.start_time, leg.end_time) for leg in stored.legs],
+            [(leg.start_time, leg.end_time) for leg in directions.legs],
+        )
+
     @vcr.use_cassette
     def test_stop_times_delayed_for_lodge(self):
         bus = mommy.make(
@@ -1677,10 +2039,16 @@ class InternalBusTimingTestCase(TransportTestCase):
         stoporder = trip.get_dropoff_stoporder()
         self.assertIsNone(stoporder.computed_time)
 
-        # Accessing the `time` property computes times, and updates
-        # the `computed_time` field
+        # Accessing the `time` property does not compute times; the last
+        # computed time is served until the bus is updated.
+        self.assertIsNone(stoporder.time)
+        self.assertTrue(stoporder.is_stale)
+
+        bus.update_stop_times()
+        stoporder = trip.get_dropoff_stoporder()
         self.assertEqual(stoporder.time, time(7, 38, 37))
         self.assertEqual(stoporder.computed_time, time(7, 38, 37))
+        self.assertFalse(stoporder.is_stale)
 
     @vcr.use_cassette
     def test_resolve_dropoff_or_pickup_sets_dirty_flag(self):
@@ -1730,6 +2098,52 @@ class InternalBusTimingTestCase(TransportTestCase):
         pickup_bus.refresh_from_db()
         self.assertTrue(pickup_bus.dirty)
 
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_update_stop_times_in_constant_queries(self, request_directions):
+        bus = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route__category=Route.INTERNAL,
+            date=date(2015, 1, 1),
+        )
+
+        def make_trips(n):
+            for i in range(n):
+                mommy.make(
+                    Trip,
+                    trips_year=self.trips_year,
+                    dropoff_route=bus.route,
+                    template__dropoff_stop__lat_lng=f'43.{i},-72.2',
+                    section__leaders_arrive=bus.date - timedelta(days=2),
+                )
+                mommy.make(
+                    Trip,
+                    trips_year=self.trips_year,
+                    pickup_route=bus.route,
+                    template__pickup_stop__lat_lng=f'44.{i},-72.2',
+                    section__leaders_arrive=bus.date - timedelta(days=4),
+                )
+
+        make_trips(1)
+        bus.update_stop_times()  # Populate leg cache
+
+        bus = InternalBus.objects.get(pk=bus.pk)
+        with self.assertNumQueries(11):
+            bus.update_stop_times()
+
+        make_trips(4)
+        InternalBus.objects.get(pk=bus.pk).update_stop_times()
+
+        bus = InternalBus.objects.get(pk=bus.pk)
+        with self.assertNumQueries(11):
+            bus.update_stop_times()
+
+        self.assertFalse(bus.dirty)
+        for stoporder in bus.stoporder_set.all():
+            self.assertIsNotNone(stoporder.computed_time)
+
     def test_changing_stop_addresses_marks_bus_as_dirty(self):
         date_leaders_arrive = date(2015, 1, 1)
 
@@ -2148,6 +2562,430 @@ class InternalBusTimingTestCase(TransportTestCase):
         self.assertEqual(legs[1].start_time, time(13, 00))
         self.assertIsNone(legs[1].end_time)
 
+        legs = InternalBus.objects.get(pk=pickup_bus.pk).stored_directions().legs
+        self.assertIsNone(legs[0].start_time)
+        self.assertIsNone(legs[0].end_time)
+        self.assertEqual(legs[1].start_time, time(13, 00))
+        self.assertIsNone(legs[1].end_time)
+
+
+class UpdateBusTimesCommandTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_old_trips_year()
+        self.init_transport_config()
+
+    def make_bus(self, trips_year):
+        bus = mommy.make(
+            InternalBus,
+            trips_year=trips_year,
+            route__category=Route.INTERNAL,
+            date=date(2015, 1, 1),
+        )
+        trip = mommy.make(
+            Trip,
+            trips_year=trips_year,
+            dropoff_route=bus.route,
+            template__dropoff_stop__lat_lng='43.8,-72.1',
+            section__leaders_arrive=bus.date - timedelta(days=2),
+        )
+        return bus, trip
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_updates_dirty_buses(self, request_directions):
+        bus, trip = self.make_bus(self.trips_year)
+        self.assertTrue(bus.dirty)
+
+        call_command('update_bus_times', stdout=io.StringIO())
+
+        bus.refresh_from_db()
+        self.assertFalse(bus.dirty)
+        self.assertIsNotNone(bus.times_updated_at)
+        self.assertEqual(trip.get_dropoff_time(), time(7, 31))
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_ignores_buses_from_other_years(self, request_directions):
+        bus, trip = self.make_bus(self.old_trips_year)
+        call_command('update_bus_times', stdout=io.StringIO())
+        bus.refresh_from_db()
+        self.assertTrue(bus.dirty)
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=maps.MapError('Oops')
+    )
+    def test_map_errors_leave_bus_dirty(self, request_directions):
+        bus, trip = self.make_bus(self.trips_year)
+        err = io.StringIO()
+        call_command('update_bus_times', stdout=io.StringIO(), stderr=err)
+        bus.refresh_from_db()
+        self.assertTrue(bus.dirty)
+        self.assertIn('Oops', err.getvalue())
+
+    @unittest.mock.patch(
+        'fyt.transport.models.InternalBus.update_stop_times',
+        side_effect=Exception('Oops'),
+    )
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_other_errors_leave_bus_dirty(self, request_directions, update_stop_times):
+        bus1, trip1 = self.make_bus(self.trips_year)
+        bus2, trip2 = self.make_bus(self.trips_year)
+        err = io.StringIO()
+        call_command('update_bus_times', stdout=io.StringIO(), stderr=err)
+        # Both buses are tried
+        self.assertEqual(update_stop_times.call_count, 2)
+        bus1.refresh_from_db()
+        self.assertTrue(bus1.dirty)
+        self.assertIn('Oops', err.getvalue())
+
+    def test_directions_are_requested_before_locking_the_bus(self):
+        bus, trip = self.make_bus(self.trips_year)
+        calls = []
+
+        def request_directions(stops):
+            calls.append('directions')
+            return fake_directions(stops)
+
+        def select_for_update(queryset, *args, **kwargs):
+            if queryset.model is InternalBus:
+                calls.append('lock')
+            return lock(queryset, *args, **kwargs)
+
+        lock = QuerySet.select_for_update
+        with unittest.mock.patch(
+            'fyt.transport.maps._request_directions', side_effect=request_directions
+        ), unittest.mock.patch.object(QuerySet, 'select_for_update', select_for_update):
+            call_command('update_bus_times', stdout=io.StringIO())
+
+        self.assertEqual(calls, ['directions', 'lock'])
+        bus.refresh_from_db()
+        self.assertFalse(bus.dirty)
+        self.assertEqual(trip.get_dropoff_time(), time(7, 31))
+
+    def test_buses_updated_while_requesting_directions_are_skipped(self):
+        bus, trip = self.make_bus(self.trips_year)
+
+        def request_directions(stops):
+            # Another worker updates the bus in the meantime
+            InternalBus.objects.filter(pk=bus.pk).update(dirty=False)
+            return fake_directions(stops)
+
+        out = io.StringIO()
+        with unittest.mock.patch(
+            'fyt.transport.maps._request_directions', side_effect=request_directions
+        ):
+            call_command('update_bus_times', stdout=out)
+
+        self.assertNotIn('Updated', out.getvalue())
+        bus.refresh_from_db()
+        self.assertIsNone(bus.times_updated_at)
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_checklist_does_not_update_times(self, request_directions):
+        director = self.make_director()
+        bus, trip = self.make_bus(self.trips_year)
+        call_command('update_bus_times', stdout=io.StringIO())
+        request_directions.reset_mock()
+
+        # The checklist shows the stored time and leaves the bus for the
+        # worker to update.
+        InternalBus.objects.filter(pk=bus.pk).update(dirty=True)
+
+        resp = self.app.get(bus.detail_url(), user=director)
+        self.assertIn('Arrive at 7:31', resp)
+        self.assertIn('out of date', resp)
+        request_directions.assert_not_called()
+        bus.refresh_from_db()
+        self.assertTrue(bus.dirty)
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_checklist_shows_stale_times(self, request_directions):
+        director = self.make_director()
+        bus, trip = self.make_bus(self.trips_year)
+        resp = self.app.get(bus.detail_url(), user=director)
+        self.assertIn('out of date', resp)
+
+        bus.dirty = False
+        bus.save()
+        resp = self.app.get(bus.detail_url(), user=director)
+        self.assertNotIn('out of date', resp)
+
+    @unittest.mock.patch('fyt.transport.views.prefetch_directions')
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_packet_prefetches_directions(self, request_directions, prefetch):
+        prefetch.side_effect = maps.prefetch_directions
+        bus1, trip1 = self.make_bus(self.trips_year)
+        bus2, trip2 = self.make_bus(self.trips_year)
+        url = reverse('core:internalbus:packet', kwargs={'trips_year': self.trips_year})
+        self.app.get(url, user=self.make_director())
+
+        prefetch.assert_called_once()
+        routes = prefetch.call_args[0][0]
+        self.assertEqual(len(routes), 2)
+        # Both buses have the same stops, so the legs are only requested
+        # once, and rendering only uses the cached legs
+        self.assertEqual(request_directions.call_count, 1)
+
+
+@override_settings(DIRECTIONS_BACKEND='offline')
+class StoredPacketTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_transport_config()
+        self.director = self.make_director()
+        self.url = reverse(
+            'core:internalbus:packet', kwargs={'trips_year': self.trips_year}
+        )
+
+    def make_bus(self):
+        bus = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route__category=Route.INTERNAL,
+            date=date(2015, 1, 3),
+        )
+        trip = mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            dropoff_route=bus.route,
+            template__dropoff_stop__lat_lng='43.8,-72.1',
+            section__leaders_arrive=date(2015, 1, 1),
+        )
+        return bus, trip
+
+    @unittest.mock.patch('fyt.transport.views.prefetch_directions')
+    def test_packet_is_only_rendered_once(self, prefetch):
+        bus, trip = self.make_bus()
+        resp1 = self.app.get(self.url, user=self.director)
+        resp2 = self.app.get(self.url, user=self.director)
+
+        prefetch.assert_called_once()
+        self.assertEqual(resp1.text, resp2.text)
+        self.assertIn(str(trip), resp2.text)
+
+        packet = StoredPacket.objects.get()
+        self.assertEqual(packet.name, self.url)
+        self.assertEqual(packet.trips_year, self.trips_year)
+
+    @unittest.mock.patch('fyt.transport.views.prefetch_directions')
+    def test_packet_is_rendered_again_when_passengers_change(self, prefetch):
+        bus, trip = self.make_bus()
+        self.app.get(self.url, user=self.director)
+        mommy.make(IncomingStudent, trips_year=self.trips_year, trip_assignment=trip)
+        resp = self.app.get(self.url, user=self.director)
+
+        self.assertEqual(prefetch.call_count, 2)
+        self.assertIn('(1 people)', resp.text)
+        # The previous version is deleted
+        self.assertEqual(StoredPacket.objects.count(), 1)
+
+    @unittest.mock.patch('fyt.transport.views.prefetch_directions')
+    def test_packet_is_rendered_again_when_names_change(self, prefetch):
+        bus, trip = self.make_bus()
+        self.app.get(self.url, user=self.director)
+
+        trip.template.name = 999
+        trip.template.save()
+        resp = self.app.get(self.url, user=self.director)
+        self.assertEqual(prefetch.call_count, 2)
+        self.assertIn(str(trip), resp.text)
+
+        bus.route.name = 'Renamed route'
+        bus.route.save()
+        resp = self.app.get(self.url, user=self.director)
+        self.assertEqual(prefetch.call_count, 3)
+        self.assertIn('Renamed route', resp.text)
+
+        bus.route.vehicle.capacity += 1
+        bus.route.vehicle.save()
+        self.app.get(self.url, user=self.director)
+        self.assertEqual(prefetch.call_count, 4)
+
+    @unittest.mock.patch('fyt.transport.views.prefetch_directions')
+    def test_packet_is_rendered_again_when_bus_is_dirty(self, prefetch):
+        bus, trip = self.make_bus()
+        InternalBus.objects.update(dirty=False)
+        self.app.get(self.url, user=self.director)
+        InternalBus.objects.update(dirty=True)
+        self.app.get(self.url, user=self.director)
+        self.assertEqual(prefetch.call_count, 2)
+
+    def test_packet_is_not_specific_to_user(self):
+        self.make_bus()
+        self.app.get(self.url, user=self.director)
+        directorate = self.make_directorate()
+        resp = self.app.get(self.url, user=directorate)
+        self.assertNotIn(self.director.name, resp.text)
+        self.assertNotIn(directorate.name, resp.text)
+
+    def test_stored_packet_requires_permissions(self):
+        self.make_bus()
+        self.app.get(self.url, user=self.director)
+        self.app.get(self.url, user=self.make_user(), status=403)
+
+    def make_external_bus(self):
+        route = mommy.make(Route, trips_year=self.trips_year, category=Route.EXTERNAL)
+        stop = mommy.make(
+            Stop,
+            trips_year=self.trips_year,
+            route=route,
+            lat_lng='43.8,-72.1',
+            pickup_time=time(10),
+            dropoff_time=time(16),
+        )
+        bus = mommy.make(
+            ExternalBus,
+            trips_year=self.trips_year,
+            route=route,
+            section__trips_year=self.trips_year,
+        )
+        return bus, stop
+
+    def test_external_packet_is_rendered_again_when_passengers_change(self):
+        bus, stop = self.make_external_bus()
+        url = reverse('core:externalbus:packet', kwargs={'trips_year': self.trips_year})
+
+        resp = self.app.get(url, user=self.director)
+        psngr = mommy.make(
+            IncomingStudent,
+            trips_year=self.trips_year,
+            trip_assignment__section=bus.section,
+            bus_assignment_round_trip=stop,
+        )
+        self.assertNotIn(psngr.name, resp.text)
+
+        resp = self.app.get(url, user=self.director)
+        self.assertIn(psngr.name, resp.text)
+
+    def test_external_packet_is_rendered_again_when_stops_change(self):
+        bus, stop = self.make_external_bus()
+        url = reverse('core:externalbus:packet', kwargs={'trips_year': self.trips_year})
+        config = TransportConfig.objects.get(trips_year=self.trips_year)
+
+        def render():
+            self.app.get(url, user=self.director)
+            return StoredPacket.objects.order_by('-pk')[0].fingerprint
+
+        fingerprint = render()
+        self.assertEqual(render(), fingerprint)
+
+        stop.pickup_time = time(11)
+        stop.save()
+        self.assertNotEqual(render(), fingerprint)
+        fingerprint = render()
+
+        bus.route.name = 'Renamed route'
+        bus.route.save()
+        self.assertNotEqual(render(), fingerprint)
+        fingerprint = render()
+
+        config.hanover = mommy.make(
+            Stop, trips_year=self.trips_year, lat_lng='43.7,-72.3'
+        )
+        config.save()
+        self.assertNotEqual(render(), fingerprint)
+
+    def test_external_packet_phone_numbers_in_constant_queries(self):
+        bus, stop = self.make_external_bus()
+        url = reverse('core:externalbus:packet', kwargs={'trips_year': self.trips_year})
+
+        def make_passengers(n):
+            for i in range(n):
+                mommy.make(
+                    IncomingStudent,
+                    trips_year=self.trips_year,
+                    trip_assignment__section=bus.section,
+                    bus_assignment_round_trip=stop,
+                    registration=mommy.make(
+                        Registration,
+                        trips_year=self.trips_year,
+                        phone=f'603-555-010{i}',
+                    ),
+                )
+
+        make_passengers(1)
+        self.app.get(url, user=self.director)  # Cache directions
+
+        StoredPacket.objects.all().delete()
+        with CaptureQueriesContext(connection) as one_passenger:
+            self.app.get(url, user=self.director)
+
+        StoredPacket.objects.all().delete()
+        make_passengers(3)
+        with CaptureQueriesContext(connection) as four_passengers:
+            resp = self.app.get(url, user=self.director)
+
+        self.assertIn('603-555-0102', resp.text)
+        self.assertEqual(len(one_passenger), len(four_passengers))
+
+    def test_render_packets(self):
+        bus, trip = self.make_bus()
+        mommy.make(
+            ExternalBus,
+            trips_year=self.trips_year,
+            route__trips_year=self.trips_year,
+            section__trips_year=self.trips_year,
+        )
+
+        packets = render_packets(self.trips_year)
+        self.assertEqual(
+            set(packet.name for packet in packets), set(packet_urls(self.trips_year))
+        )
+        self.assertIn(
+            reverse(
+                'core:internalbus:packet_for_date',
+                kwargs={'trips_year': self.trips_year, 'date': bus.date},
+            ),
+            [packet.name for packet in packets],
+        )
+        # Packets are up to date
+        self.assertEqual(render_packets(self.trips_year), [])
+
+    def test_worker_renders_packets(self):
+        self.make_bus()
+        stdout = io.StringIO()
+        call_command('update_bus_times', '--packets', stdout=stdout)
+        self.assertIn(f'Rendered {self.url}', stdout.getvalue())
+
+    @unittest.mock.patch('time.sleep')
+    @unittest.mock.patch(
+        'fyt.transport.management.commands.update_bus_times.render_packets',
+        return_value=[],
+    )
+    def test_worker_only_checks_packets_after_updates(self, render, sleep):
+        self.make_bus()
+        InternalBus.objects.update(dirty=False)
+
+        class StopPolling(Exception):
+            pass
+
+        def poll(seconds):
+            if sleep.call_count == 2:
+                InternalBus.objects.update(dirty=True)
+            elif sleep.call_count == 3:
+                raise StopPolling
+
+        sleep.side_effect = poll
+        with self.assertRaises(StopPolling):
+            call_command(
+                'update_bus_times', '--loop', '--packets', stdout=io.StringIO()
+            )
+
+        # Checked when starting and after the bus is updated, but not when
+        # nothing changed
+        self.assertEqual(render.call_count, 2)
+
 
 class MapsTestCase(TransportTestCase):
     def setUp(self):
@@ -2164,7 +3002,7 @@ class MapsTestCase(TransportTestCase):
 
     @vcr.use_cassette
     def test_directions_handles_more_than_max_waypoints(self):
-        """ Google maps restricts the number of waypoints per request."""
+        """Google maps restricts the number of waypoints per request."""
         stops = [
             mommy.make(Stop, trips_year=self.trips_year, lat_lng=coord)
             for coord in (
@@ -2207,6 +3045,1173 @@ class MapsTestCase(TransportTestCase):
             maps.get_directions([Hanover(self.trips_year)])
 
 
+class MapsMetricsTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_transport_config()
+        self.hanover = Hanover(self.trips_year)
+        self.lodge = Lodge(self.trips_year)
+
+    @override_settings(GOOGLE_MAPS_KEY='AIza-test')
+    def test_client_is_shared(self):
+        self.assertIs(maps.get_client(), maps.get_client())
+
+    @unittest.mock.patch('fyt.transport.maps.time.sleep')
+    def test_token_bucket(self, sleep):
+        bucket = maps.TokenBucket(rate=10, capacity=2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertAlmostEqual(bucket.acquire(), 0.1, places=2)
+        self.assertAlmostEqual(bucket.acquire(), 0.2, places=2)
+        self.assertEqual(sleep.call_count, 2)
+
+    @override_settings(GOOGLE_MAPS_KEY='AIza-test')
+    @unittest.mock.patch(
+        'googlemaps.Client.directions',
+        side_effect=googlemaps.exceptions.ApiError('OVER_QUERY_LIMIT'),
+    )
+    def test_failed_requests_are_recorded(self, directions):
+        with self.assertRaisesRegex(maps.MapError, 'OVER_QUERY_LIMIT'):
+            maps.get_directions([self.hanover, self.lodge])
+
+        usage = MapsUsage.objects.get()
+        self.assertEqual(usage.api, MapsUsage.DIRECTIONS)
+        self.assertEqual(usage.date, timezone.localdate())
+        self.assertEqual(usage.requests, 1)
+        self.assertEqual(usage.failures, 1)
+        self.assertEqual(usage.cache_misses, 1)
+        self.assertEqual(sum(usage.histogram), 1)
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_cache_hits_are_recorded_periodically(self, request_directions):
+        maps.get_directions([self.hanover, self.lodge])
+        maps.get_directions([self.hanover, self.lodge])
+        self.assertFalse(MapsUsage.objects.exists())
+
+        maps.metrics.flush(force=True)
+        usage = MapsUsage.objects.get()
+        self.assertEqual(usage.cache_hits, 1)
+        self.assertEqual(usage.cache_misses, 1)
+        self.assertEqual(usage.cache_hit_rate, 0.5)
+
+    def test_counts_are_added(self):
+        maps.metrics.record_request('geocode', 0.2)
+        maps.metrics.flush()
+        maps.metrics.record_request('geocode', 3, failed=True)
+        maps.metrics.flush()
+
+        usage = MapsUsage.objects.get()
+        self.assertEqual(usage.requests, 2)
+        self.assertEqual(usage.failures, 1)
+        self.assertAlmostEqual(usage.mean_latency, 1.6)
+        self.assertEqual(usage.histogram, [0, 1, 0, 0, 0, 1, 0, 0])
+
+    def test_latency_percentile(self):
+        usage = MapsUsage(requests=10, histogram=[5, 3, 1, 0, 0, 0, 0, 1])
+        self.assertEqual(usage.latency_percentile(50), 0.1)
+        self.assertEqual(usage.latency_percentile(80), 0.25)
+        self.assertEqual(usage.latency_percentile(90), 0.5)
+        self.assertIsNone(usage.latency_percentile(95))
+        self.assertIsNone(MapsUsage().latency_percentile(95))
+
+    def test_usage_is_visible_to_directors(self):
+        maps.metrics.record_request('directions', 0.3)
+        maps.metrics.flush()
+        url = reverse(
+            'core:transportconfig:maps_usage', kwargs={'trips_year': self.trips_year}
+        )
+        resp = self.app.get(url, user=self.make_director())
+        self.assertIn('1 of 2500 daily requests', resp)
+        self.app.get(url, user=self.make_directorate(), status=403)
+
+
+class CachedLegTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_transport_config()
+        self.hanover = Hanover(self.trips_year)
+        self.lodge = Lodge(self.trips_year)
+        self.stop1, self.stop2, self.stop3 = [
+            mommy.make(Stop, trips_year=self.trips_year, lat_lng=coord)
+            for coord in ('43.7,-72.2', '43.8,-72.1', '43.9,-72.0')
+        ]
+
+    def test_store_ignores_legs_cached_concurrently(self):
+        CachedLeg.objects.create(origin='a', destination='b', raw={'old': True})
+        # Another request stores the leg after the stale legs are deleted
+        with unittest.mock.patch.object(QuerySet, 'delete'):
+            CachedLeg.objects.store({('a', 'b'): {}, ('b', 'c'): {}})
+        self.assertEqual(CachedLeg.objects.get(origin='a').raw, {'old': True})
+        self.assertTrue(CachedLeg.objects.filter(origin='b').exists())
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_directions_are_cached(self, request_directions):
+        stops = [self.hanover, self.stop1, self.lodge]
+        maps.get_directions(stops)
+        directions = maps.get_directions(stops)
+        self.assertEqual(request_directions.call_count, 1)
+        self.assertEqual(len(directions.legs), 2)
+        self.assertEqual(directions.legs[0].duration, timedelta(seconds=60))
+        self.assertEqual(directions.legs[0].start_stop, self.hanover)
+        self.assertEqual(directions.legs[0].end_stop, self.stop1)
+        self.assertEqual(directions.legs[1].start_stop, self.stop1)
+        self.assertEqual(directions.legs[1].end_stop, self.lodge)
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_legs_are_directional(self, request_directions):
+        maps.get_directions([self.hanover, self.lodge])
+        maps.get_directions([self.lodge, self.hanover])
+        self.assertEqual(request_directions.call_count, 2)
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_only_missing_legs_are_requested(self, request_directions):
+        maps.get_directions(
+            [self.hanover, self.stop1, self.stop2, self.stop3, self.lodge]
+        )
+        request_directions.reset_mock()
+
+        # Swap stop2 and stop3
+        stops = [self.hanover, self.stop1, self.stop3, self.stop2, self.lodge]
+        directions = maps.get_directions(stops)
+        request_directions.assert_called_once_with(stops[1:])
+        self.assertEqual(len(directions.legs), 4)
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_separate_runs_of_missing_legs(self, request_directions):
+        maps.get_directions([self.stop1, self.stop2])
+        stops = [self.hanover, self.stop1, self.stop2, self.lodge]
+        maps.get_directions(stops)
+        self.assertEqual(
+            request_directions.call_args_list[1:],
+            [unittest.mock.call(stops[0:2]), unittest.mock.call(stops[2:4])],
+        )
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_expired_legs_are_refreshed(self, request_directions):
+        stops = [self.hanover, self.lodge]
+        maps.get_directions(stops)
+        CachedLeg.objects.update(
+            created_at=timezone.now() - CachedLeg.TTL - timedelta(minutes=1)
+        )
+        maps.get_directions(stops)
+        self.assertEqual(request_directions.call_count, 2)
+        self.assertEqual(CachedLeg.objects.count(), 1)
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_changing_stop_location_invalidates_legs(self, request_directions):
+        maps.get_directions([self.hanover, self.stop1, self.lodge])
+        maps.get_directions([self.hanover, self.lodge])
+        self.assertEqual(CachedLeg.objects.count(), 3)
+
+        self.stop1.lat_lng = '44.1,-71.5'
+        self.stop1.save()
+
+        self.assertQsEqual(
+            CachedLeg.objects.all(),
+            ['43.7031377,-72.2898190 to 43.977253,-71.8154831'],
+            transform=str,
+        )
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_prefetch_directions(self, request_directions):
+        maps.get_directions([self.stop1, self.stop2])
+        request_directions.reset_mock()
+
+        route1 = [self.hanover, self.stop1, self.stop2, self.lodge]
+        route2 = [self.hanover, self.stop1, self.lodge]
+        maps.prefetch_directions([route1, route2, [self.hanover]])
+
+        # The leg from Hanover to stop1 is only requested once
+        self.assertCountEqual(
+            request_directions.call_args_list,
+            [
+                unittest.mock.call(route1[0:2]),
+                unittest.mock.call(route1[2:4]),
+                unittest.mock.call(route2[1:3]),
+            ],
+        )
+        self.assertEqual(CachedLeg.objects.count(), 4)
+
+        request_directions.reset_mock()
+        maps.get_directions(route1)
+        maps.get_directions(route2)
+        request_directions.assert_not_called()
+
+    @unittest.mock.patch('fyt.transport.maps._request_directions')
+    def test_prefetch_directions_ignores_errors(self, request_directions):
+        def request(stops):
+            if stops[0] == self.stop1:
+                raise maps.MapError('Nope')
+            return fake_directions(stops)
+
+        request_directions.side_effect = request
+        maps.prefetch_directions([[self.hanover, self.lodge], [self.stop1, self.stop2]])
+        self.assertQsEqual(
+            CachedLeg.objects.all(),
+            ['43.7031377,-72.2898190 to 43.977253,-71.8154831'],
+            transform=str,
+        )
+        with self.assertRaises(maps.MapError):
+            maps.get_directions([self.stop1, self.stop2])
+
+    def test_missing_runs(self):
+        pairs = [(1, 2), (2, 3), (3, 4), (4, 5), (5, 6)]
+        legs = {(2, 3): {}, (3, 4): {}}
+        self.assertEqual(list(maps._missing_runs(pairs, legs)), [(0, 1), (3, 5)])
+        self.assertEqual(list(maps._missing_runs(pairs, {})), [(0, 5)])
+        self.assertEqual(list(maps._missing_runs(pairs[1:3], legs)), [])
+
+
+class OfflineBackendTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_transport_config()
+        self.hanover = Hanover(self.trips_year)
+        self.lodge = Lodge(self.trips_year)
+
+    def test_great_circle_distance(self):
+        self.assertAlmostEqual(
+            maps.great_circle_distance((43.0, -72.0), (44.0, -72.0)), 111195, 0
+        )
+        self.assertEqual(maps.great_circle_distance((43.0, -72.0), (43.0, -72.0)), 0)
+
+    def test_leg_estimate(self):
+        backend = maps.OfflineBackend(road_factor=1.5, average_speed=30)
+        stop = mommy.make(Stop, trips_year=self.trips_year, lat_lng='44.0,-72.0')
+        raw = backend.directions([self.hanover, stop])
+        leg = maps.Leg(raw['legs'][0], self.hanover, stop)
+        self.assertTrue(leg.estimated)
+        self.assertEqual(leg.steps, [])
+        # 40.4km * 1.5 at 30mph
+        self.assertEqual(leg.distance, 60554)
+        self.assertEqual(leg.duration, timedelta(seconds=4515))
+
+    def test_stops_without_coordinates_raise_error(self):
+        stop = mommy.make(Stop, trips_year=self.trips_year, address='Lyme, NH')
+        with self.assertRaisesRegex(maps.MapError, 'has no coordinates'):
+            maps.OfflineBackend().directions([self.hanover, stop])
+
+    @override_settings(DIRECTIONS_BACKEND='offline')
+    def test_estimated_legs_are_not_cached(self):
+        directions = maps.get_directions([self.hanover, self.lodge])
+        self.assertEqual(len(directions.legs), 1)
+        self.assertTrue(directions.legs[0].estimated)
+        self.assertFalse(CachedLeg.objects.exists())
+
+    @override_settings(DIRECTIONS_BACKEND='offline')
+    def test_checklist_shows_estimated_legs(self):
+        bus = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route__category=Route.INTERNAL,
+            date=date(2015, 1, 1),
+        )
+        mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            dropoff_route=bus.route,
+            template__dropoff_stop__lat_lng='43.8,-72.1',
+            section__leaders_arrive=bus.date - timedelta(days=2),
+        )
+        resp = self.app.get(bus.detail_url(), user=self.make_director())
+        self.assertIn('Estimated drive of 16.2 miles', resp)
+
+    @override_settings(DIRECTIONS_FALLBACK=True)
+    @unittest.mock.patch(
+        'fyt.transport.maps.GoogleBackend.directions',
+        side_effect=maps.MapError('Over quota'),
+    )
+    def test_fallback_to_offline_estimate(self, google_directions):
+        directions = maps.get_directions([self.hanover, self.lodge])
+        google_directions.assert_called_once()
+        self.assertTrue(directions.legs[0].estimated)
+        self.assertFalse(CachedLeg.objects.exists())
+
+    @unittest.mock.patch(
+        'fyt.transport.maps.GoogleBackend.directions',
+        side_effect=maps.MapError('Over quota'),
+    )
+    def test_no_fallback_by_default(self, google_directions):
+        with self.assertRaisesRegex(maps.MapError, 'Over quota'):
+            maps.get_directions([self.hanover, self.lodge])
+
+    @override_settings(DIRECTIONS_BACKEND='carrier-pigeon')
+    def test_unknown_backend(self):
+        with self.assertRaises(ImproperlyConfigured):
+            maps.get_backend()
+
+
+@override_settings(DIRECTIONS_BACKEND='offline')
+class DistanceMatrixTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_old_trips_year()
+        self.init_transport_config()
+        self.hanover = Hanover(self.trips_year)
+        self.lodge = Lodge(self.trips_year)
+        self.stop = mommy.make(Stop, trips_year=self.trips_year, lat_lng='43.8,-72.1')
+
+    def test_compute(self):
+        mommy.make(Stop, trips_year=self.trips_year, lat_lng='', address='Lyme, NH')
+        mommy.make(Stop, trips_year=self.old_trips_year, lat_lng='44.0,-72.0')
+        matrix = DistanceMatrix.objects.compute(self.trips_year)
+
+        self.assertEqual(
+            matrix.locations,
+            [
+                self.hanover.location,
+                self.lodge.location,
+                self.stop.location,
+                'Lyme, NH',
+            ],
+        )
+        estimate = maps.OfflineBackend().leg(self.hanover, self.stop)
+        leg = matrix.leg(self.hanover.location, self.stop.location)
+        self.assertEqual(leg['duration'], estimate['duration'])
+        self.assertEqual(leg['distance'], estimate['distance'])
+        self.assertEqual(matrix.durations[0][0], 0)
+        # The offline backend can't estimate legs without coordinates
+        self.assertIsNone(matrix.leg(self.hanover.location, 'Lyme, NH'))
+        self.assertIsNone(matrix.leg(self.hanover.location, 'Nowhere'))
+
+    def test_recompute_replaces_matrix(self):
+        DistanceMatrix.objects.compute(self.trips_year)
+        self.stop.lat_lng = '44.0,-72.0'
+        self.stop.save()
+        matrix = DistanceMatrix.objects.compute(self.trips_year)
+        self.assertEqual(DistanceMatrix.objects.count(), 1)
+        self.assertIn('44.0,-72.0', matrix.locations)
+
+    @unittest.mock.patch('fyt.transport.maps.MATRIX_BLOCK', 2)
+    def test_matrix_is_requested_in_blocks(self):
+        with unittest.mock.patch.object(
+            maps.OfflineBackend,
+            'distance_matrix',
+            autospec=True,
+            side_effect=maps.OfflineBackend.distance_matrix,
+        ) as distance_matrix:
+            locations, durations, distances = maps.get_distance_matrix(
+                [self.hanover, self.lodge, self.stop, self.stop]
+            )
+        self.assertEqual(distance_matrix.call_count, 4)
+        self.assertEqual(len(locations), 3)
+        self.assertEqual(len(durations), 3)
+        for row in durations + distances:
+            self.assertEqual(len(row), 3)
+            self.assertNotIn(None, row)
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_directions_use_matrix(self, request_directions):
+        matrix = DistanceMatrix.objects.compute(self.trips_year)
+        maps.get_directions([self.stop, self.lodge])
+        request_directions.reset_mock()
+
+        new_stop = mommy.make(Stop, trips_year=self.trips_year, lat_lng='44.0,-72.0')
+        stops = [self.hanover, self.stop, self.lodge, new_stop]
+        directions = maps.get_directions(stops, matrix=matrix)
+
+        # Only the leg to the new stop is requested
+        request_directions.assert_called_once_with(stops[2:])
+        # Cached legs take precedence over the matrix
+        self.assertEqual(directions.legs[1].duration, timedelta(seconds=60))
+        self.assertEqual(
+            directions.legs[0].raw,
+            matrix.leg(self.hanover.location, self.stop.location),
+        )
+        self.assertEqual(CachedLeg.objects.count(), 2)
+
+    @unittest.mock.patch('fyt.transport.maps._request_directions')
+    def test_bus_times_are_computed_from_matrix(self, request_directions):
+        bus = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route__category=Route.INTERNAL,
+            date=date(2015, 1, 1),
+        )
+        trip = mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            dropoff_route=bus.route,
+            template__dropoff_stop=self.stop,
+            section__leaders_arrive=bus.date - timedelta(days=2),
+        )
+        DistanceMatrix.objects.compute(self.trips_year)
+        call_command('update_bus_times', stdout=io.StringIO())
+        request_directions.assert_not_called()
+        self.assertEqual(trip.get_dropoff_time(), time(7, 57, 50))
+
+    @unittest.mock.patch(
+        'fyt.transport.maps._request_directions', side_effect=fake_directions
+    )
+    def test_matrix_is_only_loaded_for_missing_legs(self, request_directions):
+        buses = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route__category=Route.INTERNAL,
+            route__trips_year=self.trips_year,
+            date=date(2015, 1, 1),
+            _quantity=2,
+        )
+        for bus in buses:
+            mommy.make(
+                Trip,
+                trips_year=self.trips_year,
+                dropoff_route=bus.route,
+                template__dropoff_stop=self.stop,
+                section__leaders_arrive=bus.date - timedelta(days=2),
+            )
+        DistanceMatrix.objects.compute(self.trips_year)
+
+        with unittest.mock.patch.object(
+            DistanceMatrix.objects, 'for_year', wraps=DistanceMatrix.objects.for_year
+        ) as for_year:
+            # The matrix is shared by all buses
+            call_command('update_bus_times', stdout=io.StringIO())
+            for_year.assert_called_once()
+            request_directions.assert_not_called()
+
+            # Not loaded when all legs are cached
+            maps.get_directions(buses[0].all_stops)
+            for_year.reset_mock()
+            InternalBus.objects.get(pk=buses[0].pk).stored_directions()
+            for_year.assert_not_called()
+
+    @unittest.mock.patch('fyt.transport.maps._request_directions')
+    def test_external_packet_has_directions(self, request_directions):
+        request_directions.side_effect = lambda stops: {
+            'legs': [
+                {
+                    'duration': {'value': 60},
+                    'steps': [
+                        {'html_instructions': 'Turn left', 'distance': {'text': '1 mi'}}
+                    ],
+                }
+                for _ in stops[1:]
+            ]
+        }
+        route = mommy.make(Route, trips_year=self.trips_year, category=Route.EXTERNAL)
+        self.stop.route = route
+        self.stop.pickup_time = time(10)
+        self.stop.dropoff_time = time(16)
+        self.stop.save()
+        bus = mommy.make(
+            ExternalBus,
+            trips_year=self.trips_year,
+            route=route,
+            section__trips_year=self.trips_year,
+        )
+        mommy.make(
+            IncomingStudent,
+            trips_year=self.trips_year,
+            trip_assignment__section=bus.section,
+            bus_assignment_round_trip=self.stop,
+        )
+        DistanceMatrix.objects.compute(self.trips_year)
+
+        url = reverse('core:externalbus:packet', kwargs={'trips_year': self.trips_year})
+        resp = self.app.get(url, user=self.make_director())
+        self.assertEqual(resp.text.count('Turn left'), 2)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('update_distance_matrix', stdout=out)
+        self.assertIn('Computed 3x3 distance matrix', out.getvalue())
+        matrix = DistanceMatrix.objects.for_year(self.trips_year)
+        self.assertEqual(len(matrix.locations), 3)
+
+
+OFFLINE_GEOCODES = {'Lyme, NH': '43.8098,-72.1559', 'Orford, NH': '43.9043,-72.1398'}
+
+
+@override_settings(GEOCODING_BACKEND='offline', OFFLINE_GEOCODES=OFFLINE_GEOCODES)
+class GeocodingTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_old_trips_year()
+        self.init_transport_config()
+
+    def make_stop(self, **kwargs):
+        kwargs.setdefault('lat_lng', '')
+        return mommy.make(Stop, trips_year=self.trips_year, **kwargs)
+
+    def test_offline_geocode(self):
+        backend = maps.OfflineBackend()
+        self.assertEqual(backend.geocode('Lyme, NH'), '43.8098,-72.1559')
+        self.assertEqual(backend.geocode('43.7, -72.2'), '43.7,-72.2')
+        with self.assertRaises(maps.MapError):
+            backend.geocode('Atlantis')
+
+    def test_geocode_caches_coordinates(self):
+        coordinates = maps.geocode(['Lyme, NH', 'Atlantis'])
+        self.assertEqual(coordinates, {'Lyme, NH': '43.8098,-72.1559'})
+        self.assertQuerysetEqual(
+            CachedGeocode.objects.all(), ['Lyme, NH'], lambda x: x.address
+        )
+
+        with unittest.mock.patch('fyt.transport.maps.OfflineBackend.geocode') as m:
+            coordinates = maps.geocode(['Lyme, NH'])
+            m.assert_not_called()
+        self.assertEqual(coordinates, {'Lyme, NH': '43.8098,-72.1559'})
+
+    def test_store_ignores_addresses_cached_concurrently(self):
+        CachedGeocode.objects.create(address='Lyme, NH', lat_lng='43.8,-72.1')
+        # Another request stores the address after the stale ones are deleted
+        with unittest.mock.patch.object(QuerySet, 'delete'):
+            CachedGeocode.objects.store(
+                {'Lyme, NH': '43.9,-72.2', 'Orford, NH': '43.9,-72.1'}
+            )
+        self.assertEqual(
+            CachedGeocode.objects.get(address='Lyme, NH').lat_lng, '43.8,-72.1'
+        )
+        self.assertTrue(CachedGeocode.objects.filter(address='Orford, NH').exists())
+
+    def test_expired_coordinates_are_geocoded_again(self):
+        maps.geocode(['Lyme, NH'])
+        CachedGeocode.objects.update(
+            created_at=timezone.now() - CachedGeocode.TTL - timedelta(hours=1)
+        )
+        with unittest.mock.patch(
+            'fyt.transport.maps.OfflineBackend.geocode', return_value='43.8,-72.1'
+        ):
+            self.assertEqual(maps.geocode(['Lyme, NH']), {'Lyme, NH': '43.8,-72.1'})
+        self.assertEqual(CachedGeocode.objects.get().lat_lng, '43.8,-72.1')
+
+    def test_geocode_stops_in_bulk(self):
+        lyme = self.make_stop(address='Lyme, NH')
+        atlantis = self.make_stop(address='Atlantis')
+        manual = self.make_stop(address='Orford, NH', lat_lng='43.9,-72.1')
+        old = mommy.make(
+            Stop, trips_year=self.old_trips_year, lat_lng='', address='Lyme, NH'
+        )
+
+        self.assertEqual(Stop.objects.geocode(self.trips_year), [lyme])
+
+        lyme.refresh_from_db()
+        self.assertEqual(lyme.lat_lng, '43.8098,-72.1559')
+        self.assertEqual(lyme.geocoded_address, 'Lyme, NH')
+        for stop in [atlantis, old]:
+            stop.refresh_from_db()
+            self.assertEqual(stop.lat_lng, '')
+        manual.refresh_from_db()
+        self.assertEqual(manual.lat_lng, '43.9,-72.1')
+
+    def test_geocoding_marks_buses_dirty(self):
+        stop = self.make_stop(address='Lyme, NH')
+        bus = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route__category=Route.INTERNAL,
+            date=date(2015, 1, 3),
+        )
+        mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            template__dropoff_stop=stop,
+            dropoff_route=bus.route,
+            section__leaders_arrive=date(2015, 1, 1),
+        )
+        InternalBus.objects.update(dirty=False)
+
+        Stop.objects.geocode(self.trips_year)
+        bus.refresh_from_db()
+        self.assertTrue(bus.dirty)
+
+    def test_changed_address_is_geocoded_again(self):
+        stop = self.make_stop(address='Lyme, NH')
+        Stop.objects.geocode(self.trips_year)
+        stop.refresh_from_db()
+
+        stop.address = 'Orford, NH'
+        stop.save()
+        self.assertQuerysetEqual(
+            Stop.objects.needs_geocoding(self.trips_year), [stop], lambda x: x
+        )
+        self.assertTrue(stop.geocode())
+        self.assertEqual(stop.lat_lng, '43.9043,-72.1398')
+        self.assertEqual(stop.geocoded_address, 'Orford, NH')
+
+    def test_coordinates_entered_by_hand_are_kept(self):
+        stop = self.make_stop(address='Lyme, NH')
+        Stop.objects.geocode(self.trips_year)
+        stop.refresh_from_db()
+
+        stop.address = 'Orford, NH'
+        stop.lat_lng = '43.9,-72.1'
+        self.assertFalse(stop.geocode())
+        stop.save()
+        self.assertEqual(stop.geocoded_address, '')
+        self.assertFalse(Stop.objects.needs_geocoding(self.trips_year).exists())
+
+    def test_unknown_address_raises_map_error(self):
+        stop = self.make_stop(address='Atlantis')
+        with self.assertRaisesRegex(maps.MapError, 'Atlantis'):
+            stop.geocode()
+
+    def test_stop_is_geocoded_when_updated(self):
+        stop = self.make_stop(address='Atlantis')
+        resp = self.app.get(stop.update_url(), user=self.make_director())
+        resp.form['address'] = 'Lyme, NH'
+        resp.form.submit()
+        stop.refresh_from_db()
+        self.assertEqual(stop.lat_lng, '43.8098,-72.1559')
+
+    def test_geocode_stops_command(self):
+        stop = self.make_stop(address='Lyme, NH')
+        self.make_stop(address='Atlantis')
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('geocode_stops', stdout=stdout, stderr=stderr)
+        stop.refresh_from_db()
+        self.assertEqual(stop.lat_lng, '43.8098,-72.1559')
+        self.assertIn('Geocoded 1 stops', stdout.getvalue())
+        self.assertIn('Could not geocode 1 stops', stderr.getvalue())
+
+
+class TransportConfigCacheTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_transport_config()
+
+    def test_cached(self):
+        with self.assertNumQueries(1):
+            hanover = Hanover(self.trips_year)
+            lodge = Lodge(self.trips_year)
+        with self.assertNumQueries(0):
+            self.assertEqual(Hanover(self.trips_year), hanover)
+            self.assertEqual(Lodge(self.trips_year.pk), lodge)
+        self.assertEqual(hanover, self.transport_config.hanover)
+        self.assertEqual(lodge, self.transport_config.lodge)
+
+    def test_returns_new_instances(self):
+        hanover = Hanover(self.trips_year)
+        hanover.trips_dropped_off = []
+        self.assertIsNot(Hanover(self.trips_year), hanover)
+        self.assertFalse(hasattr(Hanover(self.trips_year), 'trips_dropped_off'))
+
+    def test_invalidated_by_config_changes(self):
+        Hanover(self.trips_year)
+        stop = mommy.make(Stop, trips_year=self.trips_year)
+        self.transport_config.hanover = stop
+        self.transport_config.save()
+        self.assertEqual(Hanover(self.trips_year), stop)
+
+    def test_invalidated_by_stop_changes(self):
+        hanover = Hanover(self.trips_year)
+        hanover.address = 'Somewhere new'
+        hanover.save()
+        self.assertEqual(Hanover(self.trips_year).address, 'Somewhere new')
+
+    def test_expires(self):
+        Hanover(self.trips_year)
+        TransportConfig.objects.filter(pk=self.transport_config.pk).update(
+            hanover=mommy.make(Stop, trips_year=self.trips_year)
+        )
+        with self.assertNumQueries(0):
+            Hanover(self.trips_year)
+
+        later = float('inf')
+        with unittest.mock.patch(
+            'fyt.transport.models.time.monotonic', return_value=later
+        ):
+            self.assertNotEqual(Hanover(self.trips_year), self.transport_config.hanover)
+
+
+class OptimizerTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_transport_config()
+        self.section = mommy.make(
+            Section, trips_year=self.trips_year, leaders_arrive=date(2015, 1, 1)
+        )
+        self.external = mommy.make(
+            Route, trips_year=self.trips_year, category=Route.EXTERNAL
+        )
+
+    def make_route(self, capacity):
+        return mommy.make(
+            Route,
+            trips_year=self.trips_year,
+            category=Route.INTERNAL,
+            vehicle__capacity=capacity,
+        )
+
+    def make_trip(self, route, lat_lng, size, **kwargs):
+        stop = mommy.make(
+            Stop,
+            trips_year=self.trips_year,
+            route=route,
+            lat_lng=lat_lng,
+            distance=10,
+        )
+        trip = mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            section=self.section,
+            template__dropoff_stop=stop,
+            template__pickup_stop__route=None,
+            template__return_route=self.external,
+            **kwargs,
+        )
+        mommy.make(
+            IncomingStudent, size, trips_year=self.trips_year, trip_assignment=trip
+        )
+        return trip
+
+    def test_merges_buses_under_capacity(self):
+        route1 = self.make_route(10)
+        route2 = self.make_route(10)
+        self.make_trip(route1, '43.8,-72.1', 2)
+        self.make_trip(route2, '43.81,-72.1', 2)
+
+        optimizer = Optimizer(self.trips_year)
+        self.assertEqual(optimizer.initial_cost.buses, 2)
+
+        cost = optimizer.solve()
+        self.assertEqual(cost.buses, 1)
+        self.assertEqual(cost.excess, 0)
+        self.assertLess(cost.miles, optimizer.initial_cost.miles)
+        self.assertEqual(len(set(ride.route for ride in optimizer.rides)), 1)
+
+    def test_splits_bus_over_capacity(self):
+        route1 = self.make_route(3)
+        route2 = self.make_route(3)
+        self.make_trip(route1, '43.8,-72.1', 2)
+        self.make_trip(route1, '43.81,-72.1', 2)
+
+        optimizer = Optimizer(self.trips_year)
+        self.assertEqual(optimizer.initial_cost.excess, 1)
+
+        cost = optimizer.solve()
+        self.assertEqual(cost.excess, 0)
+        self.assertEqual(cost.buses, 2)
+        self.assertEqual(
+            set(ride.route for ride in optimizer.rides), set([route1, route2])
+        )
+
+    def test_does_not_merge_over_capacity(self):
+        route1 = self.make_route(3)
+        route2 = self.make_route(3)
+        self.make_trip(route1, '43.8,-72.1', 2)
+        self.make_trip(route2, '43.81,-72.1', 2)
+
+        optimizer = Optimizer(self.trips_year)
+        self.assertEqual(optimizer.solve(), optimizer.initial_cost)
+
+    def test_returns_count_against_capacity(self):
+        route = self.make_route(3)
+        trip = self.make_trip(route, '43.8,-72.1', 1, return_route=route)
+        mommy.make(IncomingStudent, 3, trips_year=self.trips_year, trip_assignment=trip)
+
+        cost = Optimizer(self.trips_year).cost()
+        self.assertEqual(cost.buses, 2)
+        self.assertEqual(cost.excess, 1 + 1)
+
+    def test_propose_and_apply(self):
+        route1 = self.make_route(10)
+        route2 = self.make_route(10)
+        trip1 = self.make_trip(route1, '43.8,-72.1', 2)
+        trip2 = self.make_trip(route2, '43.81,-72.1', 2)
+        bus1 = mommy.make(
+            InternalBus, trips_year=self.trips_year, route=route1, date=date(2015, 1, 3)
+        )
+        bus2 = mommy.make(
+            InternalBus, trips_year=self.trips_year, route=route2, date=date(2015, 1, 3)
+        )
+
+        RouteProposal.objects.propose(self.trips_year)
+        self.assertEqual(RouteProposal.objects.count(), 2)
+
+        diff = RouteProposal.objects.diff(self.trips_year)
+        self.assertEqual(len(diff.changes), 1)
+        self.assertEqual(diff.new_buses, [])
+        self.assertEqual(len(diff.unused_buses), 1)
+
+        change = diff.changes[0]
+        used, unused = (bus2, bus1) if change.route == route2 else (bus1, bus2)
+        self.assertEqual(diff.unused_buses, [unused])
+
+        RouteProposal.objects.apply(self.trips_year)
+        self.assertQsEqual(InternalBus.objects.all(), [used])
+        change.trip.refresh_from_db()
+        self.assertEqual(change.trip.dropoff_route, change.route)
+        self.assertQsEqual(used.dropping_off(), [trip1, trip2])
+        self.assertEqual(
+            set(used.stoporder_set.values_list('trip', flat=True)),
+            set([trip1.pk, trip2.pk]),
+        )
+        self.assertFalse(RouteProposal.objects.diff(self.trips_year))
+
+    def test_apply_keeps_buses_with_notes_or_custom_times(self):
+        route1 = self.make_route(10)
+        route2 = self.make_route(10)
+        self.make_trip(route1, '43.8,-72.1', 2)
+        self.make_trip(route2, '43.81,-72.1', 2)
+        bus1 = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route=route1,
+            date=date(2015, 1, 3),
+            notes='Call the driver',
+        )
+        bus2 = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route=route2,
+            date=date(2015, 1, 3),
+            use_custom_times=True,
+        )
+        # Scheduled by hand, without any trips
+        empty = mommy.make(
+            InternalBus, trips_year=self.trips_year, route=route1, date=date(2015, 1, 4)
+        )
+
+        RouteProposal.objects.propose(self.trips_year)
+        diff = RouteProposal.objects.diff(self.trips_year)
+        self.assertEqual(len(diff.changes), 1)
+        self.assertEqual(diff.unused_buses, [])
+        self.assertEqual(len(diff.kept_buses), 1)
+        self.assertIn(diff.kept_buses[0], [bus1, bus2])
+
+        RouteProposal.objects.apply(self.trips_year)
+        self.assertQsEqual(InternalBus.objects.all(), [bus1, bus2, empty])
+
+    def test_unused_buses_with_custom_stop_times_are_kept(self):
+        route1 = self.make_route(10)
+        route2 = self.make_route(10)
+        trip1 = self.make_trip(route1, '43.8,-72.1', 2)
+        trip2 = self.make_trip(route2, '43.81,-72.1', 2)
+        for route in [route1, route2]:
+            mommy.make(
+                InternalBus,
+                trips_year=self.trips_year,
+                route=route,
+                date=date(2015, 1, 3),
+            )
+        StopOrder.objects.filter(trip__in=[trip1, trip2]).update(custom_time=time(9))
+
+        RouteProposal.objects.propose(self.trips_year)
+        diff = RouteProposal.objects.diff(self.trips_year)
+        self.assertEqual(diff.unused_buses, [])
+        self.assertEqual(len(diff.kept_buses), 1)
+
+    def test_apply_schedules_new_buses(self):
+        route1 = self.make_route(10)
+        route2 = self.make_route(10)
+        trip = self.make_trip(route1, '43.8,-72.1', 2)
+        mommy.make(
+            RouteProposal,
+            trips_year=self.trips_year,
+            trip=trip,
+            stop_type=RouteProposal.DROPOFF,
+            route=route2,
+        )
+
+        diff = RouteProposal.objects.diff(self.trips_year)
+        self.assertEqual(diff.new_buses, [(route2, date(2015, 1, 3))])
+
+        RouteProposal.objects.apply(self.trips_year)
+        bus = InternalBus.objects.get()
+        self.assertEqual(bus.route, route2)
+        self.assertEqual(bus.stoporder_set.get().trip, trip)
+
+    def test_apply_default_route_clears_override(self):
+        route1 = self.make_route(10)
+        route2 = self.make_route(10)
+        trip = self.make_trip(route1, '43.8,-72.1', 2, dropoff_route=route2)
+        mommy.make(
+            RouteProposal,
+            trips_year=self.trips_year,
+            trip=trip,
+            stop_type=RouteProposal.DROPOFF,
+            route=route1,
+        )
+
+        RouteProposal.objects.apply(self.trips_year)
+        trip.refresh_from_db()
+        self.assertIsNone(trip.dropoff_route)
+
+    def test_command(self):
+        route1 = self.make_route(10)
+        route2 = self.make_route(10)
+        self.make_trip(route1, '43.8,-72.1', 2)
+        self.make_trip(route2, '43.81,-72.1', 2)
+
+        out = io.StringIO()
+        call_command('optimize_routes', stdout=out)
+        self.assertIn('Before: 2 buses', out.getvalue())
+        self.assertIn('After: 1 buses', out.getvalue())
+        self.assertEqual(InternalBus.objects.count(), 0)
+
+        mommy.make(
+            InternalBus, trips_year=self.trips_year, route=route1, date=date(2015, 1, 3)
+        )
+        mommy.make(
+            InternalBus, trips_year=self.trips_year, route=route2, date=date(2015, 1, 3)
+        )
+        out = io.StringIO()
+        call_command('optimize_routes', '--apply', stdout=out)
+        self.assertEqual(InternalBus.objects.count(), 1)
+        self.assertIn('Remove bus:', out.getvalue())
+        self.assertIn('Applied 1 route changes', out.getvalue())
+
+
+class StopOrderingTestCase(TransportTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.init_transport_config()
+        self.section = mommy.make(
+            Section, trips_year=self.trips_year, leaders_arrive=date(2015, 1, 1)
+        )
+        self.route = mommy.make(
+            Route,
+            trips_year=self.trips_year,
+            category=Route.INTERNAL,
+            vehicle__capacity=10,
+        )
+        self.external = mommy.make(
+            Route, trips_year=self.trips_year, category=Route.EXTERNAL
+        )
+
+    def make_trip(self, lat_lng, distance, size=1, section=None, pickup=False):
+        stop = mommy.make(
+            Stop,
+            trips_year=self.trips_year,
+            route=self.route,
+            lat_lng=lat_lng,
+            distance=distance,
+        )
+        if pickup:
+            stops = {
+                'template__pickup_stop': stop,
+                'template__dropoff_stop__route': None,
+            }
+        else:
+            stops = {
+                'template__dropoff_stop': stop,
+                'template__pickup_stop__route': None,
+            }
+        trip = mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            section=section or self.section,
+            template__return_route=self.external,
+            **stops,
+        )
+        mommy.make(
+            IncomingStudent, size, trips_year=self.trips_year, trip_assignment=trip
+        )
+        return trip
+
+    def make_bus(self):
+        bus = mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route=self.route,
+            date=date(2015, 1, 3),
+        )
+        InternalBus.objects.filter(pk=bus.pk).update(dirty=False)
+        return bus
+
+    def stop_order(self, bus):
+        return [stoporder.trip for stoporder in bus.stoporder_set.all()]
+
+    def make_zig_zag(self):
+        # The rough distances zig-zag across the actual locations
+        trip1 = self.make_trip('43.75,-72.2', 30)
+        trip2 = self.make_trip('43.85,-72.05', 10)
+        trip3 = self.make_trip('43.8,-72.12', 20)
+        return trip1, trip2, trip3
+
+    def test_order_stops(self):
+        def cost(a, b):
+            return abs(a - b)
+
+        self.assertEqual(order_stops([5, 1, 4, 2, 3], 0, cost=cost), [1, 2, 3, 4, 5])
+        self.assertEqual(order_stops([5, 1, 4, 2, 3], 0, 6, cost), [1, 2, 3, 4, 5])
+        self.assertEqual(order_stops([-3, 5, 2], 0, 10, cost), [-3, 2, 5])
+        self.assertEqual(order_stops([1, 2], 3, cost=cost), [2, 1])
+        self.assertEqual(order_stops([], 0, cost=cost), [])
+
+    def test_order_stops_skips_infeasible_orders(self):
+        def cost(a, b):
+            return abs(a - b)
+
+        def feasible(order):
+            return order[0] == 3
+
+        self.assertEqual(
+            order_stops([3, 1, 2], 0, cost=cost, feasible=feasible), [3, 2, 1]
+        )
+        # Unless the passed order is infeasible
+        self.assertEqual(
+            order_stops([2, 1, 3], 0, cost=cost, feasible=feasible), [1, 2, 3]
+        )
+
+    def test_optimize_stop_order(self):
+        trip1, trip2, trip3 = self.make_zig_zag()
+        bus = self.make_bus()
+        self.assertEqual(self.stop_order(bus), [trip2, trip3, trip1])
+
+        self.assertTrue(bus.optimize_stop_order())
+        self.assertEqual(self.stop_order(bus), [trip1, trip3, trip2])
+        bus.refresh_from_db()
+        self.assertTrue(bus.dirty)
+
+        self.assertFalse(bus.optimize_stop_order())
+
+    def test_optimize_stop_order_respects_capacity(self):
+        # Picking up first is faster, but overloads the bus
+        dropoff = self.make_trip('43.96,-71.83', 1, size=3)
+        pickup = self.make_trip(
+            '43.71,-72.28',
+            50,
+            size=2,
+            section=mommy.make(
+                Section, trips_year=self.trips_year, leaders_arrive=date(2014, 12, 30)
+            ),
+            pickup=True,
+        )
+        bus = self.make_bus()
+        self.assertEqual(self.stop_order(bus), [dropoff, pickup])
+
+        self.route.vehicle.capacity = 3
+        self.route.vehicle.save()
+        self.assertFalse(bus.optimize_stop_order())
+
+        self.route.vehicle.capacity = 5
+        self.route.vehicle.save()
+        bus = InternalBus.objects.get(pk=bus.pk)
+        self.assertTrue(bus.optimize_stop_order())
+        self.assertEqual(self.stop_order(bus), [pickup, dropoff])
+
+    def test_optimize_stop_orders_command(self):
+        trip1, trip2, trip3 = self.make_zig_zag()
+        bus = self.make_bus()
+        mommy.make(
+            InternalBus,
+            trips_year=self.trips_year,
+            route=self.route,
+            date=date(2015, 1, 4),
+            use_custom_times=True,
+        )
+
+        out = io.StringIO()
+        call_command('optimize_stop_orders', stdout=out)
+        self.assertIn('Reordered 1 buses', out.getvalue())
+        self.assertEqual(self.stop_order(bus), [trip1, trip3, trip2])
+
+    def test_optimize_order_view(self):
+        trip1, trip2, trip3 = self.make_zig_zag()
+        bus = self.make_bus()
+
+        url = reverse(
+            'core:internalbus:order',
+            kwargs={'trips_year': self.trips_year, 'bus_pk': bus.pk},
+        )
+        resp = self.app.get(url, user=self.make_director())
+        resp = resp.forms[0].submit('optimize').follow()
+        self.assertContains(resp, 'Stops have been reordered')
+        self.assertEqual(self.stop_order(bus), [trip1, trip3, trip2])
+
+    def test_external_bus_stops_are_optimized(self):
+        section = mommy.make(Section, trips_year=self.trips_year, is_local=True)
+        stops = [
+            mommy.make(
+                Stop,
+                trips_year=self.trips_year,
+                route=self.external,
+                lat_lng=lat_lng,
+                distance=distance,
+            )
+            for lat_lng, distance in [
+                ('43.75,-72.2', 30),
+                ('43.85,-72.05', 10),
+                ('43.8,-72.12', 20),
+            ]
+        ]
+        for stop in stops:
+            mommy.make(
+                IncomingStudent,
+                trips_year=self.trips_year,
+                bus_assignment_round_trip=stop,
+                trip_assignment__section=section,
+            )
+        bus = mommy.make(
+            ExternalBus,
+            trips_year=self.trips_year,
+            route=self.external,
+            section=section,
+        )
+        hanover = Hanover(self.trips_year)
+        self.assertEqual(
+            bus.get_stops_from_hanover(), [hanover, stops[0], stops[2], stops[1]]
+        )
+        self.assertEqual(
+            bus.get_stops_to_hanover(), [stops[1], stops[2], stops[0], hanover]
+        )
+
+
+class BenchmarkTestCase(FytTestCase):
+    config = {
+        'sections': 3,
+        'templates': 2,
+        'stops': 3,
+        'routes': 2,
+        'external_routes': 1,
+        'trippees': 2,
+    }
+
+    def test_report(self):
+        report = run_benchmarks(repeat=1, **self.config)
+        self.assertEqual(report['config'], dict(self.config, repeat=1))
+        self.assertIn('InternalBusMatrix', report['results'])
+        self.assertIn('InternalBusPacket (stored)', report['results'])
+        self.assertIn('change Stop.route', report['results'])
+        for result in report['results'].values():
+            self.assertEqual(len(result['seconds']), 1)
+            self.assertEqual(len(result['queries']), 1)
+
+    def test_synthetic_year_is_rolled_back(self):
+        run_benchmarks(repeat=1, **self.config)
+        self.assertFalse(TripsYear.objects.exists())
+        self.assertFalse(Trip.objects.exists())
+        self.assertFalse(InternalBus.objects.exists())
+
+    def test_command_writes_report(self):
+        output = io.StringIO()
+        path = os.path.join(tempfile.mkdtemp(), 'report.json')
+        call_command(
+            'benchmark_transport',
+            '--sections=3',
+            '--templates=2',
+            '--stops=3',
+            '--repeat=1',
+            f'--output={path}',
+            stdout=output,
+        )
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(report['config']['sections'], 3)
+        self.assertIn('ExternalBusMatrix', output.getvalue())
+
+
 class LatLngTestCase(FytTestCase):
     def test_formatting(self):
         pairs = [
@@ -5,7 +5,8 @@ from fyt.transport.views import *
 
 
 transportconfig_urlpatterns = [
-    url(r'^settings/$', UpdateTransportConfig.as_view(), name='settings')
+    url(r'^settings/$', UpdateTransportConfig.as_view(), name='settings'),
+    url(r'^maps-usage/$', MapsUsageView.as_view(), name='maps_usage'),
 ]
 
 internalbus_urlpatterns = [
@@ -1,11 +1,16 @@
 from collections import defaultdict, namedtuple
 from datetime import datetime
+from itertools import groupby
 
 from braces.views import FormValidMessageMixin
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.staticfiles.storage import staticfiles_storage
 from django.core.exceptions import ValidationError
-from django.http import HttpResponseRedirect
+from django.http import FileResponse, HttpRequest, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
-from django.urls import reverse
+from django.urls import resolve, reverse
+from django.utils import timezone
 from django.utils.functional import cached_property
 from raven.contrib.django.raven_compat.models import client as sentry
 from vanilla.views import FormView, TemplateView
@@ -23,23 +28,28 @@ from fyt.incoming.models import IncomingStudent
 from fyt.permissions.views import (
     DatabaseEditPermissionRequired,
     DatabaseReadPermissionRequired,
+    SettingsPermissionRequired,
 )
 from fyt.transport.forms import StopOrderFormset
+from fyt.transport.maps import LATENCY_BUCKETS, MapError, prefetch_directions
 from fyt.transport.models import (
     ExternalBus,
     Hanover,
     InternalBus,
+    LazyDistanceMatrix,
     Lodge,
+    MapsUsage,
     Route,
     Stop,
     StopOrder,
+    StoredPacket,
     TransportConfig,
     Vehicle,
 )
 from fyt.trips.models import Section, Trip, TripTemplate
 from fyt.trips.views import _SectionMixin
 from fyt.utils.matrix import OrderedMatrix
-from fyt.utils.views import PopulateMixin
+from fyt.utils.views import ExtraContextMixin, PopulateMixin
 
 
 NOT_SCHEDULED = 'NOT_SCHEDULED'
@@ -65,21 +75,7 @@ def get_internal_route_matrix(trips_year):
     A matrix of all the scheduled internal buses, categorized by date and by
     route.
     """
-    routes = Route.objects.internal(trips_year).select_related('vehicle')
-    dates = Section.dates.trip_dates(trips_year)
-    matrix = OrderedMatrix(routes, dates)
-    scheduled = (
-        InternalBus.objects.internal(trips_year)
-        .select_related('route__vehicle')
-        .prefetch_related('stoporder_set')
-    )
-
-    preload_transported_trips(scheduled, trips_year)
-
-    for bus in scheduled:
-        matrix[bus.route][bus.date] = bus
-
-    return matrix
+    return InternalBusSchedule(trips_year).buses
 
 
 def preload_transported_trips(buses, trips_year):
@@ -103,6 +99,7 @@ def preload_transported_trips(buses, trips_year):
 
     hanover = Hanover(trips_year)
     lodge = Lodge(trips_year)
+    matrix = LazyDistanceMatrix(trips_year)
 
     for bus in buses:
         bus.trip_cache = InternalBus.TripCache(
@@ -113,6 +110,60 @@ def preload_transported_trips(buses, trips_year):
             hanover,
             lodge,
         )
+        bus.distance_matrix = matrix
+
+    return buses
+
+
+def preload_external_passengers(buses, trips_year):
+    """
+    Load the passengers of many external buses at once.
+
+    All passengers in the sections of the buses are loaded with a single
+    query, with their registrations, and sorted onto each bus. Hanover and
+    the distance matrix are
+    shared by all buses, so computing directions does not query them again
+    for each bus.
+    """
+    if not buses:
+        return buses
+
+    passengers = IncomingStudent.objects.filter(
+        trips_year=trips_year,
+        trip_assignment__section__in=set(bus.section_id for bus in buses),
+    ).select_related(
+        'registration',
+        'trip_assignment',
+        'bus_assignment_round_trip',
+        'bus_assignment_to_hanover',
+        'bus_assignment_from_hanover',
+    )
+
+    to_hanover = defaultdict(list)
+    from_hanover = defaultdict(list)
+    for passenger in passengers:
+        section = passenger.trip_assignment.section_id
+        stop = passenger.get_bus_to_hanover()
+        if stop is not None:
+            to_hanover[stop.route_id, section].append(passenger)
+        stop = passenger.get_bus_from_hanover()
+        if stop is not None:
+            from_hanover[stop.route_id, section].append(passenger)
+
+    hanover = Hanover(trips_year)
+    matrix = LazyDistanceMatrix(trips_year)
+
+    for bus in buses:
+        bus.passengers_to_hanover = sorted(
+            to_hanover[bus.route_id, bus.section_id],
+            key=lambda x: x.get_bus_to_hanover().distance,
+        )
+        bus.passengers_from_hanover = sorted(
+            from_hanover[bus.route_id, bus.section_id],
+            key=lambda x: x.get_bus_from_hanover().distance,
+        )
+        bus.hanover = hanover
+        bus.distance_matrix = matrix
 
     return buses
 
@@ -201,56 +252,141 @@ def get_internal_rider_matrix(trips_year):
     """
     Compute which trips are riding on each route every day.
     """
-    routes = Route.objects.internal(trips_year).select_related('vehicle')
-    dates = Section.dates.trip_dates(trips_year)
-    trips = Trip.objects.with_counts(trips_year).select_related(
-        'template',
-        'section',
-        'pickup_route',
-        'dropoff_route',
-        'return_route',
-        'template__dropoff_stop__route',
-        'template__pickup_stop__route',
-        'template__return_route',
-    )
-    matrix = OrderedMatrix(routes, dates, lambda: Riders())
+    return InternalBusSchedule(trips_year).riders
 
-    for trip in trips:
-        # dropoff
-        if trip.get_dropoff_route():
-            matrix[trip.get_dropoff_route()][trip.dropoff_date] += Riders(
-                dropping_off=[trip]
-            )
-        # pickup
-        if trip.get_pickup_route():
-            matrix[trip.get_pickup_route()][trip.pickup_date] += Riders(
-                picking_up=[trip]
-            )
-        # return
-        matrix[trip.get_return_route()][trip.return_date] += Riders(returning=[trip])
 
-    return matrix
+def total_size(trips):
+    return sum(trip.size for trip in trips)
+
 
+class InternalBusSchedule:
+    """
+    The internal bus schedule for a trips year.
 
-def get_internal_issues_matrix(transport_matrix, riders_matrix):
-    assert len(transport_matrix.keys()) == len(riders_matrix.keys())
+    The trips and StopOrders of the year are loaded once, and all of the
+    following are computed from them in a single pass:
 
-    matrix = riders_matrix.map(lambda x: None)  # new matrix w/ null entries
+        buses   matrix[route][date] of scheduled InternalBuses
+        riders  matrix[route][date] of Riders
+        loads   dict mapping each bus to a list of (stop, load) tuples, the
+                number of passengers on the bus as it leaves each stop
+        issues  matrix[route][date] of NOT_SCHEDULED, EXCEEDS_CAPACITY,
+                or None
 
-    for route, dates in matrix.items():
-        for date in dates:
-            transport = transport_matrix[route][date]
-            riders = riders_matrix[route][date]
-            if riders and not transport:
-                matrix[route][date] = NOT_SCHEDULED
-            elif transport and transport.over_capacity():
-                matrix[route][date] = EXCEEDS_CAPACITY
+    The number of queries is constant, and the time taken is linear in the
+    number of trips and buses.
+    """
 
-    return matrix
+    def __init__(self, trips_year):
+        routes = Route.objects.internal(trips_year).select_related('vehicle')
+        dates = Section.dates.trip_dates(trips_year)
 
+        self.buses = OrderedMatrix(routes, dates)
+        self.riders = OrderedMatrix(routes, dates, lambda: Riders())
+        self.issues = OrderedMatrix(routes, dates)
+        self.loads = {}
 
-def total_size(trips):
-    return sum(trip.size for trip in trips)
+        buses = InternalBus.objects.internal(trips_year).select_related(
+            'route__vehicle'
+        )
+        for bus in buses:
+            self.buses[bus.route][bus.date] = bus
+
+        trips = Trip.objects.with_counts(trips_year).select_related(
+            'template__dropoff_stop', 'template__pickup_stop', 'section'
+        )
+        trips = {trip.pk: trip for trip in trips}
+
+        routes = {route.pk: route for route in routes}
+        for trip in trips.values():
+            rides = [
+                (
+                    trip.dropoff_route_id or trip.template.dropoff_stop.route_id,
+                    trip.dropoff_date,
+                    'dropping_off',
+                ),
+                (
+                    trip.pickup_route_id or trip.template.pickup_stop.route_id,
+                    trip.pickup_date,
+                    'picking_up',
+                ),
+                (
+                    trip.return_route_id or trip.template.return_route_id,
+                    trip.return_date,
+                    'returning',
+                ),
+            ]
+            for route_pk, date, riding in rides:
+                if route_pk in routes:
+                    getattr(self.riders[routes[route_pk]][date], riding).add(trip)
+
+        stoporders = defaultdict(list)
+        values = StopOrder.objects.filter(trips_year=trips_year).values_list(
+            'bus', 'trip', 'stop_type'
+        )
+        for bus_pk, trip_pk, stop_type in values:
+            stoporders[bus_pk].append((trips[trip_pk], stop_type))
+
+        if buses:
+            hanover = Hanover(trips_year)
+            lodge = Lodge(trips_year)
+
+        for bus in buses:
+            riders = self.riders[bus.route][bus.date]
+            self.loads[bus] = self._loads(riders, stoporders[bus.pk], hanover, lodge)
+
+        for route, dates in self.issues.items():
+            for date in dates:
+                bus = self.buses[route][date]
+                if self.riders[route][date] and not bus:
+                    self.issues[route][date] = NOT_SCHEDULED
+                elif bus and self.over_capacity(bus):
+                    self.issues[route][date] = EXCEEDS_CAPACITY
+
+    @staticmethod
+    def _loads(riders, stoporders, hanover, lodge):
+        """
+        Follow the route of a bus, in the same way as `InternalBus.all_stops`.
+        """
+        loads = []
+        load = 0
+
+        def visit(stop, picked_up, dropped_off):
+            nonlocal load
+            load += total_size(picked_up) - total_size(dropped_off)
+            loads.append((stop, load))
+
+        def get_stop(stoporder):
+            trip, stop_type = stoporder
+            if stop_type == StopOrder.DROPOFF:
+                return trip.template.dropoff_stop
+            return trip.template.pickup_stop
+
+        # All buses start from Hanover
+        visit(hanover, riders.dropping_off, [])
+
+        for stop, orders in groupby(stoporders, get_stop):
+            orders = list(orders)
+            visit(
+                stop,
+                [trip for trip, stop_type in orders if stop_type == StopOrder.PICKUP],
+                [trip for trip, stop_type in orders if stop_type == StopOrder.DROPOFF],
+            )
+
+        if riders.picking_up or riders.returning:
+            visit(lodge, riders.returning, riders.picking_up)
+
+        if riders.returning:
+            visit(hanover, [], riders.returning)
+
+        return loads
+
+    def over_capacity(self, bus):
+        """
+        Is the bus too full at some point on its route?
+        """
+        capacity = bus.route.vehicle.capacity
+        return any(load > capacity for _, load in self.loads[bus])
 
 
 class InternalBusMatrix(DatabaseReadPermissionRequired, TripsYearMixin, TemplateView):
@@ -258,9 +394,10 @@ class InternalBusMatrix(DatabaseReadPermissionRequired, TripsYearMixin, Template
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['matrix'] = matrix = get_internal_route_matrix(self.trips_year)
-        context['riders'] = riders = get_internal_rider_matrix(self.trips_year)
-        context['issues'] = get_internal_issues_matrix(matrix, riders)
+        schedule = InternalBusSchedule(self.trips_year)
+        context['matrix'] = schedule.buses
+        context['riders'] = riders = schedule.riders
+        context['issues'] = schedule.issues
         context['NOT_SCHEDULED'] = NOT_SCHEDULED
         context['EXCEEDS_CAPACITY'] = EXCEEDS_CAPACITY
 
@@ -325,6 +462,29 @@ class ExternalBusMatrix(DatabaseTemplateView):
         }
 
 
+class MapsUsageView(
+    SettingsPermissionRequired, ExtraContextMixin, TripsYearMixin, TemplateView
+):
+    """
+    Google Maps requests, failures, latency and cache hits for each day.
+    """
+
+    template_name = 'transport/maps_usage.html'
+
+    def extra_context(self):
+        days = []
+        usage = MapsUsage.objects.recent()
+        for date, apis in groupby(usage, key=lambda x: x.date):
+            apis = list(apis)
+            days.append((date, apis, sum(x.requests for x in apis)))
+
+        return {
+            'days': days,
+            'daily_quota': settings.MAPS_DAILY_QUOTA,
+            'latency_buckets': LATENCY_BUCKETS,
+        }
+
+
 class StopListView(DatabaseListView):
     model = Stop
     context_object_name = 'stops'
@@ -339,7 +499,20 @@ class StopListView(DatabaseListView):
         )
 
 
-class StopCreateView(DatabaseCreateView):
+class GeocodeStopMixin:
+    """
+    Look up the coordinates of the address when a stop is saved.
+    """
+
+    def form_valid(self, form):
+        try:
+            form.instance.geocode()
+        except MapError as exc:
+            messages.warning(self.request, str(exc))
+        return super().form_valid(form)
+
+
+class StopCreateView(GeocodeStopMixin, DatabaseCreateView):
     model = Stop
 
 
@@ -361,7 +534,7 @@ class StopDetailView(DatabaseDetailView):
     ]
 
 
-class StopUpdateView(DatabaseUpdateView):
+class StopUpdateView(GeocodeStopMixin, DatabaseUpdateView):
     model = Stop
 
 
@@ -521,6 +694,15 @@ class OrderStops(
     def get_form(self, **kwargs):
         return StopOrderFormset(queryset=self.get_queryset(), **kwargs)
 
+    def post(self, request, *args, **kwargs):
+        if 'optimize' in request.POST:
+            if self.bus.optimize_stop_order():
+                messages.success(request, 'Stops have been reordered')
+            else:
+                messages.info(request, 'Stops are already in the best order')
+            return HttpResponseRedirect(self.get_success_url())
+        return super().post(request, *args, **kwargs)
+
     def form_valid(self, formset):
         formset.save()
         return HttpResponseRedirect(self.get_success_url())
@@ -570,7 +752,71 @@ class InternalTransportByDate(DatabaseTemplateView):
         }
 
 
-class InternalBusPacket(DatabaseListView):
+class StoredPacketMixin:
+    """
+    Serve a packet which was rendered ahead of time.
+
+    The packet is rendered and stored again if the fingerprint of its
+    buses and passengers has changed.
+    """
+
+    def fingerprint_inputs(self):
+        """
+        Return the querysets of the buses and passengers in the packet,
+        which the fingerprint is computed from.
+
+        Subclasses must implement this. Stops and the TransportConfig are
+        always included.
+        """
+        raise NotImplementedError
+
+    def get_fingerprint(self):
+        stops = Stop.objects.filter(trips_year=self.trips_year).values_list(
+            'pk',
+            'name',
+            'address',
+            'lat_lng',
+            'directions',
+            'route_id',
+            'distance',
+            'pickup_time',
+            'dropoff_time',
+        )
+        config = TransportConfig.objects.filter(trips_year=self.trips_year).values_list(
+            'pk', 'hanover_id', 'lodge_id'
+        )
+        # Stored packets link to the static files of the deploy they were
+        # rendered with
+        static = [staticfiles_storage.url(x) for x in ['base.css', 'base.js']]
+
+        return StoredPacket.objects.fingerprint(
+            stops, config, *self.fingerprint_inputs(), version=' '.join(static)
+        )
+
+    def get_packet(self):
+        """
+        Return the stored packet, rendering it first if it is out of date.
+        """
+        fingerprint = self.get_fingerprint()
+        packet = StoredPacket.objects.fresh(
+            self.trips_year, self.request.path, fingerprint
+        )
+        if packet is None:
+            response = super().get(self.request, *self.args, **self.kwargs)
+            response.render()
+            packet = StoredPacket.objects.store(
+                self.trips_year, self.request.path, fingerprint, response.content
+            )
+        return packet
+
+    def get(self, request, *args, **kwargs):
+        packet = self.get_packet()
+        return FileResponse(
+            packet.html.open('rb'), content_type='text/html; charset=utf-8'
+        )
+
+
+class InternalBusPacket(StoredPacketMixin, DatabaseListView):
     """
     Directions and notes for all internal buses.
     """
@@ -586,9 +832,52 @@ class InternalBusPacket(DatabaseListView):
         return qs
 
     def get_queryset(self):
-        qs = super().get_queryset()
+        qs = super().get_queryset().prefetch_related('stoporder_set')
         qs = self.modify_queryset(qs)
-        return preload_transported_trips(qs, self.trips_year)
+        buses = preload_transported_trips(qs, self.trips_year)
+
+        # Request directions for all buses at once, before rendering
+        prefetch_directions([bus.all_stops for bus in buses])
+
+        return buses
+
+    def fingerprint_inputs(self):
+        buses = self.modify_queryset(super().get_queryset())
+        trips = Trip.objects.filter(trips_year=self.trips_year)
+        return [
+            buses.values_list(
+                'pk',
+                'route_id',
+                'route__name',
+                'route__vehicle_id',
+                'route__vehicle__capacity',
+                'date',
+                'notes',
+                'dirty',
+                'use_custom_times',
+            ),
+            StopOrder.objects.filter(bus__in=buses).values_list(
+                'pk',
+                'bus_id',
+                'trip_id',
+                'stop_type',
+                'order',
+                'custom_time',
+                'computed_time',
+            ),
+            trips.values_list(
+                'pk',
+                'template_id',
+                'template__name',
+                'section_id',
+                'section__name',
+                'dropoff_route_id',
+                'pickup_route_id',
+                'return_route_id',
+                'num_trippees',
+                'num_leaders',
+            ),
+        ]
 
 
 class InternalBusPacketForDate(_DateMixin, InternalBusPacket):
@@ -612,8 +901,9 @@ class InternalBusPacketForBusCompany(InternalBusPacket):
         return qs.filter(route__vehicle__chartered=True)
 
 
-class ExternalBusPacket(DatabaseListView):
+class ExternalBusPacket(StoredPacketMixin, DatabaseListView):
     """
+    Directions and passengers for all external buses.
     """
 
     model = ExternalBus
@@ -624,11 +914,25 @@ class ExternalBusPacket(DatabaseListView):
 
     def get_queryset(self):
         qs = super().get_queryset()
-        return qs.select_related('section', 'route')
+        return qs.select_related('section', 'route__vehicle')
+
+    @cached_property
+    def buses(self):
+        buses = preload_external_passengers(self.get_queryset(), self.trips_year)
+
+        # Request directions for all buses at once, before rendering, so
+        # that the packet has turn-by-turn directions instead of the
+        # estimates in the distance matrix.
+        prefetch_directions(
+            [bus.get_stops_to_hanover() for bus in buses]
+            + [bus.get_stops_from_hanover() for bus in buses]
+        )
+
+        return buses
 
     def get_bus_list(self):
         bus_list = []
-        for bus in self.get_queryset():
+        for bus in self.buses:
             bus_list += [self.to_hanover_tuple(bus), self.from_hanover_tuple(bus)]
         return bus_list
 
@@ -638,6 +942,35 @@ class ExternalBusPacket(DatabaseListView):
         key = lambda x: (x[0], x[2].route.name, order[x[1]])
         return {'bus_list': sorted(self.get_bus_list(), key=key)}
 
+    def fingerprint_inputs(self):
+        buses = self.get_queryset()
+        passengers = IncomingStudent.objects.filter(
+            trips_year=self.trips_year,
+            trip_assignment__section__in=buses.values('section'),
+        )
+        return [
+            buses.values_list(
+                'pk',
+                'route_id',
+                'route__name',
+                'route__vehicle_id',
+                'route__vehicle__capacity',
+                'section_id',
+                'section__name',
+                'section__leaders_arrive',
+            ),
+            passengers.values_list(
+                'pk',
+                'name',
+                'phone',
+                'registration__phone',
+                'trip_assignment__section_id',
+                'bus_assignment_round_trip_id',
+                'bus_assignment_to_hanover_id',
+                'bus_assignment_from_hanover_id',
+            ),
+        ]
+
     def to_hanover_tuple(self, bus):
         return (bus.date_to_hanover, self.TO_HANOVER, bus)
 
@@ -652,7 +985,7 @@ class ExternalBusPacketForDate(_DateMixin, ExternalBusPacket):
 
     def get_bus_list(self):
         bus_list = []
-        for bus in self.get_queryset():
+        for bus in self.buses:
             if self.date == bus.date_to_hanover:
                 bus_list.append(self.to_hanover_tuple(bus))
             elif self.date == bus.date_from_hanover:
@@ -668,3 +1001,67 @@ class ExternalBusPacketForDateAndRoute(_RouteMixin, ExternalBusPacketForDate):
     def get_queryset(self):
         qs = super().get_queryset()
         return qs.filter(route=self.route)
+
+
+def packet_urls(trips_year):
+    """
+    The urls of all transport packets in trips_year.
+    """
+    kwargs = {'trips_year': trips_year}
+    urls = [
+        reverse('core:internalbus:packet', kwargs=kwargs),
+        reverse('core:internalbus:packet_for_bus_company', kwargs=kwargs),
+        reverse('core:externalbus:packet', kwargs=kwargs),
+    ]
+
+    dates = InternalBus.objects.filter(trips_year=trips_year).dates('date', 'day')
+    for date in dates:
+        urls.append(
+            reverse('core:internalbus:packet_for_date', kwargs=dict(kwargs, date=date))
+        )
+
+    external = ExternalBus.objects.filter(trips_year=trips_year).select_related(
+        'section'
+    )
+    routes_by_date = defaultdict(set)
+    for bus in external:
+        for date in [bus.date_to_hanover, bus.date_from_hanover]:
+            routes_by_date[date].add(bus.route_id)
+
+    for date, routes in sorted(routes_by_date.items()):
+        urls.append(
+            reverse('core:externalbus:packet_for_date', kwargs=dict(kwargs, date=date))
+        )
+        for route_pk in sorted(routes):
+            urls.append(
+                reverse(
+                    'core:externalbus:packet_for_date_and_route',
+                    kwargs=dict(kwargs, date=date, route_pk=route_pk),
+                )
+            )
+
+    return urls
+
+
+def render_packets(trips_year):
+    """
+    Render and store all packets in trips_year which are out of date, so
+    that downloads don't have to wait for them.
+
+    Returns the packets which were rendered.
+    """
+    started = timezone.now()
+    packets = []
+    for url in packet_urls(trips_year):
+        request = HttpRequest()
+        request.method = 'GET'
+        request.path = url
+
+        match = resolve(url)
+        view = match.func.view_class()
+        view.setup(request, *match.args, **match.kwargs)
+        packet = view.get_packet()
+        if packet.created_at >= started:
+            packets.append(packet)
+
+    return packets
@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class TripsConfig(AppConfig):
+    name = 'fyt.trips'
+
+    def ready(self):
+        # Register signals
+        from . import signals
+
+
+default_app_config = 'fyt.trips.TripsConfig'
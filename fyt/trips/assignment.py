@@ -0,0 +1,609 @@
+import heapq
+import math
+import re
+from collections import defaultdict, namedtuple
+
+from fyt.trips.constants import LEADERS_PER_TRIP
+from fyt.utils.choices import AVAILABLE, FIRST_CHOICE, PREFER
+
+
+"""
+Propose trip assignments for everyone who is not yet on a trip.
+
+Each person can go on the trips of the sections and trip types they are
+available for. Since every trip of a section and trip type is equally good
+for a person, trips are pooled into groups and people are first assigned to
+groups as a min-cost flow: a person is an edge of capacity one to each group
+they can go on, costed by how much they like it, and each group can take as
+many people as its trips have room for. People are then spread over the
+trips of their group, filling the emptiest trips first.
+
+The flow is augmented one person at a time along the cheapest path, which
+may move people who are already placed to other groups to make room. This
+places as many people as possible, and places them as cheaply as possible.
+If there is not room for everyone, people who come first in the order are
+kept; the rest are left unassigned for directors to place by hand.
+"""
+
+# The cost of placing a trippee on a trip of each preference.
+TRIPTYPE_COSTS = {FIRST_CHOICE: 0, PREFER: 2, AVAILABLE: 5}
+SECTION_COSTS = {PREFER: 0, AVAILABLE: 3}
+
+# The cost of placing a leader on a trip of each preference.
+LEADER_TRIPTYPE_COSTS = {PREFER: 0, AVAILABLE: 3}
+LEADER_SECTION_COSTS = {PREFER: 0, AVAILABLE: 3}
+
+
+class MinCostFlow:
+    """
+    A flow network with integer capacities and non-negative costs.
+
+    Flow is pushed one unit at a time with `augment`. Node potentials keep
+    the reduced costs of the residual network non-negative, so each
+    shortest path can be found with Dijkstra's algorithm.
+
+    Flow is only ever pushed from new sources into a single sink. The nodes
+    searched when a source has no path to the sink can never reach it
+    again, so they are skipped by later searches.
+    """
+
+    def __init__(self):
+        self.edges = []  # edge indexes leaving each node
+        self.head = []
+        self.capacity = []
+        self.cost = []
+        self.potential = []
+        self.dead = set()
+
+    def add_node(self):
+        self.edges.append([])
+        self.potential.append(0)
+        return len(self.edges) - 1
+
+    def add_edge(self, u, v, capacity, cost):
+        """
+        Add an edge from u to v, and its reverse residual edge. Returns the
+        index of the edge.
+        """
+        edge = len(self.head)
+        for tail, head, cap, c in [(u, v, capacity, cost), (v, u, 0, -cost)]:
+            self.edges[tail].append(len(self.head))
+            self.head.append(head)
+            self.capacity.append(cap)
+            self.cost.append(c)
+        return edge
+
+    def flow(self, edge):
+        return self.capacity[edge ^ 1]
+
+    def save(self):
+        """
+        Return the current flow, to be put back with `restore`. Nodes and
+        edges can't be added in between.
+        """
+        return list(self.capacity), list(self.potential), set(self.dead)
+
+    def restore(self, state):
+        self.capacity, self.potential, self.dead = state
+
+    def augment(self, source, sink):
+        """
+        Push one unit of flow from source to sink along the cheapest path
+        in the residual network. Returns False if there is no path.
+
+        The source must be a new node which no flow has been pushed into.
+        """
+        potential = self.potential
+        # Nothing flows into the source, so its potential can be raised to
+        # make the reduced costs of its edges non-negative.
+        potential[source] = max(
+            [
+                potential[self.head[edge]] - self.cost[edge]
+                for edge in self.edges[source]
+            ],
+            default=0,
+        )
+        dist = {source: 0}
+        prev = {}
+        done = set()
+        heap = [(0, source)]
+
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u in done:
+                continue
+            done.add(u)
+            if u == sink:
+                break
+            for edge in self.edges[u]:
+                if self.capacity[edge] > 0:
+                    v = self.head[edge]
+                    if v in self.dead:
+                        continue
+                    nd = d + self.cost[edge] + potential[u] - potential[v]
+                    if nd < dist.get(v, math.inf):
+                        dist[v] = nd
+                        prev[v] = edge
+                        heapq.heappush(heap, (nd, v))
+
+        if sink not in done:
+            self.dead |= done
+            return False
+
+        # Nodes which were not reached are given the distance of the sink,
+        # which keeps the reduced costs non-negative without searching the
+        # whole network.
+        bound = dist[sink]
+        for v in range(len(potential)):
+            potential[v] += min(dist.get(v, bound), bound)
+
+        v = sink
+        while v != source:
+            edge = prev[v]
+            self.capacity[edge] -= 1
+            self.capacity[edge ^ 1] += 1
+            v = self.head[edge ^ 1]
+
+        return True
+
+
+def assign(people, options, capacities):
+    """
+    Assign people to groups.
+
+    `people` is a list of people, in the order they should be placed.
+    `options` maps each person to a list of (group, cost) pairs, and
+    `capacities` maps each group to the number of people it can take.
+
+    Returns a dict mapping each person who could be placed to a group.
+    """
+    network = MinCostFlow()
+    sink = network.add_node()
+    groups = {}
+    for group, capacity in capacities.items():
+        if capacity > 0:
+            groups[group] = network.add_node()
+            network.add_edge(groups[group], sink, capacity, 0)
+
+    edges = {}
+    for person in people:
+        node = network.add_node()
+        edges[person] = [
+            (group, network.add_edge(node, groups[group], 1, cost))
+            for group, cost in options[person]
+            if group in groups
+        ]
+        network.augment(node, sink)
+
+    return {
+        person: group
+        for person, choices in edges.items()
+        for group, edge in choices
+        if network.flow(edge)
+    }
+
+
+def fill(placed, trips):
+    """
+    Spread the people placed in each group over the trips of the group.
+
+    `trips` maps each group to a list of (trip, room) pairs. People go to
+    the trip with the most room left. Returns a dict mapping people to trips.
+    """
+    room = {trip: count for group in trips.values() for trip, count in group}
+    assignments = {}
+    for person, group in placed.items():
+        trip = max(trips[group], key=lambda x: room[x[0]])[0]
+        room[trip] -= 1
+        assignments[person] = trip
+    return assignments
+
+
+def preferences(choices, owner, field):
+    """
+    Map each owner to a dict of their preferences, from a queryset of
+    section or trip type choices.
+    """
+    prefs = defaultdict(dict)
+    for owner_pk, pk, preference in choices.values_list(owner, field, 'preference'):
+        prefs[owner_pk][pk] = preference
+    return prefs
+
+
+Placement = namedtuple(
+    'Placement', ['trippee', 'trip', 'triptype_preference', 'section_preference']
+)
+
+
+class TrippeeAssigner:
+    """
+    Propose trips for the registered trippees of trips_year who are not
+    assigned to a trip.
+
+    A trippee can go on a trip if they are available for its section and
+    trip type, can pass the swim test if the trip requires it, and, if they
+    asked for an external bus, every bus they asked for runs in its section.
+    Trips take trippees up to the max_trippees of their template, counting
+    the trippees already on them.
+    """
+
+    def __init__(self, trips_year):
+        from fyt.incoming.models import (
+            IncomingStudent,
+            Registration,
+            RegistrationSectionChoice,
+            RegistrationTripTypeChoice,
+        )
+        from fyt.transport.models import ExternalBus
+        from fyt.trips.models import Trip
+
+        self.trips_year = trips_year
+
+        self.trippees = list(
+            IncomingStudent.objects.filter(
+                trips_year=trips_year,
+                trip_assignment=None,
+                cancelled=False,
+                registration__isnull=False,
+            )
+            .order_by('registration__created_at', 'pk')
+            .values(
+                'pk',
+                'registration',
+                'registration__swimming_ability',
+                'registration__bus_stop_round_trip__route',
+                'registration__bus_stop_to_hanover__route',
+                'registration__bus_stop_from_hanover__route',
+            )
+        )
+        self.non_swimmer = Registration.NON_SWIMMER
+
+        self.section_prefs = preferences(
+            RegistrationSectionChoice.objects.filter(
+                registration__trips_year=trips_year, preference__in=SECTION_COSTS
+            ),
+            'registration',
+            'section',
+        )
+        self.triptype_prefs = preferences(
+            RegistrationTripTypeChoice.objects.filter(
+                registration__trips_year=trips_year, preference__in=TRIPTYPE_COSTS
+            ),
+            'registration',
+            'triptype',
+        )
+
+        self.trips = defaultdict(list)
+        for trip in (
+            Trip.objects.filter(trips_year=trips_year)
+            .order_by('pk')
+            .values(
+                'pk',
+                'section',
+                'num_trippees',
+                'template__triptype',
+                'template__swimtest_required',
+                'template__max_trippees',
+            )
+        ):
+            group = (
+                trip['section'],
+                trip['template__triptype'],
+                trip['template__swimtest_required'],
+            )
+            room = max(trip['template__max_trippees'] - trip['num_trippees'], 0)
+            self.trips[group].append((trip['pk'], room))
+
+        self.bus_routes = defaultdict(set)
+        for section, route in ExternalBus.objects.filter(
+            trips_year=trips_year
+        ).values_list('section', 'route'):
+            self.bus_routes[section].add(route)
+
+        self.placements = []
+        self.unplaced = []
+
+    def options(self, trippee):
+        """
+        The groups of trips the trippee can go on, with their costs.
+        """
+        registration = trippee['registration']
+        non_swimmer = trippee['registration__swimming_ability'] == self.non_swimmer
+        routes = {
+            trippee[f'registration__bus_stop_{direction}__route']
+            for direction in ['round_trip', 'to_hanover', 'from_hanover']
+        } - {None}
+
+        sections = self.section_prefs[registration]
+        triptypes = self.triptype_prefs[registration]
+        return [
+            (
+                group,
+                SECTION_COSTS[sections[section]] + TRIPTYPE_COSTS[triptypes[triptype]],
+            )
+            for group in self.trips
+            for section, triptype, swimtest_required in [group]
+            if section in sections
+            and triptype in triptypes
+            and not (swimtest_required and non_swimmer)
+            and routes <= self.bus_routes[section]
+        ]
+
+    def solve(self):
+        trippees = {trippee['pk']: trippee for trippee in self.trippees}
+        capacities = {
+            group: sum(room for _, room in trips) for group, trips in self.trips.items()
+        }
+        placed = assign(
+            list(trippees),
+            {pk: self.options(trippee) for pk, trippee in trippees.items()},
+            capacities,
+        )
+
+        self.placements = []
+        for pk, trip in fill(placed, self.trips).items():
+            section, triptype, _ = placed[pk]
+            registration = trippees[pk]['registration']
+            self.placements.append(
+                Placement(
+                    pk,
+                    trip,
+                    self.triptype_prefs[registration][triptype],
+                    self.section_prefs[registration][section],
+                )
+            )
+        self.unplaced = [pk for pk in trippees if pk not in placed]
+        return self.placements
+
+
+LeaderPlacement = namedtuple(
+    'LeaderPlacement',
+    ['leader', 'trip', 'triptype_preference', 'section_preference', 'co_leader'],
+)
+
+
+class LeaderAssigner:
+    """
+    Propose trips for the leaders of trips_year who are not assigned to a
+    trip, two leaders to each trip.
+
+    A leader can go on a trip if they prefer or are available for its
+    section and trip type. Leaders with higher average scores are placed
+    first if there are not enough trips for everyone.
+
+    Leaders who name another leader in their co-leader answer are proposed
+    together on an empty trip if there is one they can both lead. Mutual
+    requests are paired before one-sided requests. Pairs are placed in
+    order of their average score, so a pair never takes the place of
+    leaders with higher scores.
+    """
+
+    def __init__(self, trips_year):
+        from fyt.applications.models import (
+            LeaderSectionChoice,
+            LeaderTripTypeChoice,
+            Volunteer,
+        )
+        from fyt.trips.models import Trip
+
+        self.trips_year = trips_year
+
+        self.leaders = list(
+            Volunteer.objects.leaders(trips_year)
+            .filter(trip_assignment=None, leader_supplement__isnull=False)
+            .with_avg_scores()
+            .order_by('-norm_avg_leader_score', 'pk')
+            .values(
+                'pk',
+                'leader_supplement',
+                'leader_supplement__co_leader',
+                'applicant__name',
+                'applicant__netid',
+                'norm_avg_leader_score',
+            )
+        )
+
+        self.section_prefs = preferences(
+            LeaderSectionChoice.objects.filter(
+                application__trips_year=trips_year,
+                preference__in=LEADER_SECTION_COSTS,
+            ),
+            'application',
+            'section',
+        )
+        self.triptype_prefs = preferences(
+            LeaderTripTypeChoice.objects.filter(
+                application__trips_year=trips_year,
+                preference__in=LEADER_TRIPTYPE_COSTS,
+            ),
+            'application',
+            'triptype',
+        )
+
+        self.trips = defaultdict(list)
+        for trip in (
+            Trip.objects.filter(trips_year=trips_year)
+            .order_by('pk')
+            .values('pk', 'section', 'template__triptype', 'num_leaders')
+        ):
+            group = (trip['section'], trip['template__triptype'])
+            room = max(LEADERS_PER_TRIP - trip['num_leaders'], 0)
+            self.trips[group].append((trip['pk'], room))
+
+        self.placements = []
+        self.unplaced = []
+
+    def options(self, leader):
+        """
+        The groups of trips the leader can go on, with their costs.
+        """
+        supplement = leader['leader_supplement']
+        sections = self.section_prefs[supplement]
+        triptypes = self.triptype_prefs[supplement]
+        return {
+            group: LEADER_SECTION_COSTS[sections[section]]
+            + LEADER_TRIPTYPE_COSTS[triptypes[triptype]]
+            for group in self.trips
+            for section, triptype in [group]
+            if section in sections and triptype in triptypes
+        }
+
+    def requests(self):
+        """
+        Map each leader to the leaders named in their co-leader answer,
+        by full name or NetID. Names of a single word are ignored.
+        """
+        patterns = {}
+        for leader in self.leaders:
+            names = [re.escape(leader['applicant__netid'])]
+            if len(leader['applicant__name'].split()) > 1:
+                names.append(
+                    r'\s+'.join(map(re.escape, leader['applicant__name'].split()))
+                )
+            patterns[leader['pk']] = re.compile(
+                r'\b({})\b'.format('|'.join(names)), re.IGNORECASE
+            )
+
+        return {
+            leader['pk']: [
+                pk
+                for pk, pattern in patterns.items()
+                if pk != leader['pk']
+                and pattern.search(leader['leader_supplement__co_leader'])
+            ]
+            for leader in self.leaders
+        }
+
+    def pairs(self):
+        """
+        Pair leaders who asked to lead together. Each leader is in at most
+        one pair.
+        """
+        requests = self.requests()
+        paired = set()
+        pairs = []
+        for mutual in [True, False]:
+            for leader in self.leaders:
+                for other in requests[leader['pk']]:
+                    if (
+                        leader['pk'] not in paired
+                        and other not in paired
+                        and (leader['pk'] in requests[other] or not mutual)
+                    ):
+                        pairs.append((leader['pk'], other))
+                        paired.update([leader['pk'], other])
+        return pairs
+
+    def solve(self):
+        leaders = {leader['pk']: leader for leader in self.leaders}
+        options = {pk: self.options(leader) for pk, leader in leaders.items()}
+        rank = {pk: i for i, pk in enumerate(leaders)}
+        score = {pk: leader['norm_avg_leader_score'] for pk, leader in leaders.items()}
+
+        # Pairs are placed in order of their average score, along with
+        # everyone else. A pair which can't go on an empty trip together is
+        # split up and placed in order of their own scores.
+        pairs = self.pairs()
+        paired = {pk for pair in pairs for pk in pair}
+        queue = [(-score[pk], rank[pk], (pk,)) for pk in leaders if pk not in paired]
+        queue += [
+            ((-score[a] - score[b]) / 2, min(rank[a], rank[b]), (a, b))
+            for a, b in pairs
+        ]
+        heapq.heapify(queue)
+
+        network = MinCostFlow()
+        sink = network.add_node()
+        groups = {}
+        for group, trips in self.trips.items():
+            room = sum(room for _, room in trips)
+            if room > 0:
+                groups[group] = network.add_node()
+                network.add_edge(groups[group], sink, room, 0)
+
+        # Pairs go on trips which don't have any leaders yet
+        empty_trips = {
+            group: [(trip, room // LEADERS_PER_TRIP) for trip, room in trips]
+            for group, trips in self.trips.items()
+        }
+        empty = {
+            group: sum(n for _, n in trips) for group, trips in empty_trips.items()
+        }
+
+        edges = {}
+        placed_pairs = {}
+        while queue:
+            _, _, unit = heapq.heappop(queue)
+            if len(unit) == 1:
+                [pk] = unit
+                node = network.add_node()
+                edges[pk] = [
+                    (group, network.add_edge(node, groups[group], 1, cost))
+                    for group, cost in options[pk].items()
+                    if group in groups
+                ]
+                network.augment(node, sink)
+                continue
+
+            a, b = unit
+            pair_options = sorted(
+                (cost + options[b][group], group)
+                for group, cost in options[a].items()
+                if group in options[b] and group in groups and empty[group] > 0
+            )
+            for _, group in pair_options:
+                # Both leaders flow from one node into the same group. If
+                # there isn't room for both the network is put back.
+                node = network.add_node()
+                for pk in unit:
+                    network.add_edge(node, groups[group], 1, options[pk][group])
+                state = network.save()
+                if network.augment(node, sink) and network.augment(node, sink):
+                    placed_pairs[unit] = group
+                    empty[group] -= 1
+                    break
+                network.restore(state)
+            else:
+                for pk in unit:
+                    heapq.heappush(queue, (-score[pk], rank[pk], (pk,)))
+
+        placed = {}
+        assignments = {}
+        co_leaders = {}
+        for (a, b), trip in fill(placed_pairs, empty_trips).items():
+            for leader, other in [(a, b), (b, a)]:
+                placed[leader] = placed_pairs[(a, b)]
+                assignments[leader] = trip
+                co_leaders[leader] = other
+
+        # Everyone else fills the remaining spots
+        taken = set(assignments.values())
+        trips = {
+            group: [(trip, 0 if trip in taken else room) for trip, room in trips]
+            for group, trips in self.trips.items()
+        }
+        placed_singles = {
+            pk: group
+            for pk, choices in edges.items()
+            for group, edge in choices
+            if network.flow(edge)
+        }
+        placed.update(placed_singles)
+        assignments.update(fill(placed_singles, trips))
+
+        self.placements = []
+        for pk, leader in leaders.items():
+            if pk in placed:
+                section, triptype = placed[pk]
+                supplement = leader['leader_supplement']
+                self.placements.append(
+                    LeaderPlacement(
+                        pk,
+                        assignments[pk],
+                        self.triptype_prefs[supplement][triptype],
+                        self.section_prefs[supplement][section],
+                        co_leaders.get(pk),
+                    )
+                )
+        self.unplaced = [pk for pk in leaders if pk not in placed]
+        return self.placements
@@ -3,4 +3,7 @@ TRIPPEE_ARRIVAL_DELTA = 1
 FIRST_CAMPSITE_DELTA = 2
 SECOND_CAMPSITE_DELTA = 3
 LODGE_ARRIVAL_DELTA = 4
-RETURN_TO_CAMPUS_DELTA = 5
\ No newline at end of file
+RETURN_TO_CAMPUS_DELTA = 5
+
+# The number of leaders on each trip
+LEADERS_PER_TRIP = 2
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from fyt.core.models import TripsYear
+from fyt.trips.models import LeaderProposal
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Propose trips for all unassigned leaders in the current trips year, '
+        'two leaders to each trip'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--apply',
+            action='store_true',
+            help='apply the stored proposal instead of computing a new one',
+        )
+
+    def handle(self, *args, **options):
+        trips_year = TripsYear.objects.current()
+
+        if options['apply']:
+            applied = LeaderProposal.objects.apply(trips_year)
+            self.stdout.write(f'Assigned {len(applied)} leaders')
+            return
+
+        start = time.perf_counter()
+        assigner = LeaderProposal.objects.propose(trips_year)
+        seconds = time.perf_counter() - start
+
+        for trip, proposals in LeaderProposal.objects.diff(trips_year):
+            current = ', '.join(str(leader) for leader in trip.leaders.all())
+            proposed = ', '.join(
+                f'{p.leader} ({p.section_preference.lower()} section, '
+                f'{p.triptype_preference.lower()} trip type'
+                + (', requested co-leader' if p.co_leader_id else '')
+                + ')'
+                for p in proposals
+            )
+            self.stdout.write(f'{trip}: {current or "no leaders"} + {proposed}')
+
+        self.stdout.write(
+            f'Proposed trips for {len(assigner.placements)} of '
+            f'{len(assigner.leaders)} leaders in {seconds:.1f}s'
+        )
+        if assigner.unplaced:
+            self.stdout.write(f'No trip available for {len(assigner.unplaced)} leaders')
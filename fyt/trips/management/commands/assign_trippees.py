@@ -0,0 +1,50 @@
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from fyt.core.models import TripsYear
+from fyt.trips.models import TrippeeProposal
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Propose trips for all unassigned trippees in the current trips year '
+        'which satisfy as many of their preferences as possible'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--apply',
+            action='store_true',
+            help='apply the stored proposal instead of computing a new one',
+        )
+
+    def handle(self, *args, **options):
+        trips_year = TripsYear.objects.current()
+
+        if options['apply']:
+            applied = TrippeeProposal.objects.apply(trips_year)
+            self.stdout.write(f'Assigned {len(applied)} trippees')
+            return
+
+        start = time.perf_counter()
+        assigner = TrippeeProposal.objects.propose(trips_year)
+        seconds = time.perf_counter() - start
+
+        self.stdout.write(
+            f'Proposed trips for {len(assigner.placements)} of '
+            f'{len(assigner.trippees)} trippees in {seconds:.1f}s'
+        )
+        for label, field in [
+            ('Trip type', 'triptype_preference'),
+            ('Section', 'section_preference'),
+        ]:
+            counts = Counter(getattr(p, field) for p in assigner.placements)
+            for preference, count in sorted(counts.items()):
+                self.stdout.write(f'{label} {preference.lower()}: {count}')
+        if assigner.unplaced:
+            self.stdout.write(
+                f'No trip available for {len(assigner.unplaced)} trippees'
+            )
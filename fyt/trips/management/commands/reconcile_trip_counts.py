@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from fyt.core.models import TripsYear
+from fyt.trips.models import Trip
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Correct the stored number of trippees and leaders of all trips in '
+        'the current trips year'
+    )
+
+    def handle(self, *args, **options):
+        trips_year = TripsYear.objects.current()
+
+        wrong = Trip.objects.reconcile(trips_year)
+        for trip in wrong:
+            self.stdout.write(
+                f'{trip}: {trip.num_trippees} -> {trip.actual_trippees} trippees, '
+                f'{trip.num_leaders} -> {trip.actual_leaders} leaders'
+            )
+        self.stdout.write(f'Corrected {len(wrong)} trips')
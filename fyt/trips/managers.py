@@ -1,10 +1,18 @@
+from collections import defaultdict
 from datetime import timedelta
 
-from django.db import models
-from django.db.models import F, Q
+from django.db import models, transaction
+from django.db.models import F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
 
-from fyt.utils.matrix import OrderedMatrix
-from fyt.trips.constants import FIRST_CAMPSITE_DELTA, LODGE_ARRIVAL_DELTA, RETURN_TO_CAMPUS_DELTA
+from fyt.utils.matrix import CompactMatrix, OrderedMatrix
+from fyt.trips.constants import (
+    FIRST_CAMPSITE_DELTA,
+    LEADERS_PER_TRIP,
+    LODGE_ARRIVAL_DELTA,
+    RETURN_TO_CAMPUS_DELTA,
+    SECOND_CAMPSITE_DELTA,
+)
 
 
 class SectionDatesManager(models.Manager):
@@ -97,8 +105,6 @@ class TripManager(models.Manager):
 
         matrix = OrderedMatrix(templates, sections)
 
-        # see https://docs.djangoproject.com/en/dev/ref/models/querysets/#id7
-        # http://stackoverflow.com/questions/6795202/django-count-in-multiple-annotations
         trips = self.with_counts(trips_year)
 
         for trip in trips:
@@ -106,20 +112,92 @@ class TripManager(models.Manager):
 
         return matrix
 
-    def with_counts(self, trips_year):
+    def compact_matrix(self, trips_year):
         """
-        Annotate the number of trippees and leaders.
+        Return a lightweight matrix of scheduled trips, for pages which
+        only show names and counts.
+
+        Sections, templates and trips are loaded as `values` rows instead of
+        model instances. matrix.get(template_pk, section_pk) is a dict with
+        the `pk`, `num_trippees` and `num_leaders` of the scheduled trip, or
+        None if it is not scheduled.
         """
-        return (
+        from fyt.trips.models import Section, TripTemplate
+
+        sections = Section.objects.filter(trips_year=trips_year).values('pk', 'name')
+        templates = TripTemplate.objects.filter(trips_year=trips_year).values(
+            'pk',
+            'name',
+            'description_summary',
+            'max_trippees',
+            triptype_name=F('triptype__name'),
+        )
+
+        matrix = CompactMatrix(templates, sections)
+
+        trips = (
             self.filter(trips_year=trips_year)
-            .annotate(num_trippees=models.Count('trippees', distinct=True))
-            .annotate(num_leaders=models.Count('leaders', distinct=True))
-            .annotate(size=F('num_trippees') + F('num_leaders'))
-            # Silence deprecation warning caused by
-            # https://docs.djangoproject.com/en/2.2/releases/2.2/#model-meta-ordering-will-no-longer-affect-group-by-queries
-            .order_by(*self.model._meta.ordering)
+            .order_by()
+            .values('pk', 'template', 'section', 'num_trippees', 'num_leaders')
+        )
+        for trip in trips:
+            matrix.set(trip['template'], trip['section'], trip)
+
+        return matrix
+
+    def with_counts(self, trips_year):
+        """
+        Annotate the size of each trip.
+
+        The number of trippees and leaders are stored on each trip, so this
+        does not need to join the assignments.
+        """
+        return self.filter(trips_year=trips_year).annotate(
+            size=F('num_trippees') + F('num_leaders')
         )
 
+    def update_counts(self, trips):
+        """
+        Recount the trippees and leaders assigned to `trips`, a list or
+        queryset of pks, in a single update.
+        """
+        from fyt.applications.models import Volunteer
+        from fyt.incoming.models import IncomingStudent
+
+        def count(model):
+            assigned = (
+                model.objects.filter(trip_assignment=OuterRef('pk'))
+                .order_by()
+                .values('trip_assignment')
+                .annotate(count=models.Count('pk'))
+                .values('count')
+            )
+            return Coalesce(Subquery(assigned), 0)
+
+        return self.filter(pk__in=trips).update(
+            num_trippees=count(IncomingStudent), num_leaders=count(Volunteer)
+        )
+
+    def reconcile(self, trips_year):
+        """
+        Correct the stored counts of all trips in `trips_year`.
+
+        Returns a list of the trips whose counts were wrong, with the
+        stored counts in `num_trippees` and `num_leaders` and the actual
+        counts in `actual_trippees` and `actual_leaders`.
+        """
+        wrong = [
+            trip
+            for trip in self.filter(trips_year=trips_year)
+            .annotate(actual_trippees=models.Count('trippees', distinct=True))
+            .annotate(actual_leaders=models.Count('leaders', distinct=True))
+            .order_by(*self.model._meta.ordering)
+            if (trip.num_trippees, trip.num_leaders)
+            != (trip.actual_trippees, trip.actual_leaders)
+        ]
+        self.update_counts([trip.pk for trip in wrong])
+        return wrong
+
     def dropoffs(self, route, date, trips_year):
         """
         All trips which are dropped off on route on date
@@ -156,7 +234,9 @@ class TripManager(models.Manager):
         """
         return (
             self.with_counts(trips_year)
-            .filter(section__leaders_arrive=date - timedelta(days=RETURN_TO_CAMPUS_DELTA))
+            .filter(
+                section__leaders_arrive=date - timedelta(days=RETURN_TO_CAMPUS_DELTA)
+            )
             .filter(
                 Q(return_route=route)
                 | Q(return_route=None, template__return_route=route)
@@ -189,6 +269,54 @@ class CampsiteManager(models.Manager):
 
         return matrix
 
+    def occupancy(self, trips_year, campsites=None):
+        """
+        Return the Occupancy of the campsites in `trips_year`, or only of
+        `campsites` if given.
+
+        Trips are grouped by campsite and section for both nights in a
+        single aggregate query.
+        """
+        from .models import Trip
+        from .occupancy import Occupancy
+
+        queryset = self.filter(trips_year=trips_year)
+        if campsites is not None:
+            queryset = queryset.filter(pk__in=campsites)
+
+        def nights(field, night):
+            trips = Trip.objects.filter(trips_year=trips_year)
+            if campsites is not None:
+                trips = trips.filter(**{f'template__{field}__in': campsites})
+            return (
+                trips.order_by()
+                .values(
+                    campsite=F(f'template__{field}'),
+                    leaders_arrive=F('section__leaders_arrive'),
+                    night=Value(night, models.IntegerField()),
+                )
+                .annotate(
+                    trips=models.Count('pk'),
+                    people=models.Sum(F('num_trippees') + F('num_leaders')),
+                    max_people=models.Sum(
+                        F('template__max_trippees')
+                        + Greatest('num_leaders', Value(LEADERS_PER_TRIP)),
+                        output_field=models.IntegerField(),
+                    ),
+                )
+            )
+
+        deltas = {
+            1: timedelta(days=FIRST_CAMPSITE_DELTA),
+            2: timedelta(days=SECOND_CAMPSITE_DELTA),
+        }
+        rows = [
+            dict(row, date=row['leaders_arrive'] + deltas[row['night']])
+            for row in nights('campsite1', 1).union(nights('campsite2', 2), all=True)
+        ]
+
+        return Occupancy(queryset.values('pk', 'name', 'capacity'), rows)
+
 
 class TripTypeManager(models.Manager):
     def visible(self, trips_year):
@@ -197,3 +325,174 @@ class TripTypeManager(models.Manager):
         incoming student registrations.
         """
         return self.filter(trips_year=trips_year, hidden=False)
+
+
+class TrippeeProposalManager(models.Manager):
+    def propose(self, trips_year):
+        """
+        Propose trips for the unassigned trippees of trips_year, replacing
+        any previous proposals.
+
+        Returns the assigner, which lists the trippees who could not be
+        placed on any trip.
+        """
+        from fyt.trips.assignment import TrippeeAssigner
+
+        assigner = TrippeeAssigner(trips_year)
+        assigner.solve()
+
+        with transaction.atomic():
+            self.filter(trips_year=trips_year).delete()
+            self.bulk_create(
+                self.model(
+                    trips_year=trips_year,
+                    trippee_id=placement.trippee,
+                    trip_id=placement.trip,
+                    triptype_preference=placement.triptype_preference,
+                    section_preference=placement.section_preference,
+                )
+                for placement in assigner.placements
+            )
+
+        return assigner
+
+    def apply(self, trips_year):
+        """
+        Assign trippees to their proposed trips, and delete the proposals.
+
+        Trippees who have been assigned to a trip since the proposals were
+        made are skipped, as are proposals for trips which have since filled
+        up. Returns the list of applied proposals.
+        """
+        from fyt.incoming.models import IncomingStudent
+        from fyt.trips.models import Trip
+
+        proposals = (
+            self.filter(trips_year=trips_year, trippee__trip_assignment=None)
+            .select_related('trip__template')
+            .order_by('pk')
+        )
+
+        room = {}
+        applied = []
+        for proposal in proposals:
+            trip = proposal.trip
+            room.setdefault(trip.pk, trip.template.max_trippees - trip.num_trippees)
+            if room[trip.pk] > 0:
+                room[trip.pk] -= 1
+                applied.append(proposal)
+
+        with transaction.atomic():
+            IncomingStudent.objects.bulk_update(
+                [
+                    IncomingStudent(
+                        pk=proposal.trippee_id, trip_assignment=proposal.trip
+                    )
+                    for proposal in applied
+                ],
+                ['trip_assignment'],
+            )
+            # bulk_update skips the signals which count trippees
+            Trip.objects.update_counts(list(room))
+            self.filter(trips_year=trips_year).delete()
+
+        return applied
+
+
+class LeaderProposalManager(models.Manager):
+    def propose(self, trips_year):
+        """
+        Propose trips for the unassigned leaders of trips_year, replacing
+        any previous proposals.
+
+        Returns the assigner, which lists the leaders who could not be
+        placed on any trip.
+        """
+        from fyt.trips.assignment import LeaderAssigner
+
+        assigner = LeaderAssigner(trips_year)
+        assigner.solve()
+
+        with transaction.atomic():
+            self.filter(trips_year=trips_year).delete()
+            self.bulk_create(
+                self.model(
+                    trips_year=trips_year,
+                    leader_id=placement.leader,
+                    trip_id=placement.trip,
+                    triptype_preference=placement.triptype_preference,
+                    section_preference=placement.section_preference,
+                    co_leader_id=placement.co_leader,
+                )
+                for placement in assigner.placements
+            )
+
+        return assigner
+
+    def diff(self, trips_year):
+        """
+        Compare the proposals for trips_year to the current leaders.
+
+        Returns a list of (trip, proposals) for each trip which has
+        proposed leaders. The current leaders of the trips are prefetched.
+        """
+        from fyt.trips.models import Trip
+
+        proposals = defaultdict(list)
+        for proposal in (
+            self.filter(trips_year=trips_year)
+            .select_related('leader__applicant', 'co_leader__applicant')
+            .order_by('leader__applicant__name')
+        ):
+            proposals[proposal.trip_id].append(proposal)
+
+        trips = (
+            Trip.objects.filter(pk__in=list(proposals))
+            .select_related('section', 'template__triptype')
+            .prefetch_related('leaders__applicant')
+        )
+        return [(trip, proposals[trip.pk]) for trip in trips]
+
+    def apply(self, trips_year):
+        """
+        Assign leaders to their proposed trips, and delete the proposals.
+
+        Leaders who have been assigned to a trip, or are no longer leaders,
+        are skipped, as are proposals for trips which have since filled up.
+        Returns the list of applied proposals.
+        """
+        from fyt.applications.models import Volunteer
+        from fyt.trips.models import Trip
+
+        proposals = (
+            self.filter(
+                trips_year=trips_year,
+                leader__status=Volunteer.LEADER,
+                leader__trip_assignment=None,
+            )
+            .select_related('trip')
+            .order_by('pk')
+        )
+
+        room = {}
+        applied = []
+        for proposal in proposals:
+            trip = proposal.trip
+            room.setdefault(trip.pk, LEADERS_PER_TRIP - trip.num_leaders)
+            if room[trip.pk] > 0:
+                room[trip.pk] -= 1
+                applied.append(proposal)
+
+        with transaction.atomic():
+            Volunteer.objects.bulk_update(
+                [
+                    Volunteer(pk=proposal.leader_id, trip_assignment=proposal.trip)
+                    for proposal in applied
+                ],
+                ['trip_assignment'],
+            )
+            # bulk_update skips the signals which count leaders
+            Trip.objects.update_counts(list(room))
+            self.filter(trips_year=trips_year).delete()
+
+        return applied
@@ -0,0 +1,35 @@
+# Generated by Django 3.1.13 on 2026-10-18 19:51
+
+from django.db import migrations, models
+
+
+def count_assignments(apps, schema_editor):
+    Trip = apps.get_model('trips', 'Trip')
+
+    for trip in Trip.objects.all():
+        trip.num_trippees = trip.trippees.count()
+        trip.num_leaders = trip.leaders.count()
+        trip.save(update_fields=['num_trippees', 'num_leaders'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0024_auto_20180822_0834'),
+        ('incoming', '0040_auto_20210625_1602'),
+        ('applications', '0133_auto_20210625_1602'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='num_leaders',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='num_trippees',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_assignments, migrations.RunPython.noop),
+    ]
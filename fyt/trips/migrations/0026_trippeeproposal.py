@@ -0,0 +1,32 @@
+# Generated by Django 3.1.13 on 2026-10-18 20:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('incoming', '0040_auto_20210625_1602'),
+        ('core', '0002_auto_20180719_1052'),
+        ('trips', '0025_trip_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrippeeProposal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('triptype_preference', models.CharField(max_length=20)),
+                ('section_preference', models.CharField(max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('trip', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='trips.trip')),
+                ('trippee', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='incoming.incomingstudent')),
+                ('trips_year', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, to='core.tripsyear')),
+            ],
+            options={
+                'unique_together': {('trips_year', 'trippee')},
+            },
+        ),
+    ]
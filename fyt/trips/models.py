@@ -4,15 +4,18 @@ from datetime import timedelta
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.functional import cached_property
 from model_utils import FieldTracker
 
 from .managers import (
     CampsiteManager,
+    LeaderProposalManager,
     SectionDatesManager,
     SectionManager,
     TripManager,
     TripTypeManager,
+    TrippeeProposalManager,
 )
 
 from fyt.core.models import DatabaseModel
@@ -83,6 +86,12 @@ class Trip(DatabaseModel):
         help_text=ROUTE_HELP_TEXT,
     )
 
+    # The number of trippees and leaders assigned to the trip. These are
+    # kept up to date by signals in `fyt.trips.signals`, and can be
+    # corrected with the `reconcile_trip_counts` command.
+    num_trippees = models.PositiveIntegerField(default=0, editable=False)
+    num_leaders = models.PositiveIntegerField(default=0, editable=False)
+
     class Meta:
         # no two Trips can have the same template-section-trips_year
         # combination; we don't want to schedule two identical trips
@@ -96,6 +105,20 @@ class Trip(DatabaseModel):
             if self.tracker.has_changed('template'):
                 raise ValidationError("Cannot change a Trip's template.")
 
+    def save(self, **kwargs):
+        """
+        Don't overwrite the stored counts with stale values when an existing
+        trip is saved.
+        """
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in ('num_trippees', 'num_leaders')
+            ]
+        return super().save(**kwargs)
+
     def get_dropoff_route(self):
         """
         Returns the overriden dropoff, if set
@@ -134,6 +157,10 @@ class Trip(DatabaseModel):
             return None
         return self.get_pickup_stoporder().time
 
+    #: A `fyt.transport.models.BusIndex`, set when many trips are processed
+    #: together so that bus and StopOrder lookups don't hit the database.
+    bus_index = None
+
     def get_dropoff_bus(self):
         """
         Return the bus that is dropping off this Trip, or None if the bus is
@@ -141,6 +168,10 @@ class Trip(DatabaseModel):
         """
         from fyt.transport.models import InternalBus
 
+        if self.bus_index is not None:
+            route = self.dropoff_route_id or self.template.dropoff_stop.route_id
+            return self.bus_index.get_bus(route, self.dropoff_date)
+
         return InternalBus.objects.filter(
             route=self.get_dropoff_route(), date=self.dropoff_date
         ).first()
@@ -152,6 +183,10 @@ class Trip(DatabaseModel):
         """
         from fyt.transport.models import InternalBus
 
+        if self.bus_index is not None:
+            route = self.pickup_route_id or self.template.pickup_stop.route_id
+            return self.bus_index.get_bus(route, self.pickup_date)
+
         return InternalBus.objects.filter(
             route=self.get_pickup_route(), date=self.pickup_date
         ).first()
@@ -159,6 +194,9 @@ class Trip(DatabaseModel):
     def get_dropoff_stoporder(self):
         from fyt.transport.models import StopOrder
 
+        if self.bus_index is not None:
+            return self.bus_index.get_stoporder(self, StopOrder.DROPOFF)
+
         try:
             return self.stoporder_set.get(stop_type=StopOrder.DROPOFF)
         except StopOrder.DoesNotExist:
@@ -167,6 +205,9 @@ class Trip(DatabaseModel):
     def get_pickup_stoporder(self):
         from fyt.transport.models import StopOrder
 
+        if self.bus_index is not None:
+            return self.bus_index.get_stoporder(self, StopOrder.PICKUP)
+
         try:
             return self.stoporder_set.get(stop_type=StopOrder.PICKUP)
         except StopOrder.DoesNotExist:
@@ -177,7 +218,7 @@ class Trip(DatabaseModel):
         """
         Return the number trippees + leaders on this trip
         """
-        return self.leaders.count() + self.trippees.count()
+        return self.num_trippees + self.num_leaders
 
     @property
     def dropoff_date(self):
@@ -533,3 +574,57 @@ class Campsite(DatabaseModel):
 
     def __str__(self):
         return self.name
+
+
+class TrippeeProposal(DatabaseModel):
+    """
+    A trip proposed by the assignment solver for an unassigned trippee.
+
+    Proposals are created by the `assign_trippees` command or the proposed
+    assignments page. Trippees are not assigned to the trips until the
+    proposals are applied.
+    """
+
+    class Meta:
+        unique_together = ['trips_year', 'trippee']
+
+    trippee = models.ForeignKey('incoming.IncomingStudent', on_delete=models.CASCADE)
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE)
+    triptype_preference = models.CharField(max_length=20)
+    section_preference = models.CharField(max_length=20)
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = TrippeeProposalManager()
+
+    def __str__(self):
+        return '{} on {}'.format(self.trippee, self.trip)
+
+
+class LeaderProposal(DatabaseModel):
+    """
+    A trip proposed by the assignment solver for an unassigned leader.
+
+    Proposals are created by the `assign_leaders` command or the proposed
+    leader assignments page. `co_leader` is the leader they asked to lead
+    with, if they were proposed together.
+    """
+
+    class Meta:
+        unique_together = ['trips_year', 'leader']
+
+    leader = models.ForeignKey('applications.Volunteer', on_delete=models.CASCADE)
+    trip = models.ForeignKey(Trip, on_delete=models.CASCADE)
+    triptype_preference = models.CharField(max_length=20)
+    section_preference = models.CharField(max_length=20)
+    co_leader = models.ForeignKey(
+        'applications.Volunteer',
+        null=True,
+        related_name='+',
+        on_delete=models.SET_NULL,
+    )
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    objects = LeaderProposalManager()
+
+    def __str__(self):
+        return '{} on {}'.format(self.leader, self.trip)
@@ -0,0 +1,107 @@
+from collections import namedtuple
+
+
+"""
+Headcounts at each campsite on each night of a trips year.
+
+The occupancy is computed by `Campsite.objects.occupancy` with one aggregate
+query over the stored sizes of the trips, so it is cheap enough to check
+whenever a trip template changes.
+"""
+
+
+class Night(namedtuple('Night', ['trips', 'people', 'max_people', 'capacity'])):
+    """
+    The trips staying at a campsite on one night.
+
+    `people` counts the trippees and leaders currently assigned to the trips,
+    `max_people` the most the trips can hold: the max trippees of their
+    templates and a full set of leaders, or every leader assigned to a trip
+    with more.
+    """
+
+    @property
+    def overbooked(self):
+        return self.capacity is not None and self.people > self.capacity
+
+    @property
+    def may_overbook(self):
+        return self.capacity is not None and self.max_people > self.capacity
+
+
+class Occupancy:
+    """
+    `campsites` is a list of Campsite `values` rows with a `pk`, `name` and
+    `capacity`. `rows` are the aggregate rows of each campsite and date.
+    """
+
+    def __init__(self, campsites, rows):
+        self.campsites = list(campsites)
+        capacities = {
+            campsite['pk']: campsite['capacity'] for campsite in self.campsites
+        }
+
+        self.nights = {}
+        for row in rows:
+            key = (row['campsite'], row['date'])
+            night = self.nights.get(key, Night(0, 0, 0, capacities[row['campsite']]))
+            self.nights[key] = night._replace(
+                trips=night.trips + row['trips'],
+                people=night.people + row['people'],
+                max_people=night.max_people + row['max_people'],
+            )
+
+    def get(self, campsite_pk, date):
+        """
+        The Night at a campsite on a date, or None if no trips are there.
+        """
+        return self.nights.get((campsite_pk, date))
+
+    def overbooked(self):
+        """
+        Return a list of (campsite, date, night) for all nights on which
+        more people are assigned to a campsite than it can hold.
+        """
+        return [
+            (campsite, date, night)
+            for campsite in self.campsites
+            for date, night in self.for_campsite(campsite['pk'])
+            if night.overbooked
+        ]
+
+    def for_campsite(self, campsite_pk):
+        """
+        The (date, night) pairs of a campsite, in order of date.
+        """
+        return sorted(
+            (date, night)
+            for (pk, date), night in self.nights.items()
+            if pk == campsite_pk
+        )
+
+    def as_json(self):
+        return {
+            'campsites': [
+                {
+                    'pk': campsite['pk'],
+                    'name': campsite['name'],
+                    'capacity': campsite['capacity'],
+                    'nights': [
+                        {
+                            'date': date.isoformat(),
+                            'trips': night.trips,
+                            'people': night.people,
+                            'max_people': night.max_people,
+                            'overbooked': night.overbooked,
+                            'may_overbook': night.may_overbook,
+                        }
+                        for date, night in self.for_campsite(campsite['pk'])
+                    ],
+                }
+                for campsite in self.campsites
+            ],
+            'overbooked': [
+                {'campsite': campsite['pk'], 'date': date.isoformat()}
+                for campsite, date, _ in self.overbooked()
+            ],
+        }
@@ -0,0 +1,49 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from fyt.applications.models import Volunteer
+from fyt.incoming.models import IncomingStudent
+from fyt.trips.models import Trip
+
+
+UNCHANGED = object()
+
+
+# A FieldTracker can't be used on these models because it loads deferred
+# fields, which breaks the `only` querysets of the volunteer index.
+@receiver(pre_save, sender=IncomingStudent)
+@receiver(pre_save, sender=Volunteer)
+def record_previous_assignment(sender, instance, update_fields, **kwargs):
+    """
+    Remember which trip a trippee or leader was assigned to before it is
+    saved.
+    """
+    if update_fields is not None and 'trip_assignment' not in update_fields:
+        instance._previous_trip_assignment = UNCHANGED
+    elif instance.pk is None:
+        instance._previous_trip_assignment = None
+    else:
+        instance._previous_trip_assignment = (
+            sender.objects.filter(pk=instance.pk)
+            .values_list('trip_assignment', flat=True)
+            .first()
+        )
+
+
+@receiver(post_save, sender=IncomingStudent)
+@receiver(post_save, sender=Volunteer)
+def update_counts_for_assignment_changes(instance, **kwargs):
+    """
+    Recount the old and new trips when a trippee or leader is assigned to
+    a different trip.
+    """
+    previous = instance._previous_trip_assignment
+    if previous is not UNCHANGED and previous != instance.trip_assignment_id:
+        Trip.objects.update_counts({previous, instance.trip_assignment_id} - {None})
+
+
+@receiver(post_delete, sender=IncomingStudent)
+@receiver(post_delete, sender=Volunteer)
+def update_counts_for_deleted_assignments(instance, **kwargs):
+    if instance.trip_assignment_id is not None:
+        Trip.objects.update_counts([instance.trip_assignment_id])
@@ -1,3 +1,4 @@
+import io
 import math
 import unittest
 from datetime import date, time, timedelta
@@ -5,22 +6,26 @@ from datetime import date, time, timedelta
 import boto3  # This is required to fix an issue with VCR
 import webtest
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.forms.models import model_to_dict
 from django.urls import reverse
 from model_mommy import mommy
 
+from ..assignment import LeaderAssigner, assign
 from ..models import (
     NUM_BAGELS_REGULAR,
     NUM_BAGELS_SUPPLEMENT,
     Campsite,
+    LeaderProposal,
     Section,
     Trip,
     TripTemplate,
     TripType,
+    TrippeeProposal,
     validate_triptemplate_name,
 )
 
-from fyt.applications.models import Volunteer
+from fyt.applications.models import Score, Volunteer
 from fyt.applications.tests import make_application
 from fyt.core.forward import forward
 from fyt.incoming.models import (
@@ -31,8 +36,8 @@ from fyt.incoming.models import (
 )
 from fyt.test import FytTestCase, vcr
 from fyt.timetable.models import Timetable
-from fyt.transport.models import Route
-from fyt.utils.choices import AVAILABLE, PREFER
+from fyt.transport.models import ExternalBus, Route, Stop
+from fyt.utils.choices import AVAILABLE, FIRST_CHOICE, PREFER
 
 
 class TripTestCase(FytTestCase):
@@ -66,6 +71,22 @@ class TripTestCase(FytTestCase):
         self.assertEqual(len(scheduled_trips), 1)
         self.assertEqual(scheduled_trips[0], trip)
 
+    def test_trippee_leader_counts(self):
+        trip = mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            section__trips_year=self.trips_year,
+            template__trips_year=self.trips_year,
+            template__max_trippees=1,
+        )
+        mommy.make(IncomingStudent, 2, trips_year=self.trips_year, trip_assignment=trip)
+        response = self.app.get(
+            reverse('core:trip:people_counts', kwargs={'trips_year': self.trips_year}),
+            user=self.make_director(),
+        )
+        self.assertIn(trip.detail_url(), response)
+        self.assertIn('class="text-bright-danger" > 2 </span>', response)
+
     def test_num_queries_in_scheduled_trip_matrix(self):
         trips_year = self.trips_year
         template1 = mommy.make(TripTemplate, trips_year=trips_year)
@@ -92,6 +113,7 @@ class TripModelTestCase(FytTestCase):
         make_application(trips_year=trips_year, trip_assignment=trip)
         mommy.make(IncomingStudent, trips_year=trips_year, trip_assignment=trip)
         mommy.make(IncomingStudent, trips_year=trips_year, trip_assignment=trip)
+        trip.refresh_from_db()
         self.assertTrue(trip.half_foodbox)
 
     def test_does_not_get_half_foodbox(self):
@@ -123,6 +145,7 @@ class TripModelTestCase(FytTestCase):
             Trip, trips_year=trips_year, template__triptype__gets_supplemental=False
         )
         mommy.make(IncomingStudent, 2, trips_year=trips_year, trip_assignment=trip)
+        trip.refresh_from_db()
         self.assertEqual(trip.bagels, math.ceil(2 * NUM_BAGELS_REGULAR))
 
     def test_bagels_supplemental(self):
@@ -131,6 +154,7 @@ class TripModelTestCase(FytTestCase):
             Trip, trips_year=trips_year, template__triptype__gets_supplemental=True
         )
         mommy.make(IncomingStudent, 2, trips_year=trips_year, trip_assignment=trip)
+        trip.refresh_from_db()
         self.assertEqual(trip.bagels, math.ceil(2 * NUM_BAGELS_SUPPLEMENT))
 
     def test_section_and_template_cannot_be_changed(self):
@@ -208,6 +232,7 @@ class TripRouteOverridesTestCase(FytTestCase):
         trips_year = self.init_trips_year()
         trip = mommy.make(Trip, trips_year=trips_year)
         make_application(trips_year=trips_year, trip_assignment=trip)
+        trip.refresh_from_db()
         self.assertEqual(trip.size, 1)
 
     def test_size_method_with_1_leader_and_2_trippees(self):
@@ -216,6 +241,7 @@ class TripRouteOverridesTestCase(FytTestCase):
         make_application(trips_year=trips_year, trip_assignment=trip)
         mommy.make(IncomingStudent, trips_year=trips_year, trip_assignment=trip)
         mommy.make(IncomingStudent, trips_year=trips_year, trip_assignment=trip)
+        trip.refresh_from_db()
         self.assertEqual(trip.size, 3)
 
 
@@ -434,6 +460,310 @@ class AssignTrippeeTestCase(FytTestCase):
         self.assertEqual(trippee.trip_assignment, trip)
 
 
+class AssignmentSolverTestCase(unittest.TestCase):
+    def test_assign_cheapest_group(self):
+        placed = assign(['a'], {'a': [('x', 5), ('y', 0)]}, {'x': 1, 'y': 1})
+        self.assertEqual(placed, {'a': 'y'})
+
+    def test_assign_moves_people_to_make_room(self):
+        placed = assign(
+            ['a', 'b'],
+            {'a': [('x', 0), ('y', 1)], 'b': [('x', 0)]},
+            {'x': 1, 'y': 1},
+        )
+        self.assertEqual(placed, {'a': 'y', 'b': 'x'})
+
+    def test_assign_minimizes_total_cost(self):
+        placed = assign(
+            ['a', 'b'],
+            {'a': [('x', 0), ('y', 1)], 'b': [('x', 0), ('y', 5)]},
+            {'x': 1, 'y': 1},
+        )
+        self.assertEqual(placed, {'a': 'y', 'b': 'x'})
+
+    def test_people_over_capacity_are_not_placed(self):
+        placed = assign(
+            ['a', 'b', 'c'],
+            {'a': [('x', 0)], 'b': [('x', 0)], 'c': [('y', 0)]},
+            {'x': 1, 'y': 0},
+        )
+        self.assertEqual(placed, {'a': 'x'})
+
+
+class TrippeeAssignmentTestCase(FytTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.section = mommy.make(Section, trips_year=self.trips_year)
+        self.triptype = mommy.make(TripType, trips_year=self.trips_year)
+
+    def make_trip(self, section=None, triptype=None, **kwargs):
+        return mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            section=section or self.section,
+            template__trips_year=self.trips_year,
+            template__triptype=triptype or self.triptype,
+            template__description__trips_year=self.trips_year,
+            **{'template__' + k: v for k, v in kwargs.items()},
+        )
+
+    def make_trippee(self, sections=None, triptypes=None, **kwargs):
+        kwargs.setdefault('swimming_ability', Registration.COMPETENT)
+        registration = mommy.make(Registration, trips_year=self.trips_year, **kwargs)
+        for section, preference in (sections or {self.section: PREFER}).items():
+            registration.set_section_preference(section, preference)
+        for triptype, preference in (triptypes or {self.triptype: PREFER}).items():
+            registration.set_triptype_preference(triptype, preference)
+        return mommy.make(
+            IncomingStudent, trips_year=self.trips_year, registration=registration
+        )
+
+    def assertProposals(self, expected):
+        self.assertQsEqual(
+            TrippeeProposal.objects.values_list('trippee', 'trip'),
+            [(trippee.pk, trip.pk) for trippee, trip in expected],
+            ordered=False,
+        )
+
+    def test_propose_first_choice(self):
+        other = mommy.make(TripType, trips_year=self.trips_year)
+        self.make_trip()
+        first_choice = self.make_trip(triptype=other)
+        trippee = self.make_trippee(
+            triptypes={self.triptype: PREFER, other: FIRST_CHOICE}
+        )
+        TrippeeProposal.objects.propose(self.trips_year)
+        self.assertProposals([(trippee, first_choice)])
+
+    def test_propose_within_max_trippees(self):
+        trip = self.make_trip(max_trippees=1)
+        first = self.make_trippee()
+        second = self.make_trippee()
+        assigner = TrippeeProposal.objects.propose(self.trips_year)
+        self.assertProposals([(first, trip)])
+        self.assertEqual(assigner.unplaced, [second.pk])
+
+    def test_propose_counts_assigned_trippees(self):
+        trip = self.make_trip(max_trippees=1)
+        mommy.make(IncomingStudent, trips_year=self.trips_year, trip_assignment=trip)
+        self.make_trippee()
+        TrippeeProposal.objects.propose(self.trips_year)
+        self.assertProposals([])
+
+    def test_non_swimmers_not_proposed_for_swimming_trips(self):
+        self.make_trip(swimtest_required=True)
+        trip = self.make_trip(swimtest_required=False)
+        trippee = self.make_trippee(swimming_ability=Registration.NON_SWIMMER)
+        TrippeeProposal.objects.propose(self.trips_year)
+        self.assertProposals([(trippee, trip)])
+
+    def test_bus_requests_only_proposed_for_sections_with_bus(self):
+        local = mommy.make(Section, trips_year=self.trips_year, is_local=True)
+        self.make_trip()
+        trip = self.make_trip(section=local)
+        stop = mommy.make(
+            Stop, trips_year=self.trips_year, route__trips_year=self.trips_year
+        )
+        mommy.make(
+            ExternalBus, trips_year=self.trips_year, route=stop.route, section=local
+        )
+        trippee = self.make_trippee(
+            sections={self.section: PREFER, local: AVAILABLE},
+            bus_stop_round_trip=stop,
+        )
+        TrippeeProposal.objects.propose(self.trips_year)
+        self.assertProposals([(trippee, trip)])
+
+    def test_apply(self):
+        trip = self.make_trip(max_trippees=2)
+        first = self.make_trippee()
+        second = self.make_trippee()
+        TrippeeProposal.objects.propose(self.trips_year)
+
+        # Assigned by hand after the proposal was made
+        second.trip_assignment = self.make_trip()
+        second.save()
+
+        applied = TrippeeProposal.objects.apply(self.trips_year)
+        self.assertEqual([p.trippee_id for p in applied], [first.pk])
+        first.refresh_from_db()
+        trip.refresh_from_db()
+        self.assertEqual(first.trip_assignment, trip)
+        self.assertEqual(trip.num_trippees, 1)
+        self.assertQsEqual(TrippeeProposal.objects.all(), [])
+
+    def test_command(self):
+        trip = self.make_trip()
+        trippee = self.make_trippee()
+
+        output = io.StringIO()
+        call_command('assign_trippees', stdout=output)
+        self.assertIn('Proposed trips for 1 of 1 trippees', output.getvalue())
+
+        call_command('assign_trippees', '--apply', stdout=output)
+        self.assertIn('Assigned 1 trippees', output.getvalue())
+        trippee.refresh_from_db()
+        self.assertEqual(trippee.trip_assignment, trip)
+
+    def test_proposal_view(self):
+        trip = self.make_trip()
+        trippee = self.make_trippee()
+        url = reverse('core:trippee_proposals', kwargs={'trips_year': self.trips_year})
+        resp = self.app.get(url, user=self.make_director())
+        resp = resp.forms[0].submit('propose').follow()
+        self.assertProposals([(trippee, trip)])
+        resp.forms[0].submit('apply').follow()
+        trippee.refresh_from_db()
+        self.assertEqual(trippee.trip_assignment, trip)
+
+
+class LeaderAssignmentTestCase(FytTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.trip = mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            template__trips_year=self.trips_year,
+            template__triptype__trips_year=self.trips_year,
+            template__description__trips_year=self.trips_year,
+            section__trips_year=self.trips_year,
+        )
+
+    def make_leader(self, name, score=None, co_leader='', trip=None):
+        trip = trip or self.trip
+        leader = make_application(
+            trips_year=self.trips_year,
+            status=Volunteer.LEADER,
+            applicant__name=name,
+            applicant__netid=name.split()[0].lower(),
+        )
+        supplement = leader.leader_supplement
+        supplement.set_section_preference(trip.section, PREFER)
+        supplement.set_triptype_preference(trip.template.triptype, AVAILABLE)
+        supplement.co_leader = co_leader
+        supplement.save()
+        if score is not None:
+            mommy.make(
+                Score,
+                trips_year=self.trips_year,
+                application=leader,
+                leader_score__value=score,
+                leader_score__trips_year=self.trips_year,
+            )
+        return leader
+
+    def assertProposals(self, expected):
+        self.assertQsEqual(
+            LeaderProposal.objects.values_list('leader', 'trip'),
+            [(leader.pk, trip.pk) for leader, trip in expected],
+            ordered=False,
+        )
+
+    def test_propose_two_leaders_by_score(self):
+        ann = self.make_leader('Ann Lee', score=2)
+        bo = self.make_leader('Bo Katz', score=4)
+        cy = self.make_leader('Cy Park', score=3)
+        assigner = LeaderProposal.objects.propose(self.trips_year)
+        self.assertProposals([(bo, self.trip), (cy, self.trip)])
+        self.assertEqual(assigner.unplaced, [ann.pk])
+
+        proposal = LeaderProposal.objects.get(leader=bo)
+        self.assertEqual(proposal.section_preference, PREFER)
+        self.assertEqual(proposal.triptype_preference, AVAILABLE)
+
+    def test_propose_counts_assigned_leaders(self):
+        make_application(
+            trips_year=self.trips_year,
+            status=Volunteer.LEADER,
+            trip_assignment=self.trip,
+        )
+        ann = self.make_leader('Ann Lee', score=2)
+        self.make_leader('Bo Katz', score=1)
+        LeaderProposal.objects.propose(self.trips_year)
+        self.assertProposals([(ann, self.trip)])
+
+    def test_co_leader_requests_are_paired(self):
+        other = mommy.make(
+            Trip,
+            trips_year=self.trips_year,
+            section=self.trip.section,
+            template__trips_year=self.trips_year,
+            template__triptype=self.trip.template.triptype,
+            template__description__trips_year=self.trips_year,
+        )
+        ann = self.make_leader('Ann Lee', score=4)
+        bo = self.make_leader('Bo Katz', score=3)
+        cy = self.make_leader('Cy Park', score=2)
+        dee = self.make_leader('Dee Moss', score=1, co_leader='Someone like ANN lee')
+
+        LeaderProposal.objects.propose(self.trips_year)
+        self.assertProposals(
+            [(ann, self.trip), (dee, self.trip), (bo, other), (cy, other)]
+        )
+        self.assertEqual(LeaderProposal.objects.get(leader=ann).co_leader, dee)
+        self.assertEqual(LeaderProposal.objects.get(leader=dee).co_leader, ann)
+        self.assertIsNone(LeaderProposal.objects.get(leader=bo).co_leader)
+
+    def test_mutual_co_leader_requests_are_paired_first(self):
+        ann = self.make_leader('Ann Lee', co_leader='bo or cy')
+        bo = self.make_leader('Bo Katz')
+        cy = self.make_leader('Cy Park', co_leader='ann')
+        self.assertEqual(LeaderAssigner(self.trips_year).pairs(), [(ann.pk, cy.pk)])
+
+    def test_co_leaders_do_not_displace_higher_scores(self):
+        ann = self.make_leader('Ann Lee', score=4)
+        bo = self.make_leader('Bo Katz', score=3)
+        self.make_leader('Cy Park', score=2, co_leader='dee')
+        self.make_leader('Dee Moss', score=1, co_leader='cy')
+        LeaderProposal.objects.propose(self.trips_year)
+        self.assertProposals([(ann, self.trip), (bo, self.trip)])
+
+    def test_co_leaders_without_an_empty_trip_are_split(self):
+        ann = self.make_leader('Ann Lee', score=4, co_leader='cy')
+        bo = self.make_leader('Bo Katz', score=3)
+        cy = self.make_leader('Cy Park', score=1)
+        assigner = LeaderProposal.objects.propose(self.trips_year)
+        self.assertProposals([(ann, self.trip), (bo, self.trip)])
+        self.assertEqual(assigner.unplaced, [cy.pk])
+        self.assertIsNone(LeaderProposal.objects.get(leader=ann).co_leader)
+
+    def test_apply(self):
+        ann = self.make_leader('Ann Lee')
+        bo = self.make_leader('Bo Katz')
+        LeaderProposal.objects.propose(self.trips_year)
+        bo.status = Volunteer.LEADER_WAITLIST
+        bo.save()
+
+        applied = LeaderProposal.objects.apply(self.trips_year)
+        self.assertEqual([p.leader_id for p in applied], [ann.pk])
+        ann.refresh_from_db()
+        self.trip.refresh_from_db()
+        self.assertEqual(ann.trip_assignment, self.trip)
+        self.assertEqual(self.trip.num_leaders, 1)
+        self.assertQsEqual(LeaderProposal.objects.all(), [])
+
+    def test_command(self):
+        self.make_leader('Ann Lee')
+        output = io.StringIO()
+        call_command('assign_leaders', stdout=output)
+        self.assertIn('no leaders + Ann Lee', output.getvalue())
+        self.assertIn('Proposed trips for 1 of 1 leaders', output.getvalue())
+
+        call_command('assign_leaders', '--apply', stdout=output)
+        self.assertIn('Assigned 1 leaders', output.getvalue())
+
+    def test_proposal_view(self):
+        ann = self.make_leader('Ann Lee')
+        url = reverse('core:leader_proposals', kwargs={'trips_year': self.trips_year})
+        resp = self.app.get(url, user=self.make_director())
+        resp = resp.forms[0].submit('propose').follow()
+        self.assertProposals([(ann, self.trip)])
+        self.assertIn('Ann Lee', resp)
+        resp.forms[0].submit('apply').follow()
+        ann.refresh_from_db()
+        self.assertEqual(ann.trip_assignment, self.trip)
+
+
 class TripManagerTestCase(FytTestCase):
     def test_manager_automatically_selects_section_and_template(self):
         trips_year = self.init_trips_year()
@@ -456,6 +786,37 @@ class TripManagerTestCase(FytTestCase):
         target = {template: {section: trip}}
         self.assertEqual(Trip.objects.matrix(trips_year), target)
 
+    def test_compact_matrix(self):
+        trips_year = self.init_trips_year()
+        template1 = mommy.make(
+            TripTemplate, trips_year=trips_year, name=2, triptype__name='Hiking'
+        )
+        template2 = mommy.make(TripTemplate, trips_year=trips_year, name=1)
+        section = mommy.make(Section, trips_year=trips_year, name='A')
+        trip = mommy.make(
+            Trip, section=section, template=template1, trips_year=trips_year
+        )
+        mommy.make(IncomingStudent, trips_year=trips_year, trip_assignment=trip)
+
+        with self.assertNumQueries(3):
+            matrix = Trip.objects.compact_matrix(trips_year)
+        self.assertEqual(
+            [row['pk'] for row in matrix.rows], [template2.pk, template1.pk]
+        )
+        self.assertEqual(matrix.cols, [{'pk': section.pk, 'name': 'A'}])
+        self.assertEqual(matrix.rows[1]['triptype_name'], 'Hiking')
+        self.assertIsNone(matrix.get(template2.pk, section.pk))
+        self.assertEqual(
+            matrix.get(template1.pk, section.pk),
+            {
+                'pk': trip.pk,
+                'template': template1.pk,
+                'section': section.pk,
+                'num_trippees': 1,
+                'num_leaders': 0,
+            },
+        )
+
     def test_another_matrix(self):
         trips_year = self.init_trips_year()
         template1 = mommy.make(TripTemplate, trips_year=trips_year)
@@ -577,6 +938,87 @@ class TripManagerTestCase(FytTestCase):
         self.assertEqual(trip.num_leaders, 0)
 
 
+class TripCountsTestCase(FytTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.trip = mommy.make(Trip, trips_year=self.trips_year)
+        self.other = mommy.make(Trip, trips_year=self.trips_year)
+
+    def assertCounts(self, trip, trippees, leaders):
+        trip.refresh_from_db()
+        self.assertEqual((trip.num_trippees, trip.num_leaders), (trippees, leaders))
+
+    def test_assigning_trippees(self):
+        trippee = mommy.make(
+            IncomingStudent, trips_year=self.trips_year, trip_assignment=self.trip
+        )
+        self.assertCounts(self.trip, 1, 0)
+
+        trippee.trip_assignment = self.other
+        trippee.save()
+        self.assertCounts(self.trip, 0, 0)
+        self.assertCounts(self.other, 1, 0)
+
+        trippee.trip_assignment = None
+        trippee.save()
+        self.assertCounts(self.other, 0, 0)
+
+    def test_deleting_trippees(self):
+        trippee = mommy.make(
+            IncomingStudent, trips_year=self.trips_year, trip_assignment=self.trip
+        )
+        trippee.delete()
+        self.assertCounts(self.trip, 0, 0)
+
+    def test_assigning_leaders(self):
+        leader = make_application(trips_year=self.trips_year, trip_assignment=self.trip)
+        self.assertCounts(self.trip, 0, 1)
+
+        leader.trip_assignment = self.other
+        leader.save()
+        self.assertCounts(self.trip, 0, 0)
+        self.assertCounts(self.other, 0, 1)
+
+    def test_saving_other_fields_does_not_recount(self):
+        trippee = mommy.make(
+            IncomingStudent, trips_year=self.trips_year, trip_assignment=self.trip
+        )
+        with self.assertNumQueries(2):
+            trippee.save(update_fields=['name'])
+            trippee.save(update_fields=['med_info'])
+
+    def test_saving_stale_trip_keeps_counts(self):
+        trip = Trip.objects.get(pk=self.trip.pk)
+        mommy.make(IncomingStudent, trips_year=self.trips_year, trip_assignment=trip)
+        trip.notes = 'Bring bug spray'
+        trip.save()
+        self.assertCounts(trip, 1, 0)
+
+    def test_reconcile(self):
+        mommy.make(
+            IncomingStudent, trips_year=self.trips_year, trip_assignment=self.trip
+        )
+        Trip.objects.filter(pk=self.trip.pk).update(num_trippees=5, num_leaders=2)
+
+        wrong = Trip.objects.reconcile(self.trips_year)
+        self.assertEqual(wrong, [self.trip])
+        self.assertEqual((wrong[0].actual_trippees, wrong[0].actual_leaders), (1, 0))
+        self.assertCounts(self.trip, 1, 0)
+        self.assertEqual(Trip.objects.reconcile(self.trips_year), [])
+
+    def test_reconcile_command(self):
+        Trip.objects.filter(pk=self.trip.pk).update(num_leaders=3)
+        output = io.StringIO()
+        call_command('reconcile_trip_counts', stdout=output)
+        self.assertIn('Corrected 1 trips', output.getvalue())
+        self.assertCounts(self.trip, 0, 0)
+
+    def test_with_counts_does_not_join_assignments(self):
+        query = str(Trip.objects.with_counts(self.trips_year).query)
+        self.assertNotIn('incoming_incomingstudent', query)
+        self.assertNotIn('applications_volunteer', query)
+
+
 class CampsiteManagerTestCase(FytTestCase):
     def test_campsite_matrix(self):
         trips_year = self.init_trips_year()
@@ -607,6 +1049,146 @@ class CampsiteManagerTestCase(FytTestCase):
         self.assertEqual(target, actual)
 
 
+class CampsiteOccupancyTestCase(FytTestCase):
+    def setUp(self):
+        self.init_trips_year()
+        self.section = mommy.make(Section, trips_year=self.trips_year)
+        self.campsite_a = mommy.make(
+            Campsite, trips_year=self.trips_year, name='A', capacity=5
+        )
+        self.campsite_b = mommy.make(
+            Campsite, trips_year=self.trips_year, name='B', capacity=None
+        )
+
+    def make_trip(self, campsite1, campsite2, trippees, max_trippees=8):
+        template = mommy.make(
+            TripTemplate,
+            trips_year=self.trips_year,
+            name=TripTemplate.objects.count() + 1,
+            description__trips_year=self.trips_year,
+            triptype__trips_year=self.trips_year,
+            dropoff_stop__trips_year=self.trips_year,
+            pickup_stop__trips_year=self.trips_year,
+            return_route__trips_year=self.trips_year,
+            campsite1=campsite1,
+            campsite2=campsite2,
+            max_trippees=max_trippees,
+        )
+        trip = mommy.make(
+            Trip, trips_year=self.trips_year, section=self.section, template=template
+        )
+        for _ in range(trippees):
+            mommy.make(
+                IncomingStudent, trips_year=self.trips_year, trip_assignment=trip
+            )
+        return trip
+
+    def test_occupancy(self):
+        self.make_trip(self.campsite_a, self.campsite_b, 3)
+        self.make_trip(self.campsite_b, self.campsite_a, 4, max_trippees=6)
+        make_application(
+            trips_year=self.trips_year,
+            trip_assignment=self.make_trip(self.campsite_b, self.campsite_b, 0),
+        )
+
+        with self.assertNumQueries(2):
+            occupancy = Campsite.objects.occupancy(self.trips_year)
+
+        first = occupancy.get(self.campsite_a.pk, self.section.at_campsite1)
+        self.assertEqual((first.trips, first.people, first.max_people), (1, 3, 10))
+        self.assertFalse(first.overbooked)
+        self.assertTrue(first.may_overbook)
+
+        second = occupancy.get(self.campsite_a.pk, self.section.at_campsite2)
+        self.assertEqual((second.trips, second.people), (1, 4))
+
+        night = occupancy.get(self.campsite_b.pk, self.section.at_campsite1)
+        self.assertEqual((night.trips, night.people), (2, 5))
+        night = occupancy.get(self.campsite_b.pk, self.section.at_campsite2)
+        self.assertEqual((night.trips, night.people), (2, 4))
+        self.assertIsNone(night.capacity)
+        self.assertFalse(night.overbooked)
+        self.assertEqual(occupancy.overbooked(), [])
+
+    def test_max_people_counts_extra_leaders(self):
+        trip = self.make_trip(self.campsite_a, self.campsite_b, 0)
+        make_application(trips_year=self.trips_year, trip_assignment=trip)
+        occupancy = Campsite.objects.occupancy(self.trips_year)
+        night = occupancy.get(self.campsite_a.pk, self.section.at_campsite1)
+        self.assertEqual((night.people, night.max_people), (1, 10))
+
+        for _ in range(2):
+            make_application(trips_year=self.trips_year, trip_assignment=trip)
+        occupancy = Campsite.objects.occupancy(self.trips_year)
+        night = occupancy.get(self.campsite_a.pk, self.section.at_campsite1)
+        self.assertEqual((night.people, night.max_people), (3, 11))
+
+    def test_overbooked(self):
+        self.make_trip(self.campsite_a, self.campsite_b, 3)
+        self.make_trip(self.campsite_a, self.campsite_b, 3)
+
+        occupancy = Campsite.objects.occupancy(self.trips_year)
+        [(campsite, date, night)] = occupancy.overbooked()
+        self.assertEqual(campsite['pk'], self.campsite_a.pk)
+        self.assertEqual(date, self.section.at_campsite1)
+        self.assertEqual(night.people, 6)
+
+    def test_occupancy_of_some_campsites(self):
+        self.make_trip(self.campsite_a, self.campsite_b, 3)
+        occupancy = Campsite.objects.occupancy(
+            self.trips_year, campsites=[self.campsite_b.pk]
+        )
+        self.assertEqual([c['pk'] for c in occupancy.campsites], [self.campsite_b.pk])
+        self.assertIsNone(occupancy.get(self.campsite_a.pk, self.section.at_campsite1))
+        self.assertEqual(
+            occupancy.get(self.campsite_b.pk, self.section.at_campsite2).people, 3
+        )
+
+    def test_json_endpoint(self):
+        self.make_trip(self.campsite_a, self.campsite_b, 6)
+        url = reverse('core:campsite:occupancy', kwargs={'trips_year': self.trips_year})
+
+        director = self.make_director()
+        response = self.app.get(url, user=director)
+        a, b = response.json['campsites']
+        self.assertEqual(a['name'], 'A')
+        self.assertEqual(
+            a['nights'],
+            [
+                {
+                    'date': self.section.at_campsite1.isoformat(),
+                    'trips': 1,
+                    'people': 6,
+                    'max_people': 10,
+                    'overbooked': True,
+                    'may_overbook': True,
+                }
+            ],
+        )
+        self.assertEqual(
+            response.json['overbooked'],
+            [
+                {
+                    'campsite': self.campsite_a.pk,
+                    'date': self.section.at_campsite1.isoformat(),
+                }
+            ],
+        )
+
+        response = self.app.get(url + f'?campsite={self.campsite_b.pk}', user=director)
+        self.assertEqual(len(response.json['campsites']), 1)
+
+        self.app.get(url + '?campsite=x', user=director, status=400)
+
+    def test_template_edit_warns_of_overbooked_campsites(self):
+        trip = self.make_trip(self.campsite_b, self.campsite_b, 6)
+        url = trip.template.update_url()
+        form = self.app.get(url, user=self.make_director()).forms[0]
+        form['template_form-campsite1'] = self.campsite_a.pk
+        response = form.submit().follow()
+        self.assertIn('A is overbooked on', response)
+
+
 class ViewsTestCase(FytTestCase):
 
     csrf_checks = False
@@ -52,6 +52,7 @@ triptype_urlpatterns = [
 
 campsite_urlpatterns = [
     url(DB_REGEX['LIST'], CampsiteMatrix.as_view(), name='index'),
+    url(r'^occupancy/$', CampsiteOccupancy.as_view(), name='occupancy'),
     url(DB_REGEX['CREATE'], CampsiteCreate.as_view(), name='create'),
     url(DB_REGEX['DETAIL'], CampsiteDetail.as_view(), name='detail'),
     url(DB_REGEX['UPDATE'], CampsiteUpdate.as_view(), name='update'),
@@ -73,6 +74,11 @@ leader_urlpatterns = [
         AssignTrippee.as_view(),
         name='assign_trippee',
     ),
+    url(
+        r'^assign/trippees/proposals/$',
+        TrippeeProposalList.as_view(),
+        name='trippee_proposals',
+    ),
     url(
         r'^assign/trippee/(?P<trippee_pk>[0-9]+)/update/$',
         AssignTrippeeToTrip.as_view(),
@@ -83,6 +89,11 @@ leader_urlpatterns = [
         AssignLeader.as_view(),
         name='assign_leader',
     ),
+    url(
+        r'^assign/leaders/proposals/$',
+        LeaderProposalList.as_view(),
+        name='leader_proposals',
+    ),
     url(
         r'^assign/leader/(?P<leader_pk>[0-9]+)/update/$',
         AssignLeaderToTrip.as_view(),
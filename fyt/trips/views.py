@@ -3,11 +3,14 @@ from statistics import mean
 
 from braces.views import FormValidMessageMixin, SetHeadlineMixin
 from crispy_forms.layout import Submit
+from django.contrib import messages
 from django.db.models import Prefetch
 from django.forms.models import modelformset_factory
+from django.http import HttpResponseRedirect, JsonResponse
 from django.urls import reverse
 from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
+from django.views.generic import View
 from vanilla import FormView, UpdateView
 
 from .forms import (
@@ -23,10 +26,12 @@ from .models import (
     NUM_BAGELS_SUPPLEMENT,
     Campsite,
     Document,
+    LeaderProposal,
     Section,
     Trip,
     TripTemplate,
     TripType,
+    TrippeeProposal,
 )
 
 from fyt.applications.models import (
@@ -57,9 +62,10 @@ from fyt.incoming.models import (
 from fyt.permissions.views import (
     ApplicationEditPermissionRequired,
     DatabaseEditPermissionRequired,
+    DatabaseReadPermissionRequired,
     TripInfoEditPermissionRequired,
 )
-from fyt.transport.models import ExternalBus, InternalBus
+from fyt.transport.models import BusIndex, ExternalBus, InternalBus
 from fyt.utils.forms import crispify
 from fyt.utils.views import MultiFormMixin, PopulateMixin
 
@@ -110,7 +116,7 @@ class TripList(DatabaseTemplateView):
     template_name = 'trips/trip_index.html'
 
     def extra_context(self):
-        return {'matrix': Trip.objects.matrix(self.trips_year)}
+        return {'matrix': Trip.objects.compact_matrix(self.trips_year)}
 
 
 class TripUpdate(DatabaseUpdateView):
@@ -201,8 +207,34 @@ class TripTemplateDetail(DatabaseDetailView):
     description_fields = ['intro', 'day1', 'day2', 'day3', 'conclusion', 'revisions']
 
 
+class _CampsiteOccupancyMixin:
+    """
+    Warn when a saved trip template leaves its campsites overbooked.
+    """
+
+    def form_valid(self, forms):
+        response = super().form_valid(forms)
+
+        template = self.object
+        occupancy = Campsite.objects.occupancy(
+            self.trips_year, campsites=[template.campsite1_id, template.campsite2_id]
+        )
+        for campsite, date, night in occupancy.overbooked():
+            messages.warning(
+                self.request,
+                f'{campsite["name"]} is overbooked on {date:%b %d}: '
+                f'{night.people} people are assigned to {night.trips} trips, '
+                f'but it holds {night.capacity}',
+            )
+
+        return response
+
+
 class TripTemplateCreate(
-    DatabaseEditPermissionRequired, MultiFormMixin, BaseCreateView
+    DatabaseEditPermissionRequired,
+    _CampsiteOccupancyMixin,
+    MultiFormMixin,
+    BaseCreateView,
 ):
     model = TripTemplate
     template_name = 'trips/triptemplate_create.html'
@@ -226,7 +258,10 @@ class TripTemplateCreate(
 
 
 class TripTemplateUpdate(
-    TripInfoEditPermissionRequired, MultiFormMixin, BaseUpdateView
+    TripInfoEditPermissionRequired,
+    _CampsiteOccupancyMixin,
+    MultiFormMixin,
+    BaseUpdateView,
 ):
     model = TripTemplate
     template_name = 'trips/triptemplate_update.html'
@@ -329,7 +364,33 @@ class CampsiteMatrix(DatabaseTemplateView):
     template_name = 'trips/campsite_index.html'
 
     def extra_context(self):
-        return {'matrix': Campsite.objects.matrix(self.trips_year)}
+        """
+        Each entry of the matrix is a pair of the trips at the campsite
+        and the Night, if any trips are there.
+        """
+        matrix = Campsite.objects.matrix(self.trips_year)
+        occupancy = Campsite.objects.occupancy(self.trips_year)
+        for campsite, dates in matrix.items():
+            for date, trips in dates.items():
+                dates[date] = (trips, occupancy.get(campsite.pk, date))
+        return {'matrix': matrix}
+
+
+class CampsiteOccupancy(DatabaseReadPermissionRequired, TripsYearMixin, View):
+    """
+    The headcount at each campsite on each night, as json.
+
+    Pass `campsite` to only include some campsites, eg.
+    ?campsite=1&campsite=2
+    """
+
+    def get(self, request, *args, **kwargs):
+        campsites = request.GET.getlist('campsite') or None
+        try:
+            occupancy = Campsite.objects.occupancy(self.trips_year, campsites)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid campsite'}, status=400)
+        return JsonResponse(occupancy.as_json())
 
 
 class CampsiteCreate(DatabaseCreateView):
@@ -525,6 +586,45 @@ class AssignTrippee(_TripMixin, DatabaseListView):
         return context
 
 
+class TrippeeProposalList(DatabaseEditPermissionRequired, DatabaseListView):
+    """
+    Review the trips proposed for unassigned trippees.
+
+    Posting `propose` replaces the proposals with a new solution, and
+    posting `apply` assigns the trippees to their proposed trips.
+    """
+
+    model = TrippeeProposal
+    template_name = 'trips/trippee_proposals.html'
+    context_object_name = 'proposals'
+
+    def get_queryset(self):
+        return (
+            super()
+            .get_queryset()
+            .select_related('trippee', 'trip__template', 'trip__section')
+            .order_by('trip__section__name', 'trip__template__name', 'trippee__name')
+        )
+
+    def post(self, request, *args, **kwargs):
+        if 'apply' in request.POST:
+            applied = TrippeeProposal.objects.apply(self.trips_year)
+            messages.success(request, f'Assigned {len(applied)} trippees to trips')
+            return HttpResponseRedirect(
+                reverse('core:leader_index', kwargs={'trips_year': self.trips_year})
+            )
+
+        assigner = TrippeeProposal.objects.propose(self.trips_year)
+        messages.success(
+            request, f'Proposed trips for {len(assigner.placements)} trippees'
+        )
+        if assigner.unplaced:
+            messages.warning(
+                request, f'No trip is available for {len(assigner.unplaced)} trippees'
+            )
+        return HttpResponseRedirect(request.path)
+
+
 class AssignTrippeeToTrip(FormValidMessageMixin, DatabaseUpdateView):
 
     model = IncomingStudent
@@ -636,6 +736,39 @@ class AssignLeader(_TripMixin, DatabaseListView):
         return context
 
 
+class LeaderProposalList(ApplicationEditPermissionRequired, DatabaseTemplateView):
+    """
+    Review the trips proposed for unassigned leaders, next to the current
+    leaders of each trip.
+
+    Posting `propose` replaces the proposals with a new solution, and
+    posting `apply` assigns the leaders to their proposed trips.
+    """
+
+    template_name = 'trips/leader_proposals.html'
+
+    def extra_context(self):
+        return {'diff': LeaderProposal.objects.diff(self.trips_year)}
+
+    def post(self, request, *args, **kwargs):
+        if 'apply' in request.POST:
+            applied = LeaderProposal.objects.apply(self.trips_year)
+            messages.success(request, f'Assigned {len(applied)} leaders to trips')
+            return HttpResponseRedirect(
+                reverse('core:leader_index', kwargs={'trips_year': self.trips_year})
+            )
+
+        assigner = LeaderProposal.objects.propose(self.trips_year)
+        messages.success(
+            request, f'Proposed trips for {len(assigner.placements)} leaders'
+        )
+        if assigner.unplaced:
+            messages.warning(
+                request, f'No trip is available for {len(assigner.unplaced)} leaders'
+            )
+        return HttpResponseRedirect(request.path)
+
+
 class AssignLeaderToTrip(
     ApplicationEditPermissionRequired,
     PopulateMixin,
@@ -705,7 +838,7 @@ class TrippeeLeaderCounts(DatabaseTemplateView):
     template_name = 'trips/trippee_leader_counts.html'
 
     def extra_context(self):
-        return {'matrix': Trip.objects.matrix(self.trips_year)}
+        return {'matrix': Trip.objects.compact_matrix(self.trips_year)}
 
 
 class FoodboxCounts(DatabaseListView):
@@ -776,7 +909,7 @@ class PacketsForSection(_SectionMixin, DatabaseListView):
     context_object_name = 'trips'
 
     def get_queryset(self):
-        return (
+        qs = (
             super()
             .get_queryset()
             .filter(section=self.section)
@@ -791,6 +924,7 @@ class PacketsForSection(_SectionMixin, DatabaseListView):
                 'leaders', 'leaders__applicant', 'trippees', 'trippees__registration'
             )
         )
+        return BusIndex.preload(qs, self.trips_year)
 
 
 class MedicalInfoForSection(PacketsForSection):
@@ -46,3 +46,34 @@ class OrderedMatrix(OrderedDict):
             for col in self.cols:
                 new[row][col] = func(self[row][col])
         return new
+
+
+class CompactMatrix:
+    """
+    A matrix of plain values, indexed by position.
+
+    `rows` and `cols` are lists of dicts, eg. from a `values` queryset, and
+    each must have a `pk`. `cells[i][j]` holds the entry for `rows[i]` and
+    `cols[j]`. Iterating over the matrix gives each row with a list of
+    `(col, entry)` pairs.
+    """
+
+    def __init__(self, rows, cols, default=None):
+        self.rows = list(rows)
+        self.cols = list(cols)
+        self.row_index = {row['pk']: i for i, row in enumerate(self.rows)}
+        self.col_index = {col['pk']: j for j, col in enumerate(self.cols)}
+        self.cells = [[default] * len(self.cols) for _ in self.rows]
+
+    def set(self, row_pk, col_pk, value):
+        self.cells[self.row_index[row_pk]][self.col_index[col_pk]] = value
+
+    def get(self, row_pk, col_pk):
+        return self.cells[self.row_index[row_pk]][self.col_index[col_pk]]
+
+    def __iter__(self):
+        for row, cells in zip(self.rows, self.cells):
+            yield row, list(zip(self.cols, cells))
+
+    def __len__(self):
+        return len(self.rows)
@@ -8,7 +8,7 @@ from fyt.test import FytTestCase
 from fyt.trips.models import Section
 from fyt.utils.fmt import join_with_and, join_with_or, section_range
 from fyt.utils.lat_lng import parse_lat_lng, validate_lat_lng
-from fyt.utils.matrix import OrderedMatrix
+from fyt.utils.matrix import CompactMatrix, OrderedMatrix
 
 
 class OrderedMatrixTestCase(unittest.TestCase):
@@ -34,6 +34,28 @@ class OrderedMatrixTestCase(unittest.TestCase):
         self.assertEqual(m[0][0], 0)
 
 
+class CompactMatrixTestCase(unittest.TestCase):
+    def test_set_and_get(self):
+        m = CompactMatrix([{'pk': 3}, {'pk': 1}], [{'pk': 2}])
+        m.set(1, 2, 'x')
+        self.assertEqual(m.get(1, 2), 'x')
+        self.assertIsNone(m.get(3, 2))
+        self.assertEqual(m.cells, [[None], ['x']])
+
+    def test_iterate_rows_with_cols(self):
+        rows = [{'pk': 1}, {'pk': 2}]
+        cols = [{'pk': 5}, {'pk': 6}]
+        m = CompactMatrix(rows, cols, default=0)
+        m.set(2, 6, 1)
+        self.assertEqual(
+            list(m),
+            [
+                (rows[0], [(cols[0], 0), (cols[1], 0)]),
+                (rows[1], [(cols[0], 0), (cols[1], 1)]),
+            ],
+        )
+
+
 class FmtUtilsTest(FytTestCase):
     def test_section_range(self):
         mommy.make(Section, name="A")